@@ -23,7 +23,8 @@ Key Components:
 - Organisation API: Manage departments and teams.
 - Settings API: Retrieve application settings.
 Security:
-- Most API endpoints require authentication via cookies (auth_token, user).
+- Most API endpoints require authentication via cookies (auth_token, user),
+    or a global token in the Authorization header for service integrations.
 - Permission checks are enforced for sensitive operations.
 - Special handling for "breakglass" account to prevent security vulnerabilities.
 Usage:
@@ -36,8 +37,9 @@ Note:
 from flask import Flask, render_template, redirect, url_for, jsonify, request
 from mako.template import Template
 from mako.lookup import TemplateLookup
-import os, sys
-import health_checks, init, create_database, auth, database, logger
+import os, sys, atexit, json, base64, html
+from datetime import datetime
+import health_checks, init, create_database, auth, database, logger, scheduler, throttle, migrations, db_util
 
 app = Flask(__name__)
 
@@ -47,6 +49,149 @@ template_lookup = TemplateLookup(directories=['templates'])
 # Create a logger for the API
 api_logger = logger.get_logger('api', log_file='logs/api.log')
 
+# List endpoints return a page at a time, the client asks for the next page with the cursor it was given
+PAGE_DEFAULT_LIMIT = 50
+
+# The password hashing workers run this module again as __mp_main__ when they start (app.py is the main
+# module under run.sh), they only need auth so the startup work below is skipped for them
+if __name__ != '__mp_main__':
+    # Bring the database schema up to date before anything uses it.
+    # Before install there is no database, init_database() applies them after the install instead.
+    # Once installed a failed migration stops the app, rather than serving requests against an old schema.
+    if db_util.credentials_exist():
+        try:
+            migrations.migrate()
+        except Exception as error:
+            api_logger.critical('Unable to apply database migrations at startup, not starting: %s', error)
+            raise
+
+    # Open the pool's minimum connections now rather than on the first request.
+    # Before install there are no credentials, the pool will be created on first use instead.
+    try:
+        database.establish_pool()
+    except Exception as error:
+        api_logger.warning('Unable to establish the connection pools at startup, will connect on first use: %s', error)
+
+    # Signed tokens can't be issued or checked without a usable secret, don't start without one
+    if auth.TOKEN_MODE == auth.SIGNED_TOKEN_MODE:
+        auth.get_token_secret()
+
+    # Load the permission name to bit table up front so permission checks never need the database.
+    # Before install there is nothing to load, it will be loaded on first use instead.
+    try:
+        auth.load_permission_bits()
+    except Exception as error:
+        api_logger.warning('Unable to load permission bits at startup, will load on first use: %s', error)
+
+    # Delete expired tokens in the background
+    scheduler.schedule('token_sweeper', auth.TOKEN_SWEEP_INTERVAL, auth.sweep_expired_tokens)
+
+    # Write sliding session deadlines in batches, and whatever is left when the app stops
+    scheduler.schedule('session_renewals', auth.SESSION_RENEWAL_INTERVAL, auth.flush_session_renewals)
+    atexit.register(auth.flush_session_renewals)
+
+    # Replace broken idle connections (e.g. after a database restart) before a request finds them
+    scheduler.schedule('pool_maintenance', database.POOL_MAINTENANCE_INTERVAL, database.maintain_pool)
+
+    # Recount the dashboard request counters, in case anything got past the trigger
+    scheduler.schedule('request_stats_reconcile', database.REQUEST_STATS_RECONCILE_INTERVAL, database.reconcile_request_stats)
+
+    # Summarise the connection pool metrics in the database log
+    scheduler.schedule('pool_metrics', database.POOL_METRICS_LOG_INTERVAL, database.log_pool_summary)
+
+    # Shared login throttle buckets live in the database, clear out the ones that have refilled
+    if throttle.SHARED_BUCKETS:
+        scheduler.schedule('login_throttle_sweeper', throttle.SHARED_BUCKET_SWEEP_INTERVAL, throttle.sweep_shared_buckets)
+
+def get_auth_data() -> tuple:
+    ''' Return the token and username to authenticate an API request with.
+    Service integrations send a global token in the Authorization header
+    (Bearer) and act as the user who created it. Everyone else uses the
+    auth_token and user cookies.
+
+    Returns:
+        tuple: token and username, either may be None
+    '''
+
+    authorization = request.headers.get('Authorization', '')
+
+    if authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):].strip()
+
+        # only global tokens are accepted in the header
+        if not auth.is_global_token(token):
+            return None, None
+
+        try:
+            context = auth.get_auth_context(token)
+        except Exception as error:
+            api_logger.error('Error looking up global token: %s', error)
+            return token, None
+
+        return token, context.username if context else None
+
+    return request.cookies.get('auth_token'), request.cookies.get('user')
+
+def get_page_args(key_length=1) -> tuple:
+    ''' Return the page size and the position to continue after for a list endpoint,
+    from the limit and cursor query args. The cursor is the opaque next_cursor
+    of the previous page, a list of the sort key values of its last row.
+
+    Args:
+        key_length: number of values in the endpoint's sort key
+
+    Returns:
+        tuple: the limit, and the sort key values (list) or None for the first page
+
+    Raises:
+        ValueError: When the cursor isn't one this endpoint handed out
+    '''
+
+    limit = request.args.get('limit', default=PAGE_DEFAULT_LIMIT, type=int)
+    limit = max(1, min(limit, database.PAGE_MAX_LIMIT))
+
+    cursor = request.args.get('cursor')
+
+    if not cursor:
+        return limit, None
+
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except ValueError as error:
+        raise ValueError('Invalid cursor') from error
+
+    # the last value is always the row id
+    if not isinstance(after, list) or len(after) != key_length or not isinstance(after[-1], int) or isinstance(after[-1], bool):
+        raise ValueError('Invalid cursor')
+
+    return limit, after
+
+def page_response(rows, limit, cursor_key) -> dict:
+    ''' Return a page of a list endpoint, the rows and the cursor for the next page.
+
+    Args:
+        rows: up to limit + 1 rows, the extra row only says there is another page
+        limit: the page size
+        cursor_key: function returning the sort key values (list) of a row
+
+    Returns:
+        dict: items, and next_cursor (None on the last page)
+    '''
+
+    next_cursor = None
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        key = json.dumps(cursor_key(rows[-1]), default=lambda value: value.isoformat())
+        next_cursor = base64.urlsafe_b64encode(key.encode()).decode().rstrip('=')
+
+    return {'items': rows, 'next_cursor': next_cursor}
+
+@app.teardown_request
+def release_database_connection(error) -> None:
+    ''' Return the request's database connection (if it used one) to the pool. '''
+    database.release_request_connection(error)
+
 """ UI Routes """
 
 @app.route('/')
@@ -159,30 +304,35 @@ def dashboard() -> str:
 
 @app.route('/api/users', methods=['GET'])
 def get_users() -> str:
-    ''' Return all users.
+    ''' Return a page of users, in id order (limit and cursor query args).
    Will only return users that the user has permissions to see.
 
     Returns:
-        str: json formatted string of users
+        str: json formatted string of the users (items) and the cursor 
+        for the next page (next_cursor)
     '''
 
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
-    if auth.check_token(username, token) is False:
+    if auth.check_token(username, token, allow_global=True) is False:
         api_logger.info('User %s not authenticated when accessing \'/api/users\'. Return error JSON.', username)
         return jsonify({'error': 'Authentication required'}), 401
 
+    try:
+        limit, after = get_page_args()
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+
     users = []
 
     # breakglass can see all users
     if auth.check_permission('breakglass', token) is True:
         api_logger.warning('Breakglass user %s accessed \'/api/users\'', username)
-        users = database.get_all_users()
+        users = database.get_all_users(limit + 1, after[0] if after else None) or []
     
     # normal users can only limited scope of users and data depending on their permissions
 
-    return jsonify(users)
+    return jsonify(page_response(users, limit, lambda user: [user[0]]))
 
 @app.route('/api/users/new', methods=['POST'])
 def create_new_user() -> str:
@@ -194,8 +344,7 @@ def create_new_user() -> str:
         user was created successfully.
     '''
 
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
@@ -215,29 +364,25 @@ def create_new_user() -> str:
             api_logger.warning('Insuffienct fields or data provided when creating a new user via \'/api/users/new\' by %s', username)
             return jsonify({'error': 'One or more fields not provided.'}), 400
 
-        # hash the password
+        # hash the password, without holding a database connection while it runs
+        database.release_request_connection()
         try:
             password = auth.hash(password)
+        except auth.HashQueueFullError as e:
+            api_logger.warning('Password hashing queue full when creating user via \'/api/users/new\' by %s', username)
+            return jsonify({'error': str(e)}), 503
         except Exception as e:
             api_logger.error('Error trying to hash password for user %s - error from argon2 library: %s', username, e)
             return jsonify({'error': f"Error hashing password: {e}"}), 500
         
-        # check if the user already exists
-        try:
-            if database.get_user_by_username(new_username):
-                api_logger.info('User %s already exists when trying to create a new user via \'/api/users/new\'', new_username)
-                return jsonify({'error': 'User already exists'}), 400
-            if database.get_user_by_email(email):
-                api_logger.info('Email %s already in use when trying to create a new user via \'/api/users/new\'', email)
-                return jsonify({'error': 'Email already in use'}), 400
-        except Exception as e:
-            api_logger.info('User or email already exists when trying to create a new user via \'/api/users/new\': %s', e)
-            pass  # an exception in this case is fine, it just means the user or email doesn't exist
-        
+        # a username or email that is already taken is caught by the insert itself
         try:
             database.add_user(new_username, email, password, [], teams, 0, False, firstname, lastname)
             api_logger.info('New user created %s', new_username)
             return jsonify({'success': 'User created successfully'}), 201
+        except database.UserExistsError as e:
+            api_logger.info('Username %s or email %s already in use when trying to create a new user via \'/api/users/new\'', new_username, email)
+            return jsonify({'error': str(e)}), 400
         except Exception as e:
             print(f"Error creating user: {e}")
             return jsonify({'error': str(e)}), 500
@@ -252,9 +397,10 @@ def get_user_self() -> str:
         str: json formatted string of user data
     '''
 
-    token = request.cookies.get('auth_token')
+    token, username = get_auth_data()
     
-    if not token:
+    # check token and user from cookies
+    if auth.check_token(username, token) is False:
         return jsonify({'error': 'Authentication required'}), 401
     
     user = database.get_user_by_token(token)
@@ -262,6 +408,10 @@ def get_user_self() -> str:
     if not user:
         return jsonify({'error': 'User not found'}), 404
     
+    # never send the password hash, blanked rather than removed so the other fields keep their positions
+    user = list(user)
+    user[3] = None
+
     return jsonify(user)
 
 ''' Authentication API '''
@@ -280,14 +430,34 @@ def login() -> str:
         username = data.get('username')
         password = data.get('password')
 
+        # the client's own address, not the reverse proxy's
+        address = throttle.client_address(request.remote_addr, request.headers.get('X-Forwarded-For'))
+
+        # too many attempts for this user or from this address, reject before doing any hashing or database work
+        try:
+            if not throttle.allow_login(username, address):
+                return jsonify({'message': 'Too many login attempts, try again later', 'status': 'failure'}), 429
+        except Exception as error:
+            api_logger.error('Error while throttling login for %s: %s', username, error)
+            return jsonify({'message': str(error), 'status': 'failure'}), 500
+
         # authenticate the user 
         try:
             token = auth.authenticate_user(username, password)
+        except auth.HashQueueFullError as error:
+            api_logger.warning('Login for %s rejected, password hashing queue is full', username)
+            return jsonify({'message': str(error), 'status': 'failure'}), 503
         except Exception as error:
             return jsonify({'message': str(error), 'status': 'failure'})
 
         # sends the token back with the username to store in a cookie
         if (token):
+            # only failed attempts count against the throttle
+            try:
+                throttle.refund_login(username, address)
+            except Exception as error:
+                api_logger.warning('Unable to refund login throttle tokens for %s: %s', username, error)
+
             return jsonify({'message': 'Login successful', 'status': 'success', 'token': token, 'user': username})
         else:
             return jsonify({'message': 'Username or password incorrect', 'status': 'failure'})
@@ -418,9 +588,12 @@ def database_health() -> str:
     global_tokens_exists = health_checks.check_table_exists('global_tokens')
     request_types_exists = health_checks.check_table_exists('request_types')
     teams_exists = health_checks.check_table_exists('teams')
+    token_revocations_exists = health_checks.check_table_exists('token_revocations')
+    login_throttle_exists = health_checks.check_table_exists('login_throttle')
+    team_members_exists = health_checks.check_table_exists('team_members')
 
     # If the tables don't exist, return an error
-    if not users_exists or not permissions_exists or not requests_exists or not tokens_exists or not settings_exists or not updates_exists or not departments_exists or not global_tokens_exists or not request_types_exists or not teams_exists:
+    if not users_exists or not permissions_exists or not requests_exists or not tokens_exists or not settings_exists or not updates_exists or not departments_exists or not global_tokens_exists or not request_types_exists or not teams_exists or not token_revocations_exists or not login_throttle_exists or not team_members_exists:
         return jsonify({'error': 'One or more tables do not exist'}), 500
 
     # If everything is fine, return a success message
@@ -489,20 +662,21 @@ def get_request_by_id(request_id) -> str:
     Checks if the user is authenticated and if the request exists in the database.
 
     Returns:
-        str: json formatted string of the request data or error message
+        str: json formatted string of the request (id, requester, requested_at, priority, 
+            outage, title, description, department, team, assignee, escalation_level, type,
+            resolved, resolved_at) or error message
     '''
 
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
         return jsonify({'error': 'Authentication required'}), 401
 
-    # get the request from the database
+    # get the request, with the type, department, team and assignee names, from the database
     try:
-        request_data = database.get_request_by_id(request_id)
+        request_data = database.get_request_detail(request_id)
     except:
         return jsonify({'error': 'No requests found with that ID.'}), 404
     
@@ -512,46 +686,6 @@ def get_request_by_id(request_id) -> str:
 
     # TODO: Check permissions or user role to determine if they can view the request
 
-    # get type name
-    type_name = ""
-    if request_data[11] is not None:
-        type_name = database.get_request_type_by_id(request_data[11])[1]
-
-    # get department name
-    department_name = "<No Department>"
-    try: 
-        department_name = ""
-        if request_data[7] is not None:
-            department_name = database.get_department_by_id(request_data[7])[1]
-    except Exception:
-        api_logger.warning('Error getting department name for request ID %d: %s', request_id, str(Exception))
-        department_name = "<No Department>"
-
-    # get team name
-    team_name = ""
-    if request_data[8] is not None:
-        team_name = database.get_team_by_id(request_data[8])[1]
-
-    # get assignee name
-    assignee_name = ""
-    if request_data[9] is not None:
-        assignee_name = database.get_user_by_id(request_data[9])[1]
-
-    request_data = (
-        request_data[0],
-        request_data[1],
-        request_data[2],
-        request_data[3],    
-        request_data[4],
-        request_data[5],
-        request_data[6],
-        department_name,
-        team_name,
-        assignee_name,
-        request_data[10],
-        type_name
-    )
-
     return jsonify(request_data), 200
 
 @app.route('/api/requests/new', methods=['POST'])
@@ -563,11 +697,10 @@ def new_request() -> str:
     '''
 
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
-    # check token and user from cookies
-    if auth.check_token(username, token) is False:
+    # check token and user, global tokens are accepted as the permission scope is checked below
+    if auth.check_token(username, token, allow_global=True) is False:
         return jsonify({'error': 'Authentication required'}), 401
     
     request_title = None
@@ -600,59 +733,222 @@ def new_request() -> str:
     # the token has the perms, create the new request
     if create_request_permission:
         # TODO: Login to determine team and other fields that are not provided
-        database.add_request(username, request_title, request_description, request_type, request_department)
-        return jsonify({'success': 'Request created.'}), 200
+        try:
+            new_request = database.add_request(username, request_title, request_description, request_type, request_department)
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+
+        return jsonify({'success': 'Request created.', 'id': new_request[0]}), 200
     else:
         return jsonify({'error': 'Permission denied.'}), 405
     
 @app.route('/api/requests/unassigned', methods=['GET'])
 def get_unassigned_unresolved_requests() -> str:
-    ''' Get all unassigned requests (that are not resolved) that the user has permission to see.
+    ''' Get a page of unassigned requests (that are not resolved) that the user has permission 
+    to see, oldest first (limit and cursor query args).
     Returns:
-        str: json formatted string of all unassigned requests or error message
+        str: json formatted string of the unassigned requests (items) and the cursor
+        for the next page (next_cursor) or error message
     '''
 
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
-    # check token and user from cookies
-    if auth.check_token(username, token) is False:
+    # check token and user, global tokens are accepted as the permission scope is checked below
+    if auth.check_token(username, token, allow_global=True) is False:
         return jsonify({'error': 'Authentication required'}), 401
 
+    try:
+        limit, after = get_page_args()
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+
     # get all requests for breakglass
     if (auth.check_permission('breakglass', token) is True):
-        result = database.get_all_unassigned_unresolved_requests()
-        return jsonify(result), 200
+        result = database.get_all_unassigned_unresolved_requests(limit + 1, after[0] if after else None)
+        return jsonify(page_response(result, limit, lambda request_data: [request_data[0]])), 200
     
     # TODO: Check permissions and return unassigned requets for user
     
     return jsonify({'error': 'Permission denied'}), 403
 
+@app.route('/api/requests', methods=['GET'])
+def query_requests() -> str:
+    ''' Get a page of the requests matching the filters in the query args, for agent work queues.
+    department, team, assignee, type, priority and escalation_level take ids/numbers and can be
+    repeated to match any of them (none matches requests where it isn't set). outage and resolved
+    take true or false, requested_after and requested_before take ISO dates. sort is requested_at
+    (default), priority or id, prefixed with - for largest first (default -requested_at).
+    Paged with the limit and cursor query args.
+
+    Returns:
+        str: json formatted string of the requests (items) and the cursor for the 
+        next page (next_cursor) or error message
+    '''
+
+    # get auth data
+    token, username = get_auth_data()
+
+    # check token and user, global tokens are accepted as the permission scope is checked below
+    if auth.check_token(username, token, allow_global=True) is False:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    # agents, who resolve requests, work from queues
+    if auth.check_permission('resolve_request', token) is not True:
+        return jsonify({'error': 'Permission denied'}), 403
+
+    sort = request.args.get('sort', default='-requested_at', type=str)
+    descending = sort.startswith('-')
+    sort = sort.lstrip('-')
+
+    try:
+        limit, after = get_page_args(key_length=1 if sort == 'id' else 2)
+
+        filters = {}
+        for name in database.REQUEST_FILTERS:
+            values = request.args.getlist(name)
+
+            if not values:
+                continue
+
+            if name in ('outage', 'resolved'):
+                if values[0] not in ('true', 'false'):
+                    raise ValueError(f'{name} must be true or false')
+                filters[name] = [values[0] == 'true']
+            else:
+                filters[name] = [None if value == 'none' else int(value) for value in values]
+
+        requested_after = request.args.get('requested_after')
+        requested_before = request.args.get('requested_before')
+
+        result = database.query_requests(
+            filters,
+            requested_after=datetime.fromisoformat(requested_after) if requested_after else None,
+            requested_before=datetime.fromisoformat(requested_before) if requested_before else None,
+            sort=sort,
+            descending=descending,
+            limit=limit + 1,
+            after=after
+        )
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+
+    sort_index = {'requested_at': 2, 'priority': 3}
+
+    if sort == 'id':
+        cursor_key = lambda request_data: [request_data[0]]
+    else:
+        cursor_key = lambda request_data: [request_data[sort_index[sort]], request_data[0]]
+
+    return jsonify(page_response(result, limit, cursor_key)), 200
+
+@app.route('/api/requests/stats', methods=['GET'])
+def get_request_stats() -> str:
+    ''' Get the open, unassigned and resolved request counts, in total and per 
+    department, team, type and priority (by id, "none" for requests without one).
+
+    Returns:
+        str: json formatted string of the counts, e.g. {"team": {"3": {"open": 5, ...}}}, or error message
+    '''
+
+    # get auth data
+    token, username = get_auth_data()
+
+    # check token and user, global tokens are accepted as the permission scope is checked below
+    if auth.check_token(username, token, allow_global=True) is False:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    if auth.check_permission('resolve_request', token) is not True:
+        return jsonify({'error': 'Permission denied'}), 403
+
+    stats = {}
+    for dimension, key, open_count, unassigned_count, resolved_count in database.get_request_stats():
+        counts = {'open': open_count, 'unassigned': unassigned_count, 'resolved': resolved_count}
+
+        if dimension == 'all':
+            stats['total'] = counts
+        else:
+            stats.setdefault(dimension, {})['none' if key == -1 else str(key)] = counts
+
+    return jsonify(stats), 200
+
+@app.route('/api/requests/search', methods=['GET'])
+def search_requests() -> str:
+    ''' Full text search over request titles, descriptions and updates, best matches
+    first. q is the search (web search syntax, "quoted phrases", or, -not). Agents
+    search every request, everyone else only their own requests and the updates 
+    they can see. Paged with the limit and cursor query args.
+
+    Returns:
+        str: json formatted string of the results (items: kind, id, request_id, title,
+        snippet with the matches in <mark>, rank) and the cursor for the next page 
+        (next_cursor) or error message
+    '''
+
+    # get auth data
+    token, username = get_auth_data()
+
+    # check token and user from cookies
+    if auth.check_token(username, token) is False:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    search_text = request.args.get('q', default='', type=str).strip()
+
+    if not search_text:
+        return jsonify({'error': 'Nothing to search for'}), 400
+
+    try:
+        limit, after = get_page_args(key_length=3)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+
+    if after and (not isinstance(after[0], (int, float)) or after[1] not in ('request', 'update')):
+        return jsonify({'error': 'Invalid cursor'}), 400
+
+    # agents see everything, everyone else only their own requests
+    requester_id = None
+    if auth.check_permission('resolve_request', token) is not True:
+        requester_id = auth.get_auth_context(token).user_id
+
+    results = database.search_requests(search_text, requester_id, limit + 1, after)
+    page = page_response(results, limit, lambda result: [result[0], result[1], result[2]])
+
+    # the snippets are user text, escape them before marking the matches
+    page['items'] = [{
+        'kind': kind,
+        'id': result_id,
+        'request_id': request_id,
+        'title': title,
+        'snippet': html.escape(snippet or '').replace(database.SEARCH_MATCH_START, '<mark>').replace(database.SEARCH_MATCH_STOP, '</mark>'),
+        'rank': rank
+    } for rank, kind, result_id, request_id, title, snippet in page['items']]
+
+    return jsonify(page), 200
+
 @app.route('/api/requests/user/self', methods=['GET'])
 def get_requests_self() -> str:
-    ''' Get all requests made by the currently logged in user.
+    ''' Get a page of the requests made by the currently logged in user, newest 
+    first (limit and cursor query args).
 
     Returns:
-        str: json formatted string of all request data made by the user or error message
+        str: json formatted string of the requests made by the user (items) and the
+        cursor for the next page (next_cursor) or error message
     '''
         
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
         return jsonify({'error': 'Authentication required'}), 401
 
     # get what requests are needed based on filters
-    page = request.args.get('page', default=1, type=int)
-    count = request.args.get('count', default=10, type=int)
-    sort = request.args.get('sort', default=None, type=str)
+    try:
+        limit, after = get_page_args()
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
 
-    # limit the count to something reasonable
-    if count > 50:
-        count = 50
+    sort = request.args.get('sort', default=None, type=str)
 
     # check token
     if not token or not username:
@@ -665,9 +961,9 @@ def get_requests_self() -> str:
 
     # TODO: Sort the return data using the sort arg if set
 
-    requests = database.get_requests_by_requester(username)
+    requests = database.get_requests_by_requester(username, limit + 1, after[0] if after else None)
 
-    return jsonify(requests), 200
+    return jsonify(page_response(requests, limit, lambda request_data: [request_data[0]])), 200
 
 @app.route('/api/requests/types', methods=['GET'])
 def get_request_types() -> str:
@@ -678,8 +974,7 @@ def get_request_types() -> str:
     '''
         
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
@@ -700,8 +995,7 @@ def get_request_departments() -> str:
     '''
         
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
@@ -717,31 +1011,34 @@ def get_request_departments() -> str:
 
 @app.route('/api/requests/<int:request_id>/updates', methods=['GET'])
 def get_request_updates(request_id) -> str:
-    ''' Get all the updates for a request by its ID.
+    ''' Get a page of the updates for a request by its ID, in the order they 
+    were made (limit and cursor query args).
 
     Returns:
-        str: json formatted string of all updates for the request or error message
+        str: json formatted string of the updates for the request (items) and the
+        cursor for the next page (next_cursor) or error message
     '''
         
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
         return jsonify({'error': 'Authentication required'}), 401
 
+    try:
+        limit, after = get_page_args(key_length=2)
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+
     # get the request from the database
     try:
-        updates_data = database.get_updates_by_request_id(request_id)
+        updates_data = database.get_updates_by_request_id(request_id, limit + 1, after)
     except Exception as e:
         return jsonify({'error': f"No updates or no request found while fetching updates. {e}"}), 404
     
-    # check if empty
-    if not updates_data:
-        return jsonify({}), 200
-    
-    return jsonify(updates_data), 200
+    # sorted by when they were made, then id
+    return jsonify(page_response(updates_data, limit, lambda update: [update[1], update[0]])), 200
 
 @app.route('/api/requests/<int:request_id>/updates/new', methods=['POST'])
 def new_request_update(request_id) -> str:
@@ -752,8 +1049,7 @@ def new_request_update(request_id) -> str:
     '''
 
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
@@ -770,9 +1066,21 @@ def new_request_update(request_id) -> str:
         if not update_content or update_content == "":
             return jsonify({'error': 'Empty update content send for new update.'}), 406
         
+    # staff who can resolve requests can update any request, otherwise only the requester or assignee can,
+    # checked by the insert itself
+    update_any = auth.check_permission('resolve_request', token)
+
     # default value for customer visible is true
-    database.add_update(request_id, username, update_content, True) 
-    return jsonify({'success': 'Update added.'}), 200
+    try:
+        update = database.add_update(request_id, username, update_content, True, update_any)
+    except database.RequestNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except database.RequestPermissionError:
+        return jsonify({'error': 'Permission denied.'}), 405
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    return jsonify({'success': 'Update added.', 'id': update[0]}), 200
 
 @app.route('/api/requests/<int:request_id>/resolve', methods=['POST'])
 def resolve_request(request_id) -> str:
@@ -783,36 +1091,27 @@ def resolve_request(request_id) -> str:
     '''
        
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
         return jsonify({'error': 'Authentication required'}), 401
 
-    resolve_request_permission = False
-    
-    # check if the logged in user has permission to resolve a request
-    resolve_request_permission = auth.check_permission('resolve_request', token)
-
-    # Check if the user created the request, if so, they can resolve it
-    user_data = database.get_user_by_token(token)
-    request_data = database.get_request_by_id(request_id)
-
-    if user_data[0] == request_data[1]:
-        resolve_request_permission = True
+    # check if the logged in user has permission to resolve any request, if not the request
+    # is only resolved if they created it, checked by the update itself
+    resolve_any = auth.check_permission('resolve_request', token)
 
     # TODO: More checks around compartmentalisation and team permissions
 
-    # If permission to resolve, resolve the request
-    if resolve_request_permission:
-        try:
-            database.resolve_request(request_id)
-            return jsonify({'success': 'Request resolved.'}), 200
-        except Exception as e:
-            return jsonify({'error': str(e)}), 500
-    else:
+    try:
+        database.resolve_request(request_id, username, resolve_any)
+        return jsonify({'success': 'Request resolved.'}), 200
+    except database.RequestNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    except database.RequestPermissionError:
         return jsonify({'error': 'Permission denied.'}), 405
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 ''' Organisation API '''
 
@@ -825,8 +1124,7 @@ def get_departments() -> str:
     '''
 
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
@@ -847,8 +1145,7 @@ def get_department_by_id(department_id) -> str:
     '''
 
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
@@ -872,8 +1169,7 @@ def get_teams() -> str:
     '''
         
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
@@ -894,8 +1190,7 @@ def get_team_by_id(team_id) -> str:
     '''
         
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
@@ -916,8 +1211,7 @@ def new_team() -> str:
     '''
 
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
@@ -955,8 +1249,7 @@ def new_department() -> str:
     '''
 
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
@@ -985,6 +1278,137 @@ def new_department() -> str:
 
     return jsonify({'error': 'Adding department failed.'}), 200
 
+''' Global Tokens API '''
+
+@app.route('/api/tokens/global', methods=['GET'])
+def get_global_tokens() -> str:
+    ''' Get all global tokens (without the token values).
+
+    Returns:
+        str: json formatted string of global tokens or error message
+    '''
+
+    # get auth data
+    token, username = get_auth_data()
+
+    # check token and user from cookies
+    if auth.check_token(username, token) is False:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    if auth.check_permission('breakglass', token) is not True:
+        return jsonify({'error': 'Permission denied'}), 403
+
+    try:
+        return jsonify(database.get_global_tokens()), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/tokens/global/new', methods=['POST'])
+def new_global_token() -> str:
+    ''' Create a global token for a service integration with the name,
+    scopes (permission names) and valid_days provided in the request body.
+    The token is only ever returned here.
+
+    Returns:
+        str: json formatted string of the new token or error message
+    '''
+
+    # get auth data
+    token, username = get_auth_data()
+
+    # check token and user from cookies
+    if auth.check_token(username, token) is False:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    if auth.check_permission('breakglass', token) is not True:
+        return jsonify({'error': 'Permission denied'}), 403
+
+    if not request.is_json:
+        return jsonify({'error': 'Invalid request format'}), 400
+
+    data = request.get_json()
+    name = data.get('name')
+    scopes = data.get('scopes')
+    valid_days = data.get('valid_days', 90)
+
+    if not name or not scopes:
+        return jsonify({'error': 'A name and at least one scope are required.'}), 400
+
+    try:
+        global_token = auth.create_global_token(token, name, list(scopes), int(valid_days))
+        api_logger.warning('Global token %s created by %s', name, username)
+        return jsonify({'success': 'Global token created.', 'token': global_token}), 201
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+
+@app.route('/api/tokens/global/<int:token_id>/revoke', methods=['POST'])
+def revoke_global_token(token_id) -> str:
+    ''' Revoke a global token by its ID.
+
+    Returns:
+        str: json formatted string of success or error message
+    '''
+
+    # get auth data
+    token, username = get_auth_data()
+
+    # check token and user from cookies
+    if auth.check_token(username, token) is False:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    if auth.check_permission('breakglass', token) is not True:
+        return jsonify({'error': 'Permission denied'}), 403
+
+    try:
+        auth.revoke_global_token(token_id)
+        api_logger.warning('Global token %s revoked by %s', token_id, username)
+        return jsonify({'success': 'Global token revoked.'}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 404
+
+''' Metrics API '''
+
+@app.route('/api/metrics/auth', methods=['GET'])
+def get_auth_metrics() -> str:
+    ''' Get the password hashing pool metrics (queue length, wait times, rejections).
+
+    Returns:
+        str: json formatted string of the metrics or error message
+    '''
+
+    # get auth data
+    token, username = get_auth_data()
+
+    # check token and user, global tokens are accepted as the permission scope is checked below
+    if auth.check_token(username, token, allow_global=True) is False:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    if auth.check_permission('breakglass', token) is not True:
+        return jsonify({'error': 'Permission denied'}), 403
+
+    return jsonify(auth.get_hash_metrics()), 200
+
+@app.route('/api/metrics/database', methods=['GET'])
+def get_database_metrics() -> str:
+    ''' Get the metrics of each database connection pool (connections in use and idle,
+    checkout wait and hold times, timeouts, connections created and discarded).
+
+    Returns:
+        str: json formatted string of the metrics or error message
+    '''
+
+    # get auth data
+    token, username = get_auth_data()
+
+    # check token and user, global tokens are accepted as the permission scope is checked below
+    if auth.check_token(username, token, allow_global=True) is False:
+        return jsonify({'error': 'Authentication required'}), 401
+
+    if auth.check_permission('breakglass', token) is not True:
+        return jsonify({'error': 'Permission denied'}), 403
+
+    return jsonify(database.get_pool_metrics()), 200
+
 ''' Settings API '''
 
 @app.route('/api/settings/<string:setting_name>', methods=['GET'])
@@ -996,8 +1420,7 @@ def get_setting_by_name(setting_name) -> str:
     '''
 
     # get auth data
-    token = request.cookies.get('auth_token')
-    username = request.cookies.get('user')
+    token, username = get_auth_data()
 
     # check token and user from cookies
     if auth.check_token(username, token) is False:
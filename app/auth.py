@@ -1,13 +1,152 @@
-from argon2 import PasswordHasher
-from flask import request
-import datetime, logger, secrets, database
+from argon2 import PasswordHasher, extract_parameters
+from flask import request, g, has_request_context
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import datetime, logger, secrets, database, threading, time, os, json, hmac, hashlib, base64, tempfile, multiprocessing
 
 ARGON_PARRALELISM = 4
 ARGON_MEMORY_COST = 102400
-ARGON_TIME_COST = 3
+ARGON_TIME_COST = 4
+
+# Parameters picked for this host by calibrate_argon2.py, overriding the defaults above.
+# Stored hashes made with weaker parameters are upgraded on the user's next successful login.
+ARGON_PARAMS_FILE = 'argon2_params.json'
+
+# Expired tokens are deleted in the background, a batch at a time so the sweep never holds
+# many row locks or competes with logins for long
+TOKEN_SWEEP_INTERVAL = 300  # seconds
+TOKEN_SWEEP_BATCH_SIZE = 500
+
+# Sessions slide, every check of a session token pushes its deadline out to a full session timeout again.
+# The new deadlines are collected in memory and written in one batch by the scheduler, and each token is
+# renewed at most once per SESSION_RENEWAL_INTERVAL so a busy session doesn't turn every request into a write.
+# Breakglass sessions never slide.
+SESSION_RENEWAL_INTERVAL = int(os.environ.get('RM_SESSION_RENEWAL_INTERVAL', 60))  # seconds
+
+# token -> new deadline waiting to be written
+pending_renewals = {}
+# token -> when it was last renewed (monotonic seconds)
+last_renewals = {}
+renewals_lock = threading.Lock()
+
+# Session timeouts (minutes) from the settings table, reread after SESSION_TIMEOUT_CACHE_TTL
+SESSION_TIMEOUT_CACHE_TTL = 60  # seconds
+session_timeouts = {}
+session_timeouts_loaded_at = None
+session_timeouts_lock = threading.Lock()
+
+# Hashing and verifying passwords is deliberately expensive, so it runs on a dedicated process pool
+# rather than the Flask worker threads. Only HASH_QUEUE_DEPTH jobs may be queued or running at once,
+# anything beyond that is rejected straight away (503) instead of piling up behind a login burst.
+HASH_POOL_WORKERS = int(os.environ.get('RM_HASH_POOL_WORKERS', os.cpu_count() or 1))
+HASH_QUEUE_DEPTH = int(os.environ.get('RM_HASH_QUEUE_DEPTH', HASH_POOL_WORKERS * 4))
+
+hash_executor = None
+hash_executor_lock = threading.Lock()
+hash_slots = threading.BoundedSemaphore(HASH_QUEUE_DEPTH)
+
+# Counters exposed through get_hash_metrics(), protected by hash_metrics_lock
+hash_metrics = {
+    'in_flight': 0,
+    'completed': 0,
+    'rejected': 0,
+    'total_wait_seconds': 0.0,
+    'max_wait_seconds': 0.0,
+    'last_wait_seconds': 0.0
+}
+hash_metrics_lock = threading.Lock()
+
+# Validated tokens are cached in process so that repeat checks of the same token
+# (every dashboard refresh) don't go back to the database. Entries are evicted
+# least recently used first, and never live longer than the TTL or the token deadline.
+TOKEN_CACHE_MAX_SIZE = 1024
+TOKEN_CACHE_TTL = 30  # seconds
+
+# token -> (AuthContext, cache entry expiry)
+token_cache = OrderedDict()
+token_cache_lock = threading.Lock()
+
+# Each permission is one bit (1 << permission id) of the mask stored with a session token.
+# Bit 0 is the global admin (breakglass) permission which grants everything.
+# The masks are stored as a BIGINT so permission ids must stay below 63.
+GLOBAL_ADMIN_BIT = 1
+MAX_PERMISSION_ID = 62
+
+# permission name -> bit, loaded once at startup
+permission_bits = {}
+permission_bits_lock = threading.Lock()
+
+# Token mode, 'database' (the default) stores a random token per user in the tokens table.
+# 'signed' issues self-contained tokens (user id, deadline, permission mask) signed with a local secret,
+# checking them needs no database access apart from the revocation list which is cached here.
+DATABASE_TOKEN_MODE = 'database'
+SIGNED_TOKEN_MODE = 'signed'
+TOKEN_MODE = os.environ.get('RM_TOKEN_MODE', DATABASE_TOKEN_MODE)
+
+# Signed tokens start with this prefix so they can't be confused with database tokens
+SIGNED_TOKEN_PREFIX = 's1.'
+TOKEN_SECRET_FILE = 'token_secret.key'
+TOKEN_SECRET_BYTES = 32
+TOKEN_SECRET_MIN_BYTES = 32
+TOKEN_REVOCATION_REFRESH_INTERVAL = 30  # seconds
+
+# Global tokens are long-lived tokens for service integrations (monitoring, ticket ingest) sent in the
+# Authorization header. They act as the user who created them, limited to the permission scopes chosen
+# when they were created. Only their SHA-256 is stored.
+GLOBAL_TOKEN_PREFIX = 'g1.'
+GLOBAL_TOKEN_MAX_DAYS = 365
+
+token_secret = None
+token_secret_lock = threading.Lock()
+
+# user id -> signed tokens for that user issued before this time (epoch seconds) are revoked
+token_revocations = {}
+token_revocations_loaded_at = None
+token_revocations_lock = threading.Lock()
 
 auth_logger = logger.get_logger('auth', 'logs/auth.log')
 
+#
+# Return the argon2 parameters to hash with, the defaults unless the calibration file exists.
+# The calibration file can only raise the time and memory cost, never lower them below the defaults.
+#
+def load_argon_params() -> dict:
+    params = {
+        'time_cost': ARGON_TIME_COST,
+        'memory_cost': ARGON_MEMORY_COST,
+        'parallelism': ARGON_PARRALELISM
+    }
+
+    if os.path.exists(ARGON_PARAMS_FILE):
+        with open(ARGON_PARAMS_FILE, encoding='utf-8') as f:
+            params.update(json.load(f))
+
+    params['time_cost'] = max(params['time_cost'], ARGON_TIME_COST)
+    params['memory_cost'] = max(params['memory_cost'], ARGON_MEMORY_COST)
+
+    return params
+
+# One hasher for the whole process (each hashing pool worker builds its own when it imports auth)
+password_hasher = PasswordHasher(**load_argon_params())
+
+#
+# Return True if a stored hash should be replaced by one made with the current parameters.
+# Only upgrades, a hash made with a higher time or memory cost is never rewritten with a lower one.
+#
+def needs_rehash(hashed_pw) -> bool:
+    if not password_hasher.check_needs_rehash(hashed_pw):
+        return False
+
+    stored = extract_parameters(hashed_pw)
+    return stored.time_cost <= password_hasher.time_cost and stored.memory_cost <= password_hasher.memory_cost
+
+#
+# Raised when the password hashing queue is full, the caller should back off and try again later
+#
+class HashQueueFullError(Exception):
+    pass
+
 #
 # Takes the username and password - checks  the hash
 # returns a token
@@ -21,16 +160,38 @@ def authenticate_user(username, password) -> str:
         user_data = database.get_user_by_username(username)
         hashed_pw = user_data[3]
 
+        # don't hold a database connection while the password is verified
+        if has_request_context():
+            database.release_request_connection()
+
         # validate the password
         if validate_pw_hash(hashed_pw, password):
-            # generate a token
-            token = generate_user_token()
-            auth_logger.info('User %s authenticated successfully, token generated', username)
-
-            # save the token to the database (will automatilly set times and deadlines)
-            database.save_user_token(username, token)
-            auth_logger.info('Token for user %s saved to database', username)
-            
+            # the stored hash was made with weaker parameters, upgrade it while we have the password
+            if needs_rehash(hashed_pw):
+                rehash_user_password(user_data[0], username, password)
+
+            # work out the user's effective permissions once, checks against the token are then just bit tests
+            permission_mask = build_permission_mask(user_data[5])
+
+            if TOKEN_MODE == SIGNED_TOKEN_MODE:
+                # one session per user, the same as database tokens, so earlier tokens are revoked
+                revoke_signed_tokens(user_data[0], username)
+                token = generate_user_token(user_data[0], username, get_session_deadline(username), permission_mask)
+                auth_logger.info('User %s authenticated successfully, signed token generated', username)
+            else:
+                # generate a token
+                token = generate_user_token()
+                auth_logger.info('User %s authenticated successfully, token generated', username)
+
+                # save the token to the database (will automatilly set times and deadlines)
+                database.save_user_token(username, token, permission_mask)
+                auth_logger.info('Token for user %s saved to database', username)
+
+    # too many logins in progress, let the API return a 503 rather than a generic failure
+    except HashQueueFullError:
+        auth_logger.warning('Hashing queue full while authenticating user %s, rejecting', username)
+        raise
+
     except Exception as error:
         auth_logger.error('Error while authenticating user %s: %s', username, error)
         raise Exception(error)
@@ -38,108 +199,635 @@ def authenticate_user(username, password) -> str:
     return token
 
 #
-# Generates a random token for the user and saves it to the database
+# Replace the user's stored hash with one using the current parameters.
+# A failure here is logged but doesn't fail the login, it will be tried again next time.
+#
+def rehash_user_password(user_id, username, password) -> None:
+    try:
+        database.update_user_password(user_id, hash(password))
+        auth_logger.info('Password hash for user %s upgraded to current argon2 parameters', username)
+    except Exception as error:
+        auth_logger.warning('Unable to upgrade password hash for user %s: %s', username, error)
+
+#
+# Generates a token for the user. A random token to be saved in the database, or in signed
+# mode a token carrying the user id, deadline and permission mask that needs no database to check.
+#
+def generate_user_token(user_id=None, username=None, deadline=None, permission_mask=0) -> str:
+    if TOKEN_MODE != SIGNED_TOKEN_MODE:
+        token = secrets.token_hex(32)
+        return token
+
+    payload = {
+        'u': user_id,
+        'n': username,
+        'd': deadline.timestamp(),
+        'i': time.time(),
+        'p': permission_mask
+    }
+    encoded = base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).decode().rstrip('=')
+
+    return SIGNED_TOKEN_PREFIX + encoded + '.' + sign_token_payload(encoded)
+
+#
+# Return the session timeout in minutes for the user, breakglass sessions are much shorter
+#
+def get_session_timeout(username) -> int:
+    global session_timeouts, session_timeouts_loaded_at
+
+    with session_timeouts_lock:
+        if session_timeouts_loaded_at is None or time.monotonic() - session_timeouts_loaded_at >= SESSION_TIMEOUT_CACHE_TTL:
+            session_timeouts = {
+                'user': database.get_setting_by_name('user_session_timeout')[2],
+                'breakglass': database.get_setting_by_name('breakglass_session_timeout')[2]
+            }
+            session_timeouts_loaded_at = time.monotonic()
+
+        return session_timeouts['breakglass' if username == 'breakglass' else 'user']
+
+#
+# Return the session deadline for a token issued now
+#
+def get_session_deadline(username):
+    return datetime.datetime.now() + datetime.timedelta(minutes=get_session_timeout(username))
+
+#
+# Extend a session token's deadline after it has been used. The context (and so the token cache) sees the new
+# deadline straight away, the database gets it on the next flush_session_renewals. A token close to its deadline
+# is written straight away instead, waiting for the flush could let it expire in the database in the meantime
+# (other workers would reject it and the sweeper could delete it).
+#
+def renew_session(context) -> None:
+    # only database session tokens slide, global and signed tokens keep their deadline
+    if context.is_global or context.token.startswith(SIGNED_TOKEN_PREFIX) or context.username == 'breakglass':
+        return
+
+    now = time.monotonic()
+
+    with renewals_lock:
+        last_renewal = last_renewals.get(context.token)
+
+        if last_renewal is not None and now - last_renewal < SESSION_RENEWAL_INTERVAL:
+            return
+
+        last_renewals[context.token] = now
+
+    deadline = get_session_deadline(context.username)
+
+    if deadline > context.deadline:
+        # the deadline we know of may itself still be waiting for a flush, so allow two flush intervals
+        expires_soon = context.deadline - datetime.datetime.now() <= datetime.timedelta(seconds=2 * SESSION_RENEWAL_INTERVAL)
+        context.deadline = deadline
+
+        if expires_soon:
+            with renewals_lock:
+                pending_renewals.pop(context.token, None)
+
+            database.extend_token_deadlines([(context.token, deadline)])
+            return
+
+        with renewals_lock:
+            pending_renewals[context.token] = deadline
+
+#
+# Write all pending session renewals to the database in one statement. Run by the scheduler.
+#
+def flush_session_renewals() -> None:
+    global pending_renewals
+
+    now = time.monotonic()
+
+    with renewals_lock:
+        renewals = pending_renewals
+        pending_renewals = {}
+
+        # forget tokens that can be renewed again anyway
+        for token in [token for token, renewed in last_renewals.items() if now - renewed >= SESSION_RENEWAL_INTERVAL]:
+            del last_renewals[token]
+
+    if renewals:
+        updated = database.extend_token_deadlines(list(renewals.items()))
+        auth_logger.debug('Extended the deadline of %s session tokens', updated)
+
+#
+# Return the secret signed tokens are signed with, creating it the first time.
+# Every process running the app must share the same secret file.
+# Raises RuntimeError if the file holds a secret shorter than TOKEN_SECRET_MIN_BYTES.
+#
+def get_token_secret() -> bytes:
+    global token_secret
+
+    with token_secret_lock:
+        if token_secret is None:
+            # write the secret to a temporary file then link it into place, so other processes
+            # either find no file or a complete one, never a half written one
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(TOKEN_SECRET_FILE)))
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(secrets.token_hex(TOKEN_SECRET_BYTES))
+                    f.flush()
+                    os.fsync(f.fileno())
+
+                # only one process gets to create it, the rest read what it wrote
+                os.link(temp_path, TOKEN_SECRET_FILE)
+                auth_logger.info('Created new token signing secret %s', TOKEN_SECRET_FILE)
+            except FileExistsError:
+                pass
+            finally:
+                os.unlink(temp_path)
+
+            with open(TOKEN_SECRET_FILE, encoding='utf-8') as f:
+                secret = bytes.fromhex(f.read().strip())
+
+            if len(secret) < TOKEN_SECRET_MIN_BYTES:
+                raise RuntimeError(f'Token signing secret {TOKEN_SECRET_FILE} is shorter than {TOKEN_SECRET_MIN_BYTES} bytes, refusing to use it')
+
+            token_secret = secret
+
+    return token_secret
+
+#
+# Return the MAC for an encoded signed token payload
+#
+def sign_token_payload(encoded) -> str:
+    mac = hmac.new(get_token_secret(), encoded.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac).decode().rstrip('=')
+
+#
+# Verify a signed token with a local MAC check and the cached revocation list.
+# Returns the auth context, or None if the token is forged, malformed or revoked.
+#
+def verify_signed_token(token):
+    try:
+        encoded, mac = token[len(SIGNED_TOKEN_PREFIX):].split('.')
+    except ValueError:
+        return None
+
+    if not hmac.compare_digest(mac, sign_token_payload(encoded)):
+        auth_logger.warning('Signed token with an invalid MAC presented')
+        return None
+
+    payload = json.loads(base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4)))
+
+    # a newer login (or an explicit revocation) has replaced this token
+    if payload['i'] < get_token_revocations().get(payload['u'], 0):
+        return None
+
+    deadline = datetime.datetime.fromtimestamp(payload['d'])
+    return AuthContext(token, deadline, payload['u'], payload['n'], payload['p'])
+
+#
+# Return the cached revocation list, refreshing it from the database when it is older than the refresh interval
+#
+def get_token_revocations() -> dict:
+    global token_revocations, token_revocations_loaded_at
+
+    with token_revocations_lock:
+        if token_revocations_loaded_at is None or time.monotonic() - token_revocations_loaded_at >= TOKEN_REVOCATION_REFRESH_INTERVAL:
+            token_revocations = {user_id: revoked_before.timestamp() for user_id, revoked_before in database.get_token_revocations()}
+            token_revocations_loaded_at = time.monotonic()
+
+        return token_revocations
+
+#
+# Revoke every signed token issued to the user before now. Other processes pick this up on their next refresh.
+#
+def revoke_signed_tokens(user_id, username) -> None:
+    revoked_before = datetime.datetime.now()
+
+    # the revocation only matters until the newest token it covers has expired
+    database.revoke_user_tokens(user_id, revoked_before, get_session_deadline(username))
+
+    with token_revocations_lock:
+        token_revocations[user_id] = revoked_before.timestamp()
+
+#
+# Load the permission name to bit table from the database. Called at startup, and
+# again lazily if a permission check happens before it was loaded.
+#
+def load_permission_bits() -> None:
+    global permission_bits
+
+    bits = {}
+    for perm_id, perm_name in database.get_permissions():
+        if perm_id > MAX_PERMISSION_ID:
+            auth_logger.warning('Permission %s has id %s which does not fit in the permission mask, ignoring it', perm_name, perm_id)
+            continue
+
+        bits[perm_name] = 1 << perm_id
+
+    with permission_bits_lock:
+        permission_bits = bits
+
+    auth_logger.info('Loaded %s permissions in to the permission bit table', len(bits))
+
+#
+# Return the bit for a permission name, raise if no permission exists with that name
+#
+def get_permission_bit(perm_str) -> int:
+    if not permission_bits:
+        load_permission_bits()
+
+    bit = permission_bits.get(perm_str)
+
+    if bit is None:
+        raise Exception(f'Error while checking permission, no permission exists:  {perm_str}')
+
+    return bit
+
+#
+# Build the effective permission mask from the user's array of permission ids
+#
+def build_permission_mask(permission_ids) -> int:
+    mask = 0
+
+    for perm_id in permission_ids or []:
+        if 0 <= perm_id <= MAX_PERMISSION_ID:
+            mask |= 1 << perm_id
+
+    return mask
+
+#
+# Everything needed to authorise a request, built from a single query over the
+# tokens (or global_tokens) and users tables, or from a signed token. Permissions are the mask computed when the
+# token was issued, for global tokens the scopes it was created with.
+#
+class AuthContext:
+    def __init__(self, token, deadline, user_id, username, permission_mask, user=None, is_global=False):
+        self.token = token
+        self.deadline = deadline
+        self.user_id = user_id
+        self.username = username
+        self.permission_mask = permission_mask or 0
+        self.is_global = is_global
+        self._user = user
+
+    # all the user's fields, signed tokens don't carry them so they are loaded on first use
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = database.get_user_by_id(self.user_id)
+
+        return self._user
+
+    # global admins (permission id 0) have every permission
+    def has_permission(self, perm_str) -> bool:
+        return bool(self.permission_mask & (GLOBAL_ADMIN_BIT | get_permission_bit(perm_str)))
+
+    def is_expired(self) -> bool:
+        return self.deadline is None or self.deadline < datetime.datetime.now()
+
+#
+# Return the cached auth context for a token, or None if it isn't cached
+# or the cache entry has expired
+#
+def get_cached_token(token):
+    with token_cache_lock:
+        entry = token_cache.get(token)
+
+        if not entry:
+            return None
+
+        # expired either by the TTL or the token's own deadline, drop it
+        if entry[1] <= time.monotonic() or entry[0].is_expired():
+            del token_cache[token]
+            return None
+
+        token_cache.move_to_end(token)
+        return entry[0]
+
+#
+# Add a validated token's auth context to the cache, evicting the least recently used entries when full
+#
+def cache_token(context):
+    expires_at = time.monotonic() + TOKEN_CACHE_TTL
+
+    with token_cache_lock:
+        token_cache[context.token] = (context, expires_at)
+        token_cache.move_to_end(context.token)
+
+        while len(token_cache) > TOKEN_CACHE_MAX_SIZE:
+            token_cache.popitem(last=False)
+
+#
+# Remove any cached tokens belonging to the user, called when the user's token is replaced
+#
+def invalidate_cached_tokens(user_id):
+    with token_cache_lock:
+        stale = [token for token, entry in token_cache.items() if entry[0].user_id == user_id]
+
+        for token in stale:
+            del token_cache[token]
+
+#
+# Build the auth context for a session or global token from the database, None if the token doesn't exist
+#
+def load_auth_context(token):
+    if is_global_token(token):
+        row = database.get_global_token_context(hash_global_token(token))
+
+        if row:
+            return AuthContext(token, row[0], row[2], row[3], row[1], user=row[2:], is_global=True)
+
+        return None
+
+    row = database.get_auth_context(token)
+
+    if row:
+        return AuthContext(row[0], row[1], row[3], row[4], row[2], user=row[3:])
+
+    return None
+
+#
+# Return the auth context for the token. Looked up at most once per HTTP request (memoized on flask.g),
+# and served from the token cache across requests while the token is valid. Returns None if the token doesn't exist.
+#
+def get_auth_context(token):
+    if not token:
+        return None
+
+    # already resolved during this request
+    if has_request_context() and token in g.setdefault('auth_contexts', {}):
+        return g.auth_contexts[token]
+
+    # signed tokens are checked locally, never against the tokens table
+    if token.startswith(SIGNED_TOKEN_PREFIX):
+        context = verify_signed_token(token) if TOKEN_MODE == SIGNED_TOKEN_MODE else None
+
+    else:
+        context = get_cached_token(token)
+
+        if not context:
+            context = load_auth_context(token)
+
+            # only tokens that are still valid are worth keeping around
+            if context and not context.is_expired():
+                cache_token(context)
+
+    if has_request_context():
+        g.auth_contexts[token] = context
+
+    return context
+
+#
+# True if the token looks like a global token, it may still not exist
+#
+def is_global_token(token) -> bool:
+    return bool(token) and token.startswith(GLOBAL_TOKEN_PREFIX)
+
+#
+# Global tokens are stored hashed, so a leaked table doesn't leak usable tokens
+#
+def hash_global_token(token) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+#
+# Create a global token acting as the creator, limited to the scopes (permission names) given.
+# The creator can't grant scopes they don't have. Returns the token, which is only ever shown this once.
 #
-def generate_user_token() -> str:
-    token = secrets.token_hex(32)
+def create_global_token(creator_token, name, scopes, valid_days) -> str:
+    creator = get_auth_context(creator_token)
+
+    if not creator or creator.is_expired():
+        raise Exception('Invalid token while creating global token')
+
+    # a global token can't be used to mint more global tokens
+    if creator.is_global:
+        raise Exception('Global tokens can not create other global tokens')
+
+    if not scopes:
+        raise Exception('A global token needs at least one permission scope')
+
+    if not 0 < valid_days <= GLOBAL_TOKEN_MAX_DAYS:
+        raise Exception(f'A global token must be valid for between 1 and {GLOBAL_TOKEN_MAX_DAYS} days')
+
+    permission_mask = 0
+    for scope in scopes:
+        if not creator.has_permission(scope):
+            raise Exception(f'Permission {scope} can not be granted to a global token by this user')
+
+        permission_mask |= get_permission_bit(scope)
+
+    token = GLOBAL_TOKEN_PREFIX + secrets.token_hex(32)
+    deadline = datetime.datetime.now() + datetime.timedelta(days=valid_days)
+
+    database.add_global_token(hash_global_token(token), name, permission_mask, deadline, creator.user_id)
+    auth_logger.info('Global token %s created by %s with scopes %s', name, creator.username, scopes)
+
     return token
 
 #
-# Checks if the token is valid (in the database)
+# Revoke a global token by its id, it stops working in this process immediately and in others within the cache TTL
+#
+def revoke_global_token(token_id) -> None:
+    created_by = database.delete_global_token(token_id)
+
+    if created_by is None:
+        raise Exception('No global token found with that id')
+
+    invalidate_cached_tokens(created_by)
+    auth_logger.info('Global token %s revoked', token_id)
+
+#
+# Checks if the token is valid (in the database).
+# Global tokens are only accepted when allow_global is set, by routes that go on to require a named
+# permission scope (check_permission), everywhere else they would act as their creator unrestricted.
 #
-def check_token(username, token) -> bool:
+def check_token(username, token, allow_global=False) -> bool:
 
     # if no username or token is provided, return false
     if not username or not token:
         return False
     
-    # get the full token data out of the database and check if anything is returned
+    # get the auth context for the token (cached, or from the database) and check if anything is returned
     try:
-        token_data = database.get_token(token)
-
-        # Get user by username sent from client
-        user_data = database.get_user_by_username(username)
+        context = get_auth_context(token)
 
         # nothing returned, no token exists
-        if not token_data:
+        if not context:
+            return False
+
+        # a global token on a route that doesn't check its scopes
+        if context.is_global and not allow_global:
             return False
 
         # check if the person who created the token is the person claiming to be logged in (via cookie)
-        if not token_data[4] == user_data[0]:
+        if not context.username == username:
             return False
 
         # check if the deadline is less than the current time
-        if token_data[3] < datetime.datetime.now():
+        if context.is_expired():
             return False
-        
+
     except Exception as error:
         print(f'Error while checking token: {error}. It may not exist or is invalid. Or there was a database error retrieving it.')
         return False
 
+    # the session is in use, keep it alive. Not being able to renew it doesn't make the token invalid.
+    try:
+        renew_session(context)
+    except Exception as error:
+        auth_logger.warning('Unable to renew session for user %s: %s', username, error)
+
     return True
 
+#
+# Create the hashing process pool on first use. Workers are started by a forkserver rather than forked
+# from this process, which by then has scheduler and request threads that may be holding locks.
+#
+def get_hash_executor() -> ProcessPoolExecutor:
+    global hash_executor
+
+    with hash_executor_lock:
+        if hash_executor is None:
+            context = multiprocessing.get_context('forkserver')
+
+            # the forkserver imports auth once (argon2 and the hashing parameters) and workers are forked from it
+            context.set_forkserver_preload(['auth'])
+
+            hash_executor = ProcessPoolExecutor(max_workers=HASH_POOL_WORKERS, mp_context=context)
+            auth_logger.info('Password hashing pool started with %s workers, queue depth %s', HASH_POOL_WORKERS, HASH_QUEUE_DEPTH)
+
+    return hash_executor
+
+#
+# Throw away a hashing pool that has broken (a worker was killed, e.g. out of memory),
+# the next get_hash_executor() starts a new one
+#
+def reset_hash_executor(broken_executor) -> None:
+    global hash_executor
+
+    with hash_executor_lock:
+        # another thread may already have replaced it
+        if hash_executor is not broken_executor:
+            return
+
+        hash_executor = None
+
+    broken_executor.shutdown(wait=False, cancel_futures=True)
+    auth_logger.error('Password hashing pool broken, starting a new one')
+
+#
+# Run a hashing job on the process pool and wait for the result.
+# Raises HashQueueFullError immediately if the queue is already full.
+# If the pool has broken, it is replaced and the job retried once.
+#
+def run_hash_job(job, *args):
+    if not hash_slots.acquire(blocking=False):
+        with hash_metrics_lock:
+            hash_metrics['rejected'] += 1
+        raise HashQueueFullError('Too many password hashing requests in progress, try again later')
+
+    with hash_metrics_lock:
+        hash_metrics['in_flight'] += 1
+
+    try:
+        # the job reports when it started so we know how long it sat in the queue
+        submitted_at = time.time()
+        executor = get_hash_executor()
+
+        try:
+            result, started_at = executor.submit(job, *args).result()
+        except BrokenProcessPool:
+            reset_hash_executor(executor)
+            result, started_at = get_hash_executor().submit(job, *args).result()
+
+        wait = max(0.0, started_at - submitted_at)
+
+        with hash_metrics_lock:
+            hash_metrics['completed'] += 1
+            hash_metrics['total_wait_seconds'] += wait
+            hash_metrics['last_wait_seconds'] = wait
+            hash_metrics['max_wait_seconds'] = max(hash_metrics['max_wait_seconds'], wait)
+
+        return result
+    finally:
+        with hash_metrics_lock:
+            hash_metrics['in_flight'] -= 1
+        hash_slots.release()
+
+#
+# Return a snapshot of the hashing pool metrics
+#
+def get_hash_metrics() -> dict:
+    with hash_metrics_lock:
+        metrics = dict(hash_metrics)
+
+    # anything in flight beyond the number of workers is waiting for a worker
+    metrics['queue_length'] = max(0, metrics['in_flight'] - HASH_POOL_WORKERS)
+    metrics['queue_depth'] = HASH_QUEUE_DEPTH
+    metrics['workers'] = HASH_POOL_WORKERS
+    metrics['average_wait_seconds'] = metrics['total_wait_seconds'] / metrics['completed'] if metrics['completed'] else 0.0
+
+    return metrics
+
+#
+# Runs in the hashing pool. Returns the hash and the time the job started.
+#
+def hash_job(pw):
+    started_at = time.time()
+    return password_hasher.hash(pw), started_at
+
+#
+# Runs in the hashing pool. Returns whether the password matches and the time the job started.
+#
+def validate_pw_hash_job(hashed_pw, plaintext_pw):
+    started_at = time.time()
+    try:
+        return password_hasher.verify(hashed_pw, plaintext_pw), started_at
+    except Exception as error:
+        return False, started_at
+
+#
+# Delete expired tokens from the database in batches until none are left. Run by the scheduler.
+#
+def sweep_expired_tokens() -> int:
+    total = 0
+
+    while True:
+        deleted = database.delete_expired_tokens(TOKEN_SWEEP_BATCH_SIZE)
+        total += deleted
+
+        if deleted < TOKEN_SWEEP_BATCH_SIZE:
+            break
+
+    # revocations of signed tokens that have all expired anyway
+    total += database.delete_expired_token_revocations()
+
+    if total:
+        auth_logger.info('Token sweeper deleted %s expired tokens', total)
+
+    return total
+
 #
 # Hash a password with argon2
 #
 def hash(pw) -> str:
-    ph = PasswordHasher(time_cost=ARGON_PARRALELISM, memory_cost=ARGON_MEMORY_COST, parallelism=ARGON_PARRALELISM)
-    hashed_password = ph.hash(pw)
+    hashed_password = run_hash_job(hash_job, pw)
     return hashed_password
 
 #
 # Check paramters if they match to validate password
 #
 def validate_pw_hash(hashed_pw, plaintext_pw):
-    ph = PasswordHasher(time_cost=ARGON_PARRALELISM, memory_cost=ARGON_MEMORY_COST, parallelism=ARGON_PARRALELISM)
-    try:
-        return ph.verify(hashed_pw, plaintext_pw)
-    except Exception as error:
-        return False
+    return run_hash_job(validate_pw_hash_job, hashed_pw, plaintext_pw)
 
 #
 # Take the token and specified permissions and check the token has the permissions.
 # Return True is that's the case.
 #
 def check_permission(perm_str, token):
-    # TODO: Will need logic to determine if the token is a global token
-
-    # will need a few things, the token, the user and the permission to match everything up
+    # will need a few things, the token, the user and their permissions, all held by the auth context
     try:
-        perm_data = database.get_permission_by_name(perm_str)
-        
-        # permission not found
-        if not perm_data:
-            print(f'Error while checking permission, no permission exists:  {perm_data}')
-            raise Exception(f'Error while checking permission, no permission exists:  {perm_data}')
-        
-        # get token data
-        token_data = database.get_token(token)
+        context = get_auth_context(token)
 
         # token not found
-        if not token_data:
+        if not context:
             print(f'No token found while checking permissions: {token}')
             raise Exception(f'No token found while checking permissions')
 
-        # get the user using the id associated with the token
-        user_data = database.get_user_by_id(token_data[4])
-        
-        # user not found
-        if not user_data:
-            print(f'User not found in database while checking permssions, user id: {token[4]}')
-            raise Exception(f'User not found in database while checking permssions, user id: {token[4]}')
-        
-        # get the array of permissions from the user data
-        user_permissions = user_data[5]
-
-        # get the id of the permission we need
-        permission_id = perm_data[0]
-
-        # Does the list of user permissions contain the required permission, or is the user a global admin
-        for p_id in user_permissions:
-            if p_id is permission_id or p_id == 0:
-                return True
-            
-        return False
+        # Does the user (or global token scope) have the required permission, or is the user a global admin
+        return context.has_permission(perm_str)
 
     except Exception as error:
         print(error)
@@ -0,0 +1,81 @@
+import argparse, json, os, time
+from argon2 import PasswordHasher
+import auth
+
+#
+# Benchmarks argon2 on this host and picks parameters for a target verify latency and memory budget.
+# The result is written to the file auth.py loads its parameters from (auth.ARGON_PARAMS_FILE), existing
+# password hashes are upgraded to the new parameters as users log in.
+#
+# Usage (from the app directory):
+#   python3 calibrate_argon2.py --target-ms 500 --memory-mib 100
+#
+
+# Never go below the shipped parameters, new hashes would be weaker than the ones they replace
+MIN_MEMORY_COST = auth.ARGON_MEMORY_COST  # KiB
+MIN_TIME_COST = auth.ARGON_TIME_COST
+MAX_TIME_COST = 50
+
+SAMPLE_PASSWORD = 'calibration-sample-password-not-a-secret'
+
+#
+# Return the median time in milliseconds to verify a password with the given parameters
+#
+def measure_verify_ms(time_cost, memory_cost, parallelism, samples):
+    ph = PasswordHasher(time_cost=time_cost, memory_cost=memory_cost, parallelism=parallelism)
+    hashed = ph.hash(SAMPLE_PASSWORD)
+
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        ph.verify(hashed, SAMPLE_PASSWORD)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    return timings[len(timings) // 2]
+
+#
+# Use the whole memory budget, then raise the time cost until verifying takes at least the target.
+# If even the minimum time cost is too slow, halve the memory until it fits or reaches the minimum.
+#
+def calibrate(target_ms, memory_budget_kib, parallelism, samples):
+    memory_cost = memory_budget_kib
+
+    while True:
+        elapsed = measure_verify_ms(MIN_TIME_COST, memory_cost, parallelism, samples)
+        print(f'time_cost={MIN_TIME_COST} memory_cost={memory_cost} parallelism={parallelism}: {elapsed:.1f} ms')
+
+        if elapsed <= target_ms or memory_cost // 2 < MIN_MEMORY_COST:
+            break
+
+        memory_cost //= 2
+
+    time_cost = MIN_TIME_COST
+    while elapsed < target_ms and time_cost < MAX_TIME_COST:
+        time_cost += 1
+        elapsed = measure_verify_ms(time_cost, memory_cost, parallelism, samples)
+        print(f'time_cost={time_cost} memory_cost={memory_cost} parallelism={parallelism}: {elapsed:.1f} ms')
+
+    return {'time_cost': time_cost, 'memory_cost': memory_cost, 'parallelism': parallelism}, elapsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pick argon2 parameters for this host.')
+    parser.add_argument('--target-ms', type=float, default=500, help='target time to verify one password, in milliseconds')
+    parser.add_argument('--memory-mib', type=int, default=auth.ARGON_MEMORY_COST // 1024, help='memory budget per hash, in MiB')
+    parser.add_argument('--parallelism', type=int, default=auth.ARGON_PARRALELISM, help='argon2 lanes per hash')
+    parser.add_argument('--samples', type=int, default=5, help='verifies timed per candidate')
+    parser.add_argument('--dry-run', action='store_true', help='print the parameters without saving them')
+    args = parser.parse_args()
+
+    memory_budget_kib = max(MIN_MEMORY_COST, args.memory_mib * 1024)
+    params, elapsed = calibrate(args.target_ms, memory_budget_kib, args.parallelism, args.samples)
+
+    print(f'Selected {params}, verify takes {elapsed:.1f} ms')
+
+    if elapsed > args.target_ms:
+        print(f'This host cannot reach {args.target_ms:.0f} ms without going below the shipped parameters, using the minimum')
+
+    if not args.dry_run:
+        with open(auth.ARGON_PARAMS_FILE, 'w', encoding='utf-8') as file:
+            json.dump(params, file, indent=4)
+        print(f'Saved to {os.path.abspath(auth.ARGON_PARAMS_FILE)}, restart the app to use them')
@@ -91,6 +91,8 @@ def create_department_table(conn, cur):
 # Create a new table of teams
 #
 def create_team_table(conn, cur):
+    # membership is in team_members, users is a copy kept in step by triggers (migrations.sync_team_members)
+    # for older versions of the app still running during an upgrade. A later migration drops it.
     cur.execute('''
         CREATE TABLE IF NOT EXISTS teams (
             id SERIAL PRIMARY KEY,
@@ -101,6 +103,22 @@ def create_team_table(conn, cur):
     ''')
     conn.commit()
 
+#
+# Create a table of team memberships, one row per user in a team.
+# The primary key finds a team's members, the index finds a user's teams.
+#
+def create_team_members_table(conn, cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS team_members (
+            team_id INTEGER NOT NULL REFERENCES teams (id) ON DELETE CASCADE,
+            user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            added_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (team_id, user_id)
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS team_members_user_id_idx ON team_members (user_id, team_id)')
+    conn.commit()
+
 #
 # Create a new table of permissions with ids, names, and descriptions.
 # The ids are then added to the users table to have permissions
@@ -183,7 +201,10 @@ def create_request_type_table(conn, cur):
     conn.commit()
 
 #
-# Create a new table of tokens associated with users
+# Create a new table of tokens associated with users.
+# Every login rewrites the user's row (save_user_token upsert) and the sweeper deletes expired rows,
+# so leave free space in each page for the new row versions and vacuum more eagerly than the default.
+# The deadline index lets the sweeper find expired tokens without scanning the table.
 #
 def create_user_tokens_table(conn, cur):
     cur.execute('''
@@ -192,22 +213,58 @@ def create_user_tokens_table(conn, cur):
             token VARCHAR(256) UNIQUE NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             deadline TIMESTAMP,
-            created_by SERIAL UNIQUE NOT NULL
+            created_by SERIAL UNIQUE NOT NULL,
+            permission_mask BIGINT NOT NULL DEFAULT 0
+        ) WITH (fillfactor = 70, autovacuum_vacuum_scale_factor = 0.05)
+    ''')
+    cur.execute('''
+        CREATE INDEX IF NOT EXISTS tokens_deadline_idx ON tokens (deadline)
+    ''')
+    conn.commit()
+
+#
+# Create a table of revocations for signed (stateless) tokens. Any signed token issued to the user
+# before revoked_before is rejected. One row per user, kept until expires_at.
+#
+def create_token_revocations_table(conn, cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS token_revocations (
+            user_id INTEGER PRIMARY KEY,
+            revoked_before TIMESTAMP NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        )
+    ''')
+    conn.commit()
+
+#
+# Create a table of login throttle token buckets, shared by all app processes when enabled (see throttle.py)
+#
+def create_login_throttle_table(conn, cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS login_throttle (
+            key VARCHAR(128) PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at TIMESTAMP NOT NULL,
+            allowed BOOLEAN NOT NULL
         )
     ''')
     conn.commit()
 
 #
 # Create a table of global tokens that can be used by anyone who has the token. i.e. you don't need to authenticate
+# The token column holds the SHA-256 of the token, permission_mask the scopes it was created with (see auth.py).
+# A user can create several, one for each integration.
 #
 def create_global_tokens_table(conn, cur):
     cur.execute('''
         CREATE TABLE IF NOT EXISTS global_tokens (
             id SERIAL PRIMARY KEY,
             token VARCHAR(256) UNIQUE NOT NULL,
+            name VARCHAR(64),
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             deadline TIMESTAMP NOT NULL,
-            created_by SERIAL UNIQUE NOT NULL
+            created_by INTEGER NOT NULL,
+            permission_mask BIGINT NOT NULL DEFAULT 0
         )
     ''')
     conn.commit()
@@ -275,9 +332,12 @@ def create_database_and_tables(new_db_username, new_db_password):
     create_requests_table(conn, cur)
     create_user_tokens_table(conn, cur)
     create_global_tokens_table(conn, cur)
+    create_token_revocations_table(conn, cur)
+    create_login_throttle_table(conn, cur)
     create_settings_table(conn, cur)
     create_department_table(conn, cur)
     create_team_table(conn, cur)
+    create_team_members_table(conn, cur)
     create_request_type_table(conn, cur)
     create_request_udpates_table(conn, cur)
     create_updates_table(conn, cur)
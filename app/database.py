@@ -1,7 +1,10 @@
-import json, auth, db_util, psycopg2, logger
+import json, auth, db_util, db_pool, psycopg2, logger
 from datetime import datetime, timedelta
-from psycopg2 import pool
-import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request
+from psycopg2 import extras, sql
+import threading, time, sys, os, weakref
+import psycopg2.errors
 
 # Create a logger for the database
 db_logger = logger.get_logger('database', log_file='logs/database.log')
@@ -14,85 +17,261 @@ temp_db_password = None
 # when the pool has not connections available
 CONNECTION_WAIT_LOG_THRESHOLD = 1  # seconds
 
-POOL_MIN_SIZE = 1
-POOL_MAX_SIZE = 10
+# Pool defaults, each can be overridden in DB_POOL_CONFIG_FILE and then by an environment
+# variable. Shared settings are top level keys in the file and RM_DB_ + the upper cased
+# name in the environment (e.g. RM_DB_HOST). Settings for one pool go under "pools" -> name
+# in the file, and RM_DB_ + pool name + setting in the environment (e.g. RM_DB_AUTH_MAX_SIZE=8)
+DB_POOL_CONFIG_FILE = 'db_pool.json'
+
+# Each workload gets its own pool, so short auth lookups never queue behind list and report
+# queries. statement_timeout and work_mem are set on every connection the pool opens.
+# Pools that hold for the request keep their connection until the request ends (see
+# release_request_connection), the others give it back as soon as the function is done.
+AUTH_POOL = 'auth'
+INTERACTIVE_POOL = 'interactive'
+BULK_POOL = 'bulk'
+
+POOL_CLASSES = {
+    AUTH_POOL: {'min_size': 2, 'max_size': 4, 'statement_timeout': '2s', 'work_mem': '4MB', 'hold_for_request': False},
+    INTERACTIVE_POOL: {'min_size': 1, 'max_size': 10, 'statement_timeout': '15s', 'work_mem': '4MB', 'hold_for_request': True},
+    BULK_POOL: {'min_size': 0, 'max_size': 3, 'statement_timeout': '2min', 'work_mem': '64MB', 'hold_for_request': False}
+}
+
+# Used by functions that don't ask for a pool
+DEFAULT_POOL = INTERACTIVE_POOL
+
+# Most rows a list function returns at once, lists are paged with keyset cursors (see app.py)
+PAGE_MAX_LIMIT = 200
+
+# The columns of a request and an update, in table order, as the API returns them. Spelled out rather 
+# than SELECT * so the full text search columns (search_vector) stay in the database.
+REQUEST_COLUMNS = ('id, requester, requested_at, priority, outage, title, description, team_category, '
+    'assigned_to_team, assigned_to_user, escalation_level, type, resolved, resolved_at')
+UPDATE_COLUMNS = 'id, created_at, made_by, request_id, content, customer_visible'
+
+# Text search configuration for the search_vector columns and queries (see migrations.py)
+SEARCH_LANGUAGE = 'english'
+
+# How long to wait for a connection when they are all in use before giving up
+POOL_CHECKOUT_TIMEOUT = 10  # seconds
+
+# Connections are replaced after this long or this many checkouts, so server side memory
+# doesn't build up and connections move over after a failover
+POOL_MAX_AGE = 3600  # seconds
+POOL_MAX_USES = 10000
+
+# Connections idle for longer than this are checked with SELECT 1 before being handed out
+POOL_VALIDATE_AFTER = 1  # seconds
+
+# Connections above a pool's min_size idle for longer than this are closed by the pool maintenance
+POOL_MAX_IDLE = 600  # seconds
+
+# Give up connecting to the server after this long
+CONNECT_TIMEOUT = 5  # seconds
+
+# How often the idle connections are checked and the pools topped back up to their minimum size
+POOL_MAINTENANCE_INTERVAL = 30  # seconds
+
+# How often the pool metrics are summarised in the log
+POOL_METRICS_LOG_INTERVAL = 300  # seconds
 
 DB_CONFIGURATION = {
     'dbname': 'requestmanager',
     'user': '',
     'password': '',
     'host': 'localhost',
-    'port': '5432'
+    'port': '5432',
+    'connect_timeout': CONNECT_TIMEOUT
 }
 
-# Create the pool
-connection_pool = None
+# The pools, and the settings they were created with, by name
+connection_pools = {}
+connection_pool_settings = {}
+connection_pool_lock = threading.Lock()
 
-def establish_pool() -> None:
-    ''' Read credentials and add them to the db 
-        connection hashmap configuration.
-        Initialise the connection pool which is global. 
+# Per thread state for pooled_connection() and transaction(), the connections of pools that
+# don't hold for the request (or all of them when not handling a Flask request), and the 
+# transaction in progress
+thread_connections = threading.local()
+
+def setting_from_env(name, default, setting_type=None):
+    ''' Return the environment variable converted to the setting's type,
+        or the default if it isn't set.
+
+    Args:
+        name: environment variable name
+        default: value to use when it isn't set
+        setting_type: type to convert to, the type of the default if None.
+            'none' (or 'null') gives None, to turn off a limit such as max_age
 
     Returns:
-        None
+        the setting
     '''
 
-    # read the credentials from the creds files and add them to the hashmap
-    creds = db_util.read_credentials()
+    value = os.environ.get(name)
+
+    if value is None:
+        return default
+
+    if value.lower() in ('none', 'null'):
+        return None
+
+    setting_type = setting_type or type(default)
 
-    DB_CONFIGURATION['user'] = creds['username']
-    DB_CONFIGURATION['password'] = creds['password']
+    if setting_type is bool:
+        return value.lower() in ('1', 'true', 'yes')
+
+    if setting_type is type(None):
+        return value
 
     try:
-        # Initialise the connection pool
-        global connection_pool
+        return setting_type(value)
+    except ValueError:
+        raise ValueError(f'{name} must be a {setting_type.__name__}, not {value!r}')
 
-        connection_pool = pool.ThreadedConnectionPool(
-            minconn=POOL_MIN_SIZE, 
-            maxconn=POOL_MAX_SIZE,
-            **DB_CONFIGURATION # ** unmaps the hashmap
-        )
+def load_pool_settings(pool=DEFAULT_POOL) -> dict:
+    ''' Return the settings for a pool. Each setting is, from lowest to highest precedence, 
+        the default above (or the pool class's, in POOL_CLASSES), the top level of
+        DB_POOL_CONFIG_FILE (if it exists), RM_DB_<SETTING>, the pool's section of the
+        file ("pools": {"<pool>": {...}}) and RM_DB_<POOL>_<SETTING>.
 
-        db_logger.info('Connection pool established successfully.')
-    except psycopg2.Error as e:
-        db_logger.critical('Failed to establish connection pool: %s', e)
-        raise psycopg2.Error(f'Failed to establish connection pool: {e}')
+    Args:
+        pool: name of the pool, one of POOL_CLASSES
 
-def get_conn() -> object:
+    Returns:
+        dict: server (host, port, dbname), pool sizing and session settings
+    '''
+
+    defaults = {
+        'host': DB_CONFIGURATION['host'],
+        'port': DB_CONFIGURATION['port'],
+        'dbname': DB_CONFIGURATION['dbname'],
+        'connect_timeout': CONNECT_TIMEOUT,
+        'checkout_timeout': POOL_CHECKOUT_TIMEOUT,
+        'max_age': POOL_MAX_AGE,
+        'max_uses': POOL_MAX_USES,
+        'validate_after': POOL_VALIDATE_AFTER,
+        'max_idle': POOL_MAX_IDLE
+    }
+    defaults.update(POOL_CLASSES[pool])
+
+    file_settings = {}
+    if os.path.exists(DB_POOL_CONFIG_FILE):
+        with open(DB_POOL_CONFIG_FILE, encoding='utf-8') as f:
+            file_settings = json.load(f)
+
+    pool_file_settings = file_settings.get('pools', {}).get(pool, {})
+
+    settings = {}
+    for name, default in defaults.items():
+        # env values are converted to the type of the built in default, even when the file set None
+        value = setting_from_env(f'RM_DB_{name.upper()}', file_settings.get(name, default), type(default))
+        value = pool_file_settings.get(name, value)
+        settings[name] = setting_from_env(f'RM_DB_{pool.upper()}_{name.upper()}', value, type(default))
+
+    if settings['min_size'] > settings['max_size']:
+        raise ValueError(f'{pool} pool min_size ({settings["min_size"]}) is larger than max_size ({settings["max_size"]})')
+
+    return settings
+
+def establish_pool(pool=None) -> None:
+    ''' Read credentials and add them to the db 
+        connection hashmap configuration.
+        Initialise the connection pool(s) which are global. 
+        Safe to call from several threads, each pool is only ever created once.
+
+    Args:
+        pool: name of the pool to create, all of them if None
+
+    Returns:
+        None
+    '''
+
+    with connection_pool_lock:
+        for name in ([pool] if pool else POOL_CLASSES):
+            # another thread got here first
+            if name in connection_pools:
+                continue
+
+            settings = load_pool_settings(name)
+
+            # read the credentials from the creds files and add them to the hashmap
+            creds = db_util.read_credentials()
+
+            DB_CONFIGURATION['user'] = creds['username']
+            DB_CONFIGURATION['password'] = creds['password']
+
+            for setting in ('host', 'port', 'dbname', 'connect_timeout'):
+                DB_CONFIGURATION[setting] = settings[setting]
+
+            # session settings for every connection of this pool
+            options = f'-c statement_timeout={settings["statement_timeout"]} -c work_mem={settings["work_mem"]}'
+
+            try:
+                # Initialise the connection pool, this opens min_size connections straight away
+                connection_pools[name] = db_pool.BlockingConnectionPool(
+                    minconn=int(settings['min_size']), 
+                    maxconn=int(settings['max_size']),
+                    timeout=settings['checkout_timeout'],
+                    max_age=settings['max_age'],
+                    max_uses=settings['max_uses'],
+                    validate_after=settings['validate_after'],
+                    max_idle=settings['max_idle'],
+                    options=options,
+                    **DB_CONFIGURATION # ** unmaps the hashmap
+                )
+
+                connection_pool_settings[name] = settings
+
+                db_logger.info('Connection pool %s established successfully, %s to %s connections to %s:%s (%s).',
+                    name, int(settings['min_size']), int(settings['max_size']), settings['host'], settings['port'], options)
+            except psycopg2.Error as e:
+                db_logger.critical('Failed to establish connection pool %s: %s', name, e)
+                raise psycopg2.Error(f'Failed to establish connection pool {name}: {e}')
+
+def get_conn(label=None, pool=DEFAULT_POOL) -> object:
     ''' Return a connection from the pool. 
-        If connection pool is not initalise, raise exception
+        Waits (in turn with other callers) for up to POOL_CHECKOUT_TIMEOUT 
+        seconds if every connection is in use.
+
+    Args:
+        label: who the connection is for (function and route), for the pool metrics
+        pool: name of the pool to take it from
 
     Returns:
         Connection: connecion to database
 
     Raises:
-        Exception: When the connection pool is not initialised
+        PoolTimeoutError: When no connection became available in time
     '''
 
     # No pool available yet, establish the pool
-    if connection_pool is None:
-        establish_pool()
+    if pool not in connection_pools:
+        establish_pool(pool)
 
     # start timer and get a connection from the pool
-    start_time = datetime.now()
-    conn = connection_pool.getconn()
-    end_time = datetime.now()
+    start_time = time.monotonic()
 
-    elapsed_time = (end_time.timestamp() - start_time.timestamp())
+    try:
+        conn = connection_pools[pool].getconn(label=label)
+    finally:
+        elapsed_time = time.monotonic() - start_time
 
-    # if the wait time for a connection exceeds the threshold, log it
-    if elapsed_time >= CONNECTION_WAIT_LOG_THRESHOLD:
-        db_logger.error('Connection wait time exceeded threshold of %s, '
-            'time taken: %s seconds', CONNECTION_WAIT_LOG_THRESHOLD, elapsed_time)
+        # if the wait time for a connection exceeds the threshold, log it
+        if elapsed_time >= CONNECTION_WAIT_LOG_THRESHOLD:
+            db_logger.error('Connection wait time for the %s pool exceeded threshold of %s, '
+                'time taken: %s seconds', pool, CONNECTION_WAIT_LOG_THRESHOLD, elapsed_time)
 
     return conn 
 
-def put_conn(connection) -> None:
+def put_conn(connection, close=False, pool=DEFAULT_POOL) -> None:
     ''' Put a connection back in to the pool. 
         If connection pool is not initalise, raise exception
 
     Args:
         connection: The connectino object to put back in to the pool
+        close: Close the connection instead of keeping it for reuse
+        pool: name of the pool it came from
 
     Returns:
         None
@@ -102,18 +281,23 @@ def put_conn(connection) -> None:
     '''
 
     # No pool, wtf?
-    if not connection_pool:
+    if pool not in connection_pools:
         db_logger.critical('Unable to put connection back in to pool,' \
-            ' connection_pool not initialised.')
+            ' connection pool %s not initialised.', pool)
         # TODO: Change to more specific Exception type
         raise Exception('Unable to put connection back in to pool, ' \
-            'connection_pool not initialised.')
+            f'connection pool {pool} not initialised.')
  
-    connection_pool.putconn(connection)
+    connection_pools[pool].putconn(connection, close=close)
 
-def connect() -> object:
+def connect(label=None, pool=DEFAULT_POOL) -> object:
     ''' Return a connection from the pool. 
-        If connection pool is not initalised, initialise it
+        If connection pool is not initalised, initialise it.
+        Prefer pooled_connection(), which always gives the connection back.
+
+    Args:
+        label: who the connection is for (function and route), for the pool metrics
+        pool: name of the pool to take it from
 
     Returns:
         Connection: connecion to database
@@ -121,31 +305,313 @@ def connect() -> object:
     Raises:
         Exception: When the connection fails
     '''
-    if not connection_pool:
-        establish_pool()
+    if pool not in connection_pools:
+        establish_pool(pool)
 
     try:
-        conn = get_conn()
+        conn = get_conn(label, pool)
         return conn
     except Exception as e:
         db_logger.critical('Unable to retrieve a connection from ' \
             'the connection pool: %s', e)
         raise Exception(e)
 
-def disconnect(connection) -> None:
+def disconnect(connection, pool=DEFAULT_POOL) -> None:
     ''' Close the connection to the database and put it back in the pool
     Args:
         connection: The connection object to close and put back in the pool
+        pool: name of the pool it came from
     Returns:
         None
     '''
 
     if connection:
-        put_conn(connection)
+        put_conn(connection, pool=pool)
     elif not connection or connection.closed:
         db_logger.warning('Connection is already closed or not ' \
             'valid, nothing to disconnect.')
 
+def get_pool_metrics() -> dict:
+    ''' Return the metrics of each connection pool, connections in use and idle,
+        checkout wait and hold time histograms, timeouts, and connections
+        created and discarded. Pools that haven't been created yet are left out.
+
+    Returns:
+        dict: pool name -> the metrics
+    '''
+
+    return {name: connection_pool.metrics() for name, connection_pool in list(connection_pools.items())}
+
+def maintain_pool() -> None:
+    ''' Check the idle connections and top the pools back up to their minimum size,
+        so requests after a database restart don't pay to reconnect. Run by the scheduler.
+    '''
+
+    for name, connection_pool in list(connection_pools.items()):
+        try:
+            connection_pool.maintain()
+        except psycopg2.Error as e:
+            db_logger.error('Unable to top up the %s connection pool: %s', name, e)
+
+def log_pool_summary() -> None:
+    ''' Log a one line summary of each pool's metrics. Run by the scheduler. '''
+
+    for name, metrics in get_pool_metrics().items():
+        db_logger.info('Connection pool %s: %s/%s in use, %s idle, %s waiting, %s timeouts, %s created, %s discarded, '
+            '%s recycled, %s failed checks, average wait %.4fs, max wait %.4fs', name, metrics['in_use'], metrics['max_size'],
+            metrics['idle'], metrics['waiting'], metrics['timeouts'], metrics['created'], metrics['discarded'],
+            metrics['recycled'], metrics['failed_checks'], metrics['wait_time']['average_seconds'],
+            metrics['wait_time']['max_seconds'])
+
+def current_scope(pool=DEFAULT_POOL) -> object:
+    ''' Return where the current connection of a pool is kept. During a Flask request 
+        it is the request (flask.g) for pools that hold for the request, so every 
+        database call in the request shares one connection. Anywhere else 
+        (background jobs, scripts, short lived pools) it is the thread.
+
+    Args:
+        pool: name of the pool
+
+    Returns:
+        object: flask.g or the thread local state
+    '''
+
+    if pool not in connection_pools:
+        establish_pool(pool)
+
+    if has_request_context() and connection_pool_settings[pool]['hold_for_request']:
+        return g
+
+    return thread_connections
+
+def connection_label() -> str:
+    ''' Return what a new connection is being checked out for, the database function
+        that asked for it, followed by the route during a Flask request.
+
+    Returns:
+        str: label for the pool hold time metrics, e.g. get_user@request:get_user_self
+    '''
+
+    # skip over the connection plumbing to the function that wants the connection
+    frame = sys._getframe(1)
+    while frame and frame.f_code.co_name in ('pooled_connection', 'transaction', '__enter__'):
+        frame = frame.f_back
+
+    label = frame.f_code.co_name if frame else 'unknown'
+
+    if has_request_context():
+        return f'{label}@request:{request.endpoint}'
+
+    return label
+
+def in_transaction() -> bool:
+    ''' Return True if the current thread is inside a transaction() block. '''
+    return getattr(thread_connections, 'db_transaction_depth', 0) > 0
+
+@contextmanager
+def pooled_connection(pool=DEFAULT_POOL):
+    ''' Check a connection out of a pool for the duration of a with block.
+        The connection always goes back to the pool, whatever happens in the block.
+        Anything not committed when the block raises is rolled back.
+        The first block in a Flask request checks out a connection that the rest
+        of the request reuses (for pools that hold for the request), it goes back 
+        to the pool in teardown_request (see release_request_connection). 
+        Otherwise nested blocks on the same thread share the outer block's connection.
+        Inside transaction() every block uses the transaction's connection, whatever 
+        pool it asks for.
+
+    Args:
+        pool: name of the pool, one of POOL_CLASSES
+
+    Yields:
+        Connection: connecion to database
+    '''
+
+    if in_transaction():
+        pool = thread_connections.db_transaction_pool
+
+    scope = current_scope(pool)
+
+    if getattr(scope, 'db_connections', None) is None:
+        scope.db_connections = {}
+
+    connection = scope.db_connections.get(pool)
+
+    # already holding one, the request or the outermost block is responsible for it
+    if connection is not None and not connection.closed:
+        try:
+            yield connection
+        except Exception:
+            # each function commits its own work, this only clears the failed statement.
+            # inside a transaction it is up to transaction() to roll back
+            if not in_transaction() and not connection.closed:
+                connection.rollback()
+            raise
+        return
+
+    # the held connection broke, swap it for a new one
+    if connection is not None:
+        del scope.db_connections[pool]
+        put_conn(connection, close=True, pool=pool)
+
+    connection = connect(connection_label(), pool)
+    scope.db_connections[pool] = connection
+
+    # request connections outlive this block
+    if scope is g:
+        try:
+            yield connection
+        except Exception:
+            if not in_transaction() and not connection.closed:
+                connection.rollback()
+            raise
+        return
+
+    try:
+        yield connection
+    except Exception:
+        if not connection.closed:
+            connection.rollback()
+        raise
+    finally:
+        scope.db_connections.pop(pool, None)
+
+        # a broken connection is no use to anyone else
+        put_conn(connection, close=bool(connection.closed), pool=pool)
+
+def release_request_connection(error=None) -> None:
+    ''' Put the connections held by the current Flask request back in their pools.
+        Registered as a teardown_request handler, and can be called mid request
+        before slow work that doesn't need the database (e.g. password hashing).
+        The next database call in the request checks out a connection again.
+
+    Args:
+        error: the exception that ended the request, if any
+    '''
+
+    connections = g.pop('db_connections', None) or {}
+
+    for pool, connection in connections.items():
+        try:
+            if not connection.closed and (error or connection.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                connection.rollback()
+        finally:
+            put_conn(connection, close=bool(connection.closed), pool=pool)
+
+@contextmanager
+def transaction(pool=DEFAULT_POOL):
+    ''' Run several database calls as one transaction. Commits made by the
+        database functions called inside the block are held back, everything
+        is committed together when the block finishes, or rolled back if it raises.
+        Blocks can be nested, only the outermost one commits.
+
+    Args:
+        pool: name of the pool the transaction runs on, nested blocks use the same connection
+
+    Yields:
+        Connection: connecion to database
+    '''
+
+    with pooled_connection(pool) as connection:
+        if not in_transaction():
+            thread_connections.db_transaction_pool = pool
+
+        thread_connections.db_transaction_depth = getattr(thread_connections, 'db_transaction_depth', 0) + 1
+
+        try:
+            yield connection
+        except Exception:
+            thread_connections.db_transaction_depth -= 1
+            if thread_connections.db_transaction_depth == 0 and not connection.closed:
+                connection.rollback()
+            raise
+
+        thread_connections.db_transaction_depth -= 1
+        if thread_connections.db_transaction_depth == 0:
+            connection.commit()
+
+def commit(connection) -> None:
+    ''' Commit the connection, unless inside transaction() which commits at the end. '''
+    if not in_transaction():
+        connection.commit()
+
+# The hot queries, prepared (parsed and planned) once per connection and executed by name 
+# with execute_prepared() from then on. Parameters are $1, $2... as in PREPARE
+PREPARED_STATEMENTS = {
+    'get_token': 'SELECT * FROM tokens WHERE token = $1',
+    'get_auth_context': '''
+        SELECT t.token, t.deadline, t.permission_mask, u.*
+        FROM tokens t
+        INNER JOIN users u ON u.id = t.created_by
+        WHERE t.token = $1
+    ''',
+    'get_user_by_username': 'SELECT * FROM users WHERE username = $1',
+    'get_user_by_id': 'SELECT * FROM users WHERE id = $1',
+    'get_permission_by_name': 'SELECT * FROM permissions WHERE permission_name = $1',
+    'get_setting_by_name': 'SELECT * FROM app_settings WHERE setting_name = $1',
+    'get_request_detail': '''
+        SELECT r.id, r.requester, r.requested_at, r.priority, r.outage, r.title, r.description,
+            COALESCE(d.name, '') AS department, COALESCE(t.name, '') AS team,
+            COALESCE(u.username, '') AS assignee, r.escalation_level, COALESCE(rt.name, '') AS type,
+            r.resolved, r.resolved_at
+        FROM requests r
+        LEFT JOIN request_types rt ON rt.id = r.type
+        LEFT JOIN departments d ON d.id = r.team_category
+        LEFT JOIN teams t ON t.id = r.assigned_to_team
+        LEFT JOIN users u ON u.id = r.assigned_to_user
+        WHERE r.id = $1
+    '''
+}
+
+# connection -> names of the statements prepared on it. A reconnected connection is a new 
+# object that isn't in here, so its statements get prepared again
+prepared_connections = weakref.WeakKeyDictionary()
+prepared_connections_lock = threading.Lock()
+
+def execute_prepared(cursor, name, params=()) -> None:
+    ''' Execute one of the PREPARED_STATEMENTS on the cursor, preparing it on the 
+        cursor's connection first if it hasn't been already.
+        If the server has lost the statement (e.g. the session was reset) or its plan 
+        no longer fits the table (e.g. a column was added by a migration), the
+        connection's statements are dropped and prepared again, then the statement 
+        is retried once, unless inside a transaction() which has to be rolled back instead.
+
+    Args:
+        cursor: cursor to execute on
+        name: name of the statement in PREPARED_STATEMENTS
+        params: the statement's parameters in order
+
+    Returns:
+        None, fetch the results from the cursor
+    '''
+
+    placeholders = ', '.join(['%s'] * len(params))
+    execute = f'EXECUTE {name} ({placeholders})' if params else f'EXECUTE {name}'
+
+    for attempt in range(2):
+        connection = cursor.connection
+
+        with prepared_connections_lock:
+            prepared = prepared_connections.setdefault(connection, set())
+
+        try:
+            if name not in prepared:
+                cursor.execute(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}')
+                prepared.add(name)
+
+            cursor.execute(execute, params)
+            return
+        except (psycopg2.errors.InvalidSqlStatementName, psycopg2.errors.DuplicatePreparedStatement,
+                psycopg2.errors.FeatureNotSupported) as error:
+            if attempt or in_transaction():
+                raise
+
+            db_logger.warning('Preparing statements again after %s: %s', type(error).__name__, error)
+
+            # start again from a clean session, prepared statements aren't transactional
+            connection.rollback()
+            cursor.execute('DEALLOCATE ALL')
+            prepared.clear()
 
 #
 # Make sure the database credentials are valid
@@ -186,30 +652,31 @@ def test_connection(db_username, db_password):
 ######################################
 
 #
-# Get all users from the database
+# Get a page of users from the database, in id order.
+# after is the id of the last user on the previous page, None for the first page.
 #
-def get_all_users():
+def get_all_users(limit=PAGE_MAX_LIMIT, after=None):
     # TODO: Remove exception handling internally, raise the exceptions
 
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query
-        cursor.execute('SELECT id, username, email, created_at, permissions, level, end_user, firstname, lastname FROM users')
+        with pooled_connection(BULK_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query, the primary key index gives the order and the starting point
+            query = """
+            SELECT id, username, email, created_at, permissions, level, end_user, firstname, lastname FROM users
+            WHERE (%(after)s::integer IS NULL OR id > %(after)s)
+            ORDER BY id
+            LIMIT %(limit)s
+            """
+            cursor.execute(query, {'after': after, 'limit': limit})
 
-        # Retrieve query results
-        users = cursor.fetchall()
+            # Retrieve query results
+            users = cursor.fetchall()
 
-        return users
+            return users
 
     except Exception as error:
         print(f'Error fetching users: {error}')
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
 # Return all fields for a user by the username
@@ -217,27 +684,20 @@ def get_all_users():
 def get_user_by_username(username):
     try:
         # Connect to the db
-        connection = connect()
-        cursor = connection.cursor()
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to get the user by username
+            execute_prepared(cursor, 'get_user_by_username', (username,))
 
-        # Execute a query to get the user by username
-        query = 'SELECT * FROM users WHERE username = %s'
-        cursor.execute(query, (username,))
-
-        # Retrieve query results
-        user = cursor.fetchone()
+            # Retrieve query results
+            user = cursor.fetchone()
 
-        if user:
-            return user
-        else:
-            raise Exception('No user found when getting user by username from database')
+            if user:
+                return user
+            else:
+                raise Exception('No user found when getting user by username from database')
             
     except Exception as error:
         raise Exception(f'Failed to get user by username: {error}')
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
 # Return the user data searching by email
@@ -245,27 +705,21 @@ def get_user_by_username(username):
 def get_user_by_email(email):
     try:
         # Connect to the db
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to get the user by email
-        query = "SELECT * FROM users WHERE email = %s"
-        cursor.execute(query, (email,))
-
-        # Retrieve query results
-        user = cursor.fetchone()
-
-        if user:
-            return user
-        else:
-            raise Exception("No user found when getting user by email from database")
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get the user by email
+            query = "SELECT * FROM users WHERE email = %s"
+            cursor.execute(query, (email,))
+
+            # Retrieve query results
+            user = cursor.fetchone()
+
+            if user:
+                return user
+            else:
+                raise Exception("No user found when getting user by email from database")
             
     except Exception as error:
         raise Exception(f'Failed to get user by email: {error}')
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
 # Return user data, using id
@@ -273,65 +727,48 @@ def get_user_by_email(email):
 def get_user_by_id(id):
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to get the user by id
-        query = "SELECT * FROM users WHERE id = %s"
-        cursor.execute(query, (id,))
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to get the user by id
+            execute_prepared(cursor, 'get_user_by_id', (id,))
 
-        # Retrieve query results
-        user = cursor.fetchone()
+            # Retrieve query results
+            user = cursor.fetchone()
 
-        if user:
-            return user
-        else:
-            raise Exception("No user found when getting user by id from database")
+            if user:
+                return user
+            else:
+                raise Exception("No user found when getting user by id from database")
 
     except Exception as error:
         print(f"Error fetching user by id: {error}")
         return None
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
-# Return user data by token
+# Return user data by token. Reuses the auth context already resolved for the token during this request.
 #
 def get_user_by_token(token):
     try:
-        # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to get the user by token
-        query = '''
-        SELECT u.*
-        FROM users u
-        INNER JOIN tokens t ON u.id = t.created_by
-        WHERE t.token = %s
-        '''
-        cursor.execute(query, (token,))
-
-        # Retrieve query results
-        user = cursor.fetchone()
+        context = auth.get_auth_context(token)
 
-        if user:
-            return user
+        if context:
+            return context.user
         else:
             raise Exception('No user found when getting user by token from database')
 
     except Exception as error:
         print(f'Error fetching user by token: {error}')
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
-# Add a new user to the database
+# Raised by add_user when the username or email is already taken
+#
+class UserExistsError(Exception):
+    pass
+
+#
+# Add a new user to the database, with their team memberships, in one statement.
+# Teams that don't exist are skipped. Returns the new user's id.
+# Raises UserExistsError if the username or email is already in use.
 #
 def add_user(username, email, password, permissions, teams, level, end_user, firstname, lastname):
     # input validation
@@ -339,45 +776,77 @@ def add_user(username, email, password, permissions, teams, level, end_user, fir
         raise Exception('Username, email, password, firstname or lastname too long')
     
     # map to integers, database columns are integer arrays, json format from client will be lists of strings
-    teams = list(map(int, teams))
+    teams = list(map(int, teams or []))
     permissions = list(map(int, permissions))
 
     try:
         # Connect to the database
-        connection = connect()
-        cursor = connection.cursor()
-        
-        # Execute a query to insert a new user
-        insert_query = '''
-        INSERT INTO users (username, email, password, created_at, permissions, level, end_user, firstname, lastname)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-        '''
-        cursor.execute(insert_query, (username, email, password, datetime.now(), permissions, level, end_user, firstname, lastname))
-        
-        # Commit the transaction
-        connection.commit()
-        
-        # Get the user id of the newly created user
-        cursor.execute('SELECT id FROM users WHERE username = %s', (username,))
-        user_id = cursor.fetchone()
-        if not user_id:
-            raise Exception('Failed to get user id after adding user to database')
-        user_id = user_id[0]
-
-        # Add the user to each team
-        for teamId in teams:
-            add_user_to_team(user_id, teamId)
-
-        connection.commit()
-        
-        return True
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Insert the user and their memberships together, nothing is written if the username or email is taken
+            insert_query = '''
+            WITH new_user AS (
+                INSERT INTO users (username, email, password, created_at, permissions, level, end_user, firstname, lastname)
+                VALUES (%(username)s, %(email)s, %(password)s, %(created_at)s, %(permissions)s, %(level)s, %(end_user)s, %(firstname)s, %(lastname)s)
+                ON CONFLICT DO NOTHING
+                RETURNING id
+            ), memberships AS (
+                INSERT INTO team_members (team_id, user_id)
+                SELECT DISTINCT t.id, new_user.id
+                FROM new_user
+                CROSS JOIN unnest(%(teams)s::integer[]) AS team (team_id)
+                INNER JOIN teams t ON t.id = team.team_id
+            )
+            SELECT id FROM new_user
+            '''
+            cursor.execute(insert_query, {
+                'username': username, 'email': email, 'password': password, 'created_at': datetime.now(),
+                'permissions': permissions, 'level': level, 'end_user': end_user, 'firstname': firstname,
+                'lastname': lastname, 'teams': teams
+            })
+            user_id = cursor.fetchone()
+
+            # Commit the transaction
+            commit(connection)
+
+            if user_id:
+                return user_id[0]
+
+            # only on a conflict, work out which one for the error message
+            cursor.execute('SELECT username = %s FROM users WHERE username = %s OR email = %s LIMIT 1', (username, username, email))
+            taken = cursor.fetchone()
+
+            if taken and taken[0]:
+                raise UserExistsError('User already exists')
+
+            raise UserExistsError('Email already in use')
+
+    except UserExistsError:
+        raise
     except Exception as error:
         print(f'Error adding user to database: {error}')
         raise Exception(f'Error adding user in to database: {error}')
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
+
+#
+# Replace the stored password hash for a user
+#
+def update_user_password(user_id, hashed_password):
+    try:
+        # Connect to the database
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to update the password
+            update_query = '''
+            UPDATE users
+            SET password = %s
+            WHERE id = %s
+            '''
+            cursor.execute(update_query, (hashed_password, user_id))
+
+            # Commit the transaction
+            commit(connection)
+
+    except Exception as error:
+        print(f'Error updating user password: {error}')
+        raise Exception(f'Error updating user password in database: {error}')
 
 # 
 # Add the user id to the array of users in the teams table
@@ -385,27 +854,21 @@ def add_user(username, email, password, permissions, teams, level, end_user, fir
 def add_user_to_team(userId, teamId):
     try:
         # Connect to the database
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to add the user to the team
-        update_query = '''
-        UPDATE teams
-        SET users = array_append(users, %s)
-        WHERE id = %s
-        '''
-        cursor.execute(update_query, (userId, teamId))
-
-        # Commit the transaction
-        connection.commit()
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to add the user to the team, one row per membership so the team row isn't touched
+            insert_query = '''
+            INSERT INTO team_members (user_id, team_id)
+            VALUES (%s, %s)
+            ON CONFLICT DO NOTHING
+            '''
+            cursor.execute(insert_query, (userId, teamId))
+
+            # Commit the transaction
+            commit(connection)
 
     except Exception as error:
         print(f'Error adding user to database: {error}')
         raise Exception(f'Error adding user in to database: {error}')
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
 # Check if the breakglass account has been set in the settings table. To help prevent re-creation via the API.
@@ -418,26 +881,20 @@ def check_breakglass_account_is_set():
 
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query
-        cursor.execute('SELECT * FROM app_settings WHERE setting_name=\'breakglass_set\'')
-
-        # Check if the value column is 1
-        breakglass_account = cursor.fetchone()
-        if breakglass_account and breakglass_account[2] == 1:
-            return True
-        else:
-            return False
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query
+            cursor.execute('SELECT * FROM app_settings WHERE setting_name=\'breakglass_set\'')
+
+            # Check if the value column is 1
+            breakglass_account = cursor.fetchone()
+            if breakglass_account and breakglass_account[2] == 1:
+                return True
+            else:
+                return False
         
     except Exception as error:
         print(f'Error fetching breakglass account: {error}')
         return False
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
 # Create the breakglass account in the database
@@ -446,41 +903,37 @@ def create_breakglass_account(password):
     # TODO: Remove exception handling internally, raise the exceptions
 
     try:
-        # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to insert a new user
-        insert_query = '''
-        INSERT INTO users (username, email, password, permissions, level)
-        VALUES (%s, %s, %s, %s, %s)
-        '''
-
-        # Hash the password and create the entry in the database
+        # Hash the password first, no need to hold a connection while that runs
         hash = auth.hash(password)
-        cursor.execute(insert_query, ('breakglass', 'breakglass@breakglass.com', hash, '{0}', 0))
-        connection.commit()
-
-        # Update the settings table to set breakglass_set to 1
-        update_query = '''
-        UPDATE app_settings
-        SET value = 1
-        WHERE setting_name = 'breakglass_set'
-        '''
-        cursor.execute(update_query)
 
-        # Commit the transaction
-        connection.commit()
-
-    # print the error first before sending it to the calling function, which will likely be an api call to send the
-    # error back to the user interface
+        # Connect to your postgres DB, the account and the breakglass_set setting are committed together
+        with transaction() as connection, connection.cursor() as cursor:
+            # Execute a query to insert a new user
+            insert_query = '''
+            INSERT INTO users (username, email, password, permissions, level)
+            VALUES (%s, %s, %s, %s, %s)
+            '''
+
+            # Create the entry in the database
+            cursor.execute(insert_query, ('breakglass', 'breakglass@breakglass.com', hash, '{0}', 0))
+            commit(connection)
+
+            # Update the settings table to set breakglass_set to 1
+            update_query = '''
+            UPDATE app_settings
+            SET value = 1
+            WHERE setting_name = 'breakglass_set'
+            '''
+            cursor.execute(update_query)
+
+            # Commit the transaction
+            commit(connection)
+
+        # print the error first before sending it to the calling function, which will likely be an api call to send the
+        # error back to the user interface
     except Exception as error:
         print(f'Error creating breakglass account: {error}')
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 
 ######################################
@@ -493,28 +946,21 @@ def create_breakglass_account(password):
 def get_setting_by_name(setting_name):
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to get the setting by name
+            execute_prepared(cursor, 'get_setting_by_name', (setting_name,))
 
-        # Execute a query to get the setting by name
-        query = 'SELECT * FROM app_settings WHERE setting_name = %s'
-        cursor.execute(query, (setting_name,))
+            # Retrieve query results
+            setting = cursor.fetchone()
 
-        # Retrieve query results
-        setting = cursor.fetchone()
-
-        if setting:
-            return setting
-        else:
-            raise Exception('Failed to find setting %s in database', setting_name)
+            if setting:
+                return setting
+            else:
+                raise Exception('Failed to find setting %s in database', setting_name)
 
     except Exception as error:
         print(f"Error fetching setting: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 
 ########################################################
@@ -527,78 +973,380 @@ def get_setting_by_name(setting_name):
 def get_token(token):
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to get the token
+            execute_prepared(cursor, 'get_token', (token,))
 
-        # Execute a query to get the token
-        query = "SELECT * FROM tokens WHERE token = %s"
-        cursor.execute(query, (token,))
+            # Retrieve query results
+            token_data = cursor.fetchone()
 
-        # Retrieve query results
-        token_data = cursor.fetchone()
-
-        if token_data:
-            return token_data
-        else:
-            raise Exception("Token not found in database")
+            if token_data:
+                return token_data
+            else:
+                raise Exception("Token not found in database")
 
     except Exception as error:
         print(f"Error fetching token: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
+
+#
+# Return the token, its deadline, its permission mask and all the user's fields in one query.
+# Used to build the auth context for a request. Returns None if the token doesn't exist.
+#
+def get_auth_context(token):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to get the token, its permission mask and the user together
+            execute_prepared(cursor, 'get_auth_context', (token,))
+
+            # Retrieve query results
+            return cursor.fetchone()
+
+    except Exception as error:
+        print(f"Error fetching auth context: {error}")
+        raise error
 
 #
 # Takes the token created and associated with the user and saves it to the database with a new time and deadline.
+# The permission mask is the user's effective permissions at login (see auth.build_permission_mask).
 # This function will refresh the token by default.
 # Returns True if the user was created, false or an exception if not
 #
-def save_user_token(username, token):
+def save_user_token(username, token, permission_mask=0):
     # TODO: Move token time deadline login to auth.authenticate function (database module should be dumb database access)
 
-    # Connect to your postgres DB
-    connection = connect()
-    cursor = connection.cursor()
-
-    # Check if the user exists
-    query = "SELECT * FROM users WHERE username = %s"
-    cursor.execute(query, (username,))
-    user = cursor.fetchone()
-
-    # User not found in the database, throw an error
-    if not user:
-        print(f"Error: User not found while saving token to user token table")
-        raise Exception("User not found while saving token to user token table")
-
     # get the timeout setting value from the settings table
     timeout_setting = get_setting_by_name('user_session_timeout')
     breakglass_timeout_setting = get_setting_by_name('breakglass_session_timeout')
 
-    # Generate current timestamp and deadline timestamp, breakglass will have much shorter timeout
-    created_at = datetime.now()
-    if username == "breakglass":
-        deadline = created_at + timedelta(minutes=breakglass_timeout_setting[2])
-    else:
-        deadline = created_at + timedelta(minutes=timeout_setting[2])
-
-    # Execute a query to insert or update the token for the user
-    upsert_query = """
-    INSERT INTO tokens (token, created_at, deadline, created_by)
-    VALUES (%s, %s, %s, %s)
-    ON CONFLICT (created_by)
-    DO UPDATE SET token = EXCLUDED.token, created_at = EXCLUDED.created_at, deadline = EXCLUDED.deadline
-    """
-    cursor.execute(upsert_query, (token, created_at, deadline, user[0]))
-
-    # Commit the transaction
-    connection.commit()
-    cursor.close()
-    disconnect(connection)
+    # Connect to your postgres DB, the connection goes back to the pool even if the user doesn't exist
+    with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+        # Check if the user exists
+        query = "SELECT * FROM users WHERE username = %s"
+        cursor.execute(query, (username,))
+        user = cursor.fetchone()
+
+        # User not found in the database, throw an error
+        if not user:
+            print(f"Error: User not found while saving token to user token table")
+            raise Exception("User not found while saving token to user token table")
+
+        # Generate current timestamp and deadline timestamp, breakglass will have much shorter timeout
+        created_at = datetime.now()
+        if username == "breakglass":
+            deadline = created_at + timedelta(minutes=breakglass_timeout_setting[2])
+        else:
+            deadline = created_at + timedelta(minutes=timeout_setting[2])
+
+        # Execute a query to insert or update the token for the user
+        upsert_query = """
+        INSERT INTO tokens (token, created_at, deadline, created_by, permission_mask)
+        VALUES (%s, %s, %s, %s, %s)
+        ON CONFLICT (created_by)
+        DO UPDATE SET token = EXCLUDED.token, created_at = EXCLUDED.created_at, deadline = EXCLUDED.deadline,
+            permission_mask = EXCLUDED.permission_mask
+        """
+        cursor.execute(upsert_query, (token, created_at, deadline, user[0], permission_mask))
+
+        # Commit the transaction
+        commit(connection)
+
+    # the user's previous token has been replaced, make sure it isn't still accepted from the cache
+    auth.invalidate_cached_tokens(user[0])
 
     return True
 
+#
+# Extend the deadlines of many tokens at once from a list of (token, deadline) pairs.
+# A deadline is never moved earlier. Returns how many tokens were updated.
+#
+def extend_token_deadlines(renewals):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to update every token in the batch
+            update_query = """
+            UPDATE tokens
+            SET deadline = v.deadline
+            FROM (VALUES %s) AS v (token, deadline)
+            WHERE tokens.token = v.token AND tokens.deadline < v.deadline
+            """
+            extras.execute_values(cursor, update_query, renewals, template='(%s, %s::timestamp)')
+            updated = cursor.rowcount
+
+            # Commit the transaction
+            commit(connection)
+
+            return updated
+
+    except Exception as error:
+        print(f"Error extending token deadlines: {error}")
+        raise error
+
+#
+# Delete up to batch_size expired tokens, returns how many were deleted.
+# Rows already locked (by a login upserting its token, or a sweeper in another process) are skipped.
+#
+def delete_expired_tokens(batch_size):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection(BULK_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to delete a batch of expired tokens, oldest first using the deadline index
+            delete_query = """
+            DELETE FROM tokens
+            WHERE id IN (
+                SELECT id FROM tokens
+                WHERE deadline < %s
+                ORDER BY deadline
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            """
+            cursor.execute(delete_query, (datetime.now(), batch_size))
+            deleted = cursor.rowcount
+
+            # Commit the transaction
+            commit(connection)
+
+            return deleted
+
+    except Exception as error:
+        print(f"Error deleting expired tokens: {error}")
+        raise error
+
+#
+# Revoke every signed token issued to the user before revoked_before. The row can be deleted
+# after expires_at, when every token it covers has expired anyway.
+#
+def revoke_user_tokens(user_id, revoked_before, expires_at):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to insert or update the revocation for the user
+            upsert_query = """
+            INSERT INTO token_revocations (user_id, revoked_before, expires_at)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (user_id)
+            DO UPDATE SET revoked_before = EXCLUDED.revoked_before, expires_at = EXCLUDED.expires_at
+            """
+            cursor.execute(upsert_query, (user_id, revoked_before, expires_at))
+
+            # Commit the transaction
+            commit(connection)
+
+    except Exception as error:
+        print(f"Error revoking user tokens: {error}")
+        raise error
+
+#
+# Return the (user id, revoked before) pairs for every revocation still in effect
+#
+def get_token_revocations():
+    try:
+        # Connect to your postgres DB
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to get the revocations
+            query = "SELECT user_id, revoked_before FROM token_revocations WHERE expires_at >= %s"
+            cursor.execute(query, (datetime.now(),))
+
+            # Retrieve query results
+            revocations = cursor.fetchall()
+
+            return revocations
+
+    except Exception as error:
+        print(f"Error fetching token revocations: {error}")
+        raise error
+
+#
+# Delete revocations that no longer cover any unexpired token, returns how many were deleted
+#
+def delete_expired_token_revocations():
+    try:
+        # Connect to your postgres DB
+        with pooled_connection(BULK_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to delete the expired revocations
+            delete_query = "DELETE FROM token_revocations WHERE expires_at < %s"
+            cursor.execute(delete_query, (datetime.now(),))
+            deleted = cursor.rowcount
+
+            # Commit the transaction
+            commit(connection)
+
+            return deleted
+
+    except Exception as error:
+        print(f"Error deleting expired token revocations: {error}")
+        raise error
+
+########################################################
+#			GLOBAL TOKENS
+########################################################
+
+#
+# Return the deadline, permission mask and all the creating user's fields for a global token, by the token's hash.
+# Same shape as get_auth_context without the token. Returns None if no token has that hash.
+#
+def get_global_token_context(token_hash):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to get the global token and the user who created it
+            query = '''
+            SELECT gt.deadline, gt.permission_mask, u.*
+            FROM global_tokens gt
+            INNER JOIN users u ON u.id = gt.created_by
+            WHERE gt.token = %s
+            '''
+            cursor.execute(query, (token_hash,))
+
+            # Retrieve query results
+            return cursor.fetchone()
+
+    except Exception as error:
+        print(f"Error fetching global token: {error}")
+        raise error
+
+#
+# Return the id, name, created_at, deadline, permission mask and creator of every global token (not the token hashes)
+#
+def get_global_tokens():
+    try:
+        # Connect to your postgres DB
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get all global tokens
+            query = "SELECT id, name, created_at, deadline, permission_mask, created_by FROM global_tokens ORDER BY id"
+            cursor.execute(query)
+
+            # Retrieve query results
+            global_tokens = cursor.fetchall()
+
+            return global_tokens
+
+    except Exception as error:
+        print(f"Error fetching global tokens: {error}")
+        raise error
+
+#
+# Add a new global token, only the token's hash is stored
+#
+def add_global_token(token_hash, name, permission_mask, deadline, created_by):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to insert the global token
+            insert_query = """
+            INSERT INTO global_tokens (token, name, created_at, deadline, permission_mask, created_by)
+            VALUES (%s, %s, %s, %s, %s, %s)
+            """
+            cursor.execute(insert_query, (token_hash, name, datetime.now(), deadline, permission_mask, created_by))
+
+            # Commit the transaction
+            commit(connection)
+
+    except Exception as error:
+        print(f"Error adding global token: {error}")
+        raise Exception(f"Failed to add global token: {error}")
+
+#
+# Delete a global token by id, returns the id of the user who created it or None if it didn't exist
+#
+def delete_global_token(token_id):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to delete the global token
+            delete_query = "DELETE FROM global_tokens WHERE id = %s RETURNING created_by"
+            cursor.execute(delete_query, (token_id,))
+            deleted = cursor.fetchone()
+
+            # Commit the transaction
+            commit(connection)
+
+            return deleted[0] if deleted else None
+
+    except Exception as error:
+        print(f"Error deleting global token: {error}")
+        raise error
+
+########################################################
+#			LOGIN THROTTLING
+########################################################
+
+#
+# Take a token from a shared login throttle bucket, refilling it for the time since it was last used.
+# Returns False if the bucket was empty. Done in one statement so concurrent workers can't both take the last token.
+#
+def take_login_throttle_token(key, capacity, refill_per_second):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to refill the bucket and take a token if there is one
+            upsert_query = """
+            INSERT INTO login_throttle AS b (key, tokens, updated_at, allowed)
+            VALUES (%(key)s, %(capacity)s - 1, %(now)s, TRUE)
+            ON CONFLICT (key) DO UPDATE SET
+                tokens = CASE
+                    WHEN LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM (%(now)s - b.updated_at)) * %(rate)s) >= 1
+                    THEN LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM (%(now)s - b.updated_at)) * %(rate)s) - 1
+                    ELSE LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM (%(now)s - b.updated_at)) * %(rate)s)
+                END,
+                allowed = LEAST(%(capacity)s, b.tokens + EXTRACT(EPOCH FROM (%(now)s - b.updated_at)) * %(rate)s) >= 1,
+                updated_at = %(now)s
+            RETURNING allowed
+            """
+            cursor.execute(upsert_query, {'key': key, 'capacity': capacity, 'rate': refill_per_second, 'now': datetime.now()})
+            allowed = cursor.fetchone()[0]
+
+            # Commit the transaction
+            commit(connection)
+
+            return allowed
+
+    except Exception as error:
+        print(f"Error taking login throttle token: {error}")
+        raise error
+
+#
+# Give a token back to a login throttle bucket, up to its capacity
+#
+def refund_login_throttle_token(key, capacity):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to add the token back to the bucket
+            update_query = "UPDATE login_throttle SET tokens = LEAST(%s, tokens + 1) WHERE key = %s"
+            cursor.execute(update_query, (capacity, key))
+
+            # Commit the transaction
+            commit(connection)
+
+    except Exception as error:
+        print(f"Error refunding login throttle token: {error}")
+        raise error
+
+#
+# Delete login throttle buckets not used for idle_seconds, returns how many were deleted
+#
+def delete_idle_login_throttle_buckets(idle_seconds):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection(BULK_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to delete the idle buckets
+            delete_query = "DELETE FROM login_throttle WHERE updated_at < %s"
+            cursor.execute(delete_query, (datetime.now() - timedelta(seconds=idle_seconds),))
+            deleted = cursor.rowcount
+
+            # Commit the transaction
+            commit(connection)
+
+            return deleted
+
+    except Exception as error:
+        print(f"Error deleting idle login throttle buckets: {error}")
+        raise error
+
 ########################################################
 #			REQUESTS
 ########################################################
@@ -609,59 +1357,81 @@ def save_user_token(username, token):
 def get_request_by_id(request_id):
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to get the request by id
-        query = "SELECT * FROM requests WHERE id = %s"
-        cursor.execute(query, (request_id,))
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get the request by id
+            query = f"SELECT {REQUEST_COLUMNS} FROM requests WHERE id = %s"
+            cursor.execute(query, (request_id,))
 
-        # Retrieve query results
-        request = cursor.fetchone()
+            # Retrieve query results
+            request = cursor.fetchone()
 
-        if request:
-            return request
-        else:
-            raise Exception("No request found when getting request by id from database")
+            if request:
+                return request
+            else:
+                raise Exception("No request found when getting request by id from database")
 
     except Exception as error:
         print(f"Error fetching request by id: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
-# Return all requests for the user. Excluded resolved requests.
+# Return the request with the names of its type, department, team and assignee in place of their ids,
+# as a dict of named fields. One query, for the request detail view.
 #
-def get_requests_by_requester(username):
+def get_request_detail(request_id):
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get the request and the names it refers to
+            execute_prepared(cursor, 'get_request_detail', (request_id,))
 
-        username_data = get_user_by_username(username)
+            # Retrieve query results
+            request = cursor.fetchone()
 
-        # Execute a query to get requests by requester username
-        query = "SELECT * FROM requests WHERE requester = %s AND resolved = false" 
-        cursor.execute(query, (username_data[0],))
+            if request:
+                return dict(zip([column.name for column in cursor.description], request))
+            else:
+                raise Exception("No request found when getting request detail from database")
 
-        # Retrieve query results
-        requests = cursor.fetchall()
+    except Exception as error:
+        print(f"Error fetching request detail: {error}")
+        raise error
+
+#
+# Return a page of requests for the user, newest first. Excluded resolved requests.
+# after is the id of the last request on the previous page, None for the first page.
+#
+def get_requests_by_requester(username, limit=PAGE_MAX_LIMIT, after=None):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            username_data = get_user_by_username(username)
+
+            # Execute a query to get requests by requester username (requests_requester_open_idx)
+            query = f"""
+            SELECT {REQUEST_COLUMNS} FROM requests
+            WHERE requester = %(requester)s AND resolved = false
+            AND (%(after)s::integer IS NULL OR id < %(after)s)
+            ORDER BY id DESC
+            LIMIT %(limit)s
+            """
+            cursor.execute(query, {'requester': username_data[0], 'after': after, 'limit': limit})
+
+            # Retrieve query results
+            requests = cursor.fetchall()
         
-        return requests
+            return requests
 
     except Exception as error:
         print(f"Error fetching requests by username: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
-def get_all_unassigned_unresolved_requests():
-    ''' Return all unassigned and unresolved requests from the database.
+def get_all_unassigned_unresolved_requests(limit=PAGE_MAX_LIMIT, after=None):
+    ''' Return a page of unassigned and unresolved requests from the database, oldest first.
+
+    Args:
+        limit: the most requests to return
+        after: id of the last request on the previous page, None for the first page
     
     Returns:
         list: List of unassigned requests
@@ -669,25 +1439,168 @@ def get_all_unassigned_unresolved_requests():
 
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to get all unassigned requests
-        query = "SELECT * FROM requests WHERE (assigned_to_team IS NULL OR assigned_to_user IS NULL) AND resolved = false"
-        cursor.execute(query)
-
-        # Retrieve query results
-        unassigned_requests = cursor.fetchall()
+        with pooled_connection(BULK_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to get the unassigned requests (requests_unassigned_open_idx)
+            query = f"""
+            SELECT {REQUEST_COLUMNS} FROM requests
+            WHERE (assigned_to_team IS NULL OR assigned_to_user IS NULL) AND resolved = false
+            AND (%(after)s::integer IS NULL OR id > %(after)s)
+            ORDER BY id
+            LIMIT %(limit)s
+            """
+            cursor.execute(query, {'after': after, 'limit': limit})
+
+            # Retrieve query results
+            unassigned_requests = cursor.fetchall()
         
-        return unassigned_requests
+            return unassigned_requests
     
     except Exception as error:
         print(f"Error fetching unassigned requests: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
+
+# Filters query_requests accepts -> the requests column they match
+REQUEST_FILTERS = {
+    'department': 'team_category',
+    'team': 'assigned_to_team',
+    'assignee': 'assigned_to_user',
+    'type': 'type',
+    'priority': 'priority',
+    'escalation_level': 'escalation_level',
+    'outage': 'outage',
+    'resolved': 'resolved'
+}
+
+# Columns query_requests can sort by, id breaks ties. requested_at and priority can be NULL, NULLs sort
+# as the largest values (last ascending, first descending), the order the indexes hold them in.
+REQUEST_SORTS = ('requested_at', 'priority', 'id')
+
+#
+# Return a query_requests cursor's sort value as the column's type, raises ValueError if it isn't one
+#
+def parse_request_sort_value(sort, value):
+    if value is None:
+        return None
+
+    if sort == 'requested_at' and isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError as error:
+            raise ValueError('Invalid cursor') from error
+
+    if sort == 'priority' and isinstance(value, int) and not isinstance(value, bool):
+        return value
+
+    raise ValueError('Invalid cursor')
+
+def query_requests(filters, requested_after=None, requested_before=None, sort='requested_at', descending=True, limit=PAGE_MAX_LIMIT, after=None):
+    ''' Return a page of requests matching the filters, sorted. Builds one parameterised
+        query, the filters and sort line up with the open request indexes 
+        (requests_*_queue_idx) so a work queue is read straight off an index.
+
+    Args:
+        filters: dict of REQUEST_FILTERS name -> list of values, a request matches
+            any of the values. None matches requests where the column isn't set.
+        requested_after: only requests made at or after this time
+        requested_before: only requests made before this time
+        sort: one of REQUEST_SORTS
+        descending: sort largest (newest) first
+        limit: the most requests to return
+        after: [sort value, id] of the last request on the previous page, None for the first page.
+            The sort value is an ISO timestamp string for requested_at, an integer for priority,
+            or None where the request doesn't have one
+
+    Returns:
+        list: List of requests
+
+    Raises:
+        ValueError: When a filter or the sort isn't supported, or after doesn't match the sort
+    '''
+
+    if sort not in REQUEST_SORTS:
+        raise ValueError(f'Cannot sort requests by {sort}')
+
+    conditions = []
+    params = []
+
+    for name, values in filters.items():
+        if name not in REQUEST_FILTERS:
+            raise ValueError(f'Cannot filter requests by {name}')
+
+        column = sql.Identifier(REQUEST_FILTERS[name])
+        matches = []
+        values = [value for value in values if value is not None]
+
+        # a single value is a plain comparison, which plans best
+        if len(values) == 1:
+            matches.append(sql.SQL('{} = %s').format(column))
+            params.append(values[0])
+        elif values:
+            matches.append(sql.SQL('{} = ANY(%s)').format(column))
+            params.append(values)
+
+        if None in filters[name]:
+            matches.append(sql.SQL('{} IS NULL').format(column))
+
+        conditions.append(sql.SQL('({})').format(sql.SQL(' OR ').join(matches)))
+
+    if requested_after is not None:
+        conditions.append(sql.SQL('requested_at >= %s'))
+        params.append(requested_after)
+
+    if requested_before is not None:
+        conditions.append(sql.SQL('requested_at < %s'))
+        params.append(requested_before)
+
+    sort_column = sql.Identifier(sort)
+    direction = sql.SQL('DESC' if descending else 'ASC')
+    nulls = sql.SQL('NULLS FIRST' if descending else 'NULLS LAST')
+    comparison = sql.SQL('<' if descending else '>')
+
+    # carry on from the last request of the previous page
+    if after is not None:
+        if sort == 'id':
+            conditions.append(sql.SQL('id {} %s').format(comparison))
+            params.append(after[-1])
+        else:
+            after_value, after_id = parse_request_sort_value(sort, after[0]), after[-1]
+
+            if after_value is None and descending:
+                # the rest of the NULLs, then everything that is set
+                conditions.append(sql.SQL('(({0} IS NULL AND id < %s) OR {0} IS NOT NULL)').format(sort_column))
+                params.append(after_id)
+            elif after_value is None:
+                # only NULLs are left
+                conditions.append(sql.SQL('({} IS NULL AND id > %s)').format(sort_column))
+                params.append(after_id)
+            elif descending:
+                # the NULLs came first, a row comparison leaves them out
+                conditions.append(sql.SQL('({}, id) < (%s, %s)').format(sort_column))
+                params.extend((after_value, after_id))
+            else:
+                # the NULLs are still to come
+                conditions.append(sql.SQL('(({0}, id) > (%s, %s) OR {0} IS NULL)').format(sort_column))
+                params.extend((after_value, after_id))
+
+    query = sql.SQL('SELECT ' + REQUEST_COLUMNS + ' FROM requests WHERE {} ORDER BY {} {} {}, id {} LIMIT %s').format(
+        sql.SQL(' AND ').join(conditions) if conditions else sql.SQL('true'),
+        sort_column, direction, nulls, direction)
+    params.append(limit)
+
+    try:
+        # Connect to your postgres DB
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            cursor.execute(query, params)
+
+            # Retrieve query results
+            return cursor.fetchall()
+
+    # every value in the query came from the caller, e.g. an id too large for the column
+    except psycopg2.DataError as error:
+        raise ValueError(f'Invalid request query: {error}'.strip()) from error
+    except Exception as error:
+        print(f"Error querying requests: {error}")
+        raise error
 
 #
 # Return list of departments
@@ -695,25 +1608,19 @@ def get_all_unassigned_unresolved_requests():
 def get_request_departments():
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to get all departments
-        query = "SELECT * FROM departments"
-        cursor.execute(query)
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get all departments
+            query = "SELECT * FROM departments"
+            cursor.execute(query)
 
-        # Retrieve query results
-        departments = cursor.fetchall()
+            # Retrieve query results
+            departments = cursor.fetchall()
 
-        return departments
+            return departments
 
     except Exception as error:
         print(f"Error fetching departments: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
 # Return list of request types
@@ -721,25 +1628,19 @@ def get_request_departments():
 def get_request_types():
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to get all request types
-        query = "SELECT * FROM request_types"
-        cursor.execute(query)
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get all request types
+            query = "SELECT * FROM request_types"
+            cursor.execute(query)
 
-        # Retrieve query results
-        request_types = cursor.fetchall()
+            # Retrieve query results
+            request_types = cursor.fetchall()
 
-        return request_types
+            return request_types
 
     except Exception as error:
         print(f"Error fetching request types: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
 # Return a request type by its ID
@@ -747,28 +1648,22 @@ def get_request_types():
 def get_request_type_by_id(request_type_id):
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get the request type by id
+            query = "SELECT * FROM request_types WHERE id = %s"
+            cursor.execute(query, (request_type_id,))
 
-        # Execute a query to get the request type by id
-        query = "SELECT * FROM request_types WHERE id = %s"
-        cursor.execute(query, (request_type_id,))
+            # Retrieve query results
+            request_type = cursor.fetchone()
 
-        # Retrieve query results
-        request_type = cursor.fetchone()
-
-        if request_type:
-            return request_type
-        else:
-            raise Exception("No request type found when getting request type by id from database")
+            if request_type:
+                return request_type
+            else:
+                raise Exception("No request type found when getting request type by id from database")
 
     except Exception as error:
         print(f"Error fetching request type by id: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
 # Return a department by its ID
@@ -776,173 +1671,398 @@ def get_request_type_by_id(request_type_id):
 def get_department_by_id(department_id):
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get the department by id
+            query = "SELECT * FROM departments WHERE id = %s"
+            cursor.execute(query, (department_id,))
 
-        # Execute a query to get the department by id
-        query = "SELECT * FROM departments WHERE id = %s"
-        cursor.execute(query, (department_id,))
+            # Retrieve query results
+            department = cursor.fetchone()
 
-        # Retrieve query results
-        department = cursor.fetchone()
-
-        if department:
-            return department
-        else:
-            raise Exception("No department found when getting department by id from database")
+            if department:
+                return department
+            else:
+                raise Exception("No department found when getting department by id from database")
 
     except Exception as error:
         print(f"Error fetching department by id: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
-# Resolve a request by its ID
+# Raised by the request writes when the request doesn't exist
 #
-def resolve_request(request_id):
-    try:
-        # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to update the request status to resolved
-        update_query = """
-        UPDATE requests
-        SET resolved = true, resolved_at = %s
-        WHERE id = %s
-        """
-        cursor.execute(update_query, (datetime.now(), request_id))
+class RequestNotFoundError(Exception):
+    pass
 
-        # Commit the transaction
-        connection.commit()
+#
+# Raised by the request writes when the user may not change the request
+#
+class RequestPermissionError(Exception):
+    pass
 
+#
+# Resolve a request by its ID, as the user with the username. Only the requester can resolve their own
+# request unless resolve_any is set (the resolve_request permission). The ownership check and the update
+# are one statement. Returns the resolved request.
+#
+def resolve_request(request_id, username, resolve_any=False):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to update the request status to resolved, if the user may, and whether the request exists
+            update_query = f"""
+            WITH resolver AS (
+                SELECT id AS user_id FROM users WHERE username = %(username)s
+            ), resolved AS (
+                UPDATE requests
+                SET resolved = true, resolved_at = %(resolved_at)s
+                FROM resolver
+                WHERE id = %(request_id)s
+                AND (%(resolve_any)s OR requester = resolver.user_id)
+                RETURNING {REQUEST_COLUMNS}
+            )
+            SELECT EXISTS (SELECT 1 FROM requests WHERE id = %(request_id)s), resolved.*
+            FROM (SELECT 1) AS one
+            LEFT JOIN resolved ON true
+            """
+            cursor.execute(update_query, {'request_id': request_id, 'username': username, 'resolved_at': datetime.now(), 'resolve_any': resolve_any})
+            found, *request = cursor.fetchone()
+
+            # Commit the transaction
+            commit(connection)
+
+            if not found:
+                raise RequestNotFoundError(f"No request with id {request_id}")
+            if request[0] is None:
+                raise RequestPermissionError(f"{username} may not resolve request {request_id}")
+
+            return tuple(request)
+
+    except (RequestNotFoundError, RequestPermissionError):
+        raise
     except Exception as error:
         print(f"Error resolving request: {error}")
         raise Exception("Failed to resolve request")
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
-# Insert a new request
+# Insert a new request for the user with the username, the user id is looked up by the insert.
+# Returns the new request.
 #
 def add_request(username, request_title, request_description, request_type, request_department):
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # get the user, we need the id
-        user_data = get_user_by_username(username)
-
-        # Execute a query to insert a new request
-        insert_query = """
-        INSERT INTO requests (requester, requested_at, priority, outage, title, description, team_category, assigned_to_team, assigned_to_user, escalation_level, type)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
-        cursor.execute(insert_query, (user_data[0], datetime.now(), 4, False, request_title, request_description, request_department, None, None, 0, request_type))
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to insert a new request
+            insert_query = f"""
+            INSERT INTO requests (requester, requested_at, priority, outage, title, description, team_category, assigned_to_team, assigned_to_user, escalation_level, type)
+            SELECT id, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+            FROM users
+            WHERE username = %s
+            RETURNING {REQUEST_COLUMNS}
+            """
+            cursor.execute(insert_query, (datetime.now(), 4, False, request_title, request_description, request_department, None, None, 0, request_type, username))
+            new_request = cursor.fetchone()
+
+            if not new_request:
+                raise Exception(f"No user found with username {username}")
         
-        # Commit the transaction
-        connection.commit()
+            # Commit the transaction
+            commit(connection)
+
+            return new_request
 
     except Exception as error:
         print(f"Error adding request: {error}")
         raise Exception("Failed to add new requests")
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 ########################################################
 #			REQUEST UPDATES
 ########################################################
 
-def get_updates_by_request_id(request_id):
+#
+# Return a page of the updates for a request, in the order they were made.
+# after is (created_at, id) of the last update on the previous page, None for the first page.
+#
+def get_updates_by_request_id(request_id, limit=PAGE_MAX_LIMIT, after=None):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get updates by request id (updates_request_id_idx), id breaks ties
+            query = f"""
+            SELECT {UPDATE_COLUMNS} FROM updates
+            WHERE request_id = %(request_id)s
+            AND (%(after_created_at)s::timestamp IS NULL OR (created_at, id) > (%(after_created_at)s::timestamp, %(after_id)s))
+            ORDER BY created_at, id
+            LIMIT %(limit)s
+            """
+            after_created_at, after_id = after or (None, None)
+            cursor.execute(query, {'request_id': request_id, 'after_created_at': after_created_at, 'after_id': after_id, 'limit': limit})
+
+            # Retrieve query results
+            updates = cursor.fetchall()
+
+            return updates
+
+    except Exception as error:
+        print(f"Error fetching updates by request id: {error}")
+        raise error
+
+#
+# Add a new update to a request, made by the user with the username. Only the requester and the assigned
+# user can add updates unless update_any is set (the resolve_request permission). The ownership check and
+# the insert are one statement. Returns the new update.
+#
+def add_update(request_id, username, update_content, customer_visible, update_any=False):
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to insert a new update, if the user may, and whether the request exists
+            insert_query = f"""
+            WITH request AS (
+                SELECT id, requester, assigned_to_user FROM requests WHERE id = %(request_id)s
+            ), author AS (
+                SELECT id AS user_id FROM users WHERE username = %(username)s
+            ), inserted AS (
+                INSERT INTO updates (created_at, made_by, request_id, content, customer_visible)
+                SELECT %(created_at)s, author.user_id, request.id, %(content)s, %(customer_visible)s
+                FROM request
+                CROSS JOIN author
+                WHERE %(update_any)s OR author.user_id IN (request.requester, request.assigned_to_user)
+                RETURNING {UPDATE_COLUMNS}
+            )
+            SELECT EXISTS (SELECT 1 FROM request), inserted.*
+            FROM (SELECT 1) AS one
+            LEFT JOIN inserted ON true
+            """
+            cursor.execute(insert_query, {
+                'request_id': request_id, 'username': username, 'created_at': datetime.now(),
+                'content': update_content, 'customer_visible': customer_visible, 'update_any': update_any
+            })
+            found, *update = cursor.fetchone()
+
+            # Commit the transaction
+            commit(connection)
+
+            if not found:
+                raise RequestNotFoundError(f"No request with id {request_id}")
+            if update[0] is None:
+                raise RequestPermissionError(f"{username} may not update request {request_id}")
+
+            return tuple(update)
+
+    except (RequestNotFoundError, RequestPermissionError):
+        raise
+    except Exception as error:
+        print(f"Error adding update: {error}")
+        raise Exception("Failed to add new update")
 
-        # Execute a query to get updates by request id
-        query = "SELECT * FROM updates WHERE request_id = %s"
-        cursor.execute(query, (request_id,))
+########################################################
+#			STATISTICS
+########################################################
 
-        # Retrieve query results
-        updates = cursor.fetchall()
+# How often the request counters are recounted from the requests table
+REQUEST_STATS_RECONCILE_INTERVAL = 3600  # seconds
+
+# The requests counted per dimension and value, what the request_stats counters should hold
+REQUEST_STATS_QUERY = '''
+    SELECT d.dimension, d.key,
+        count(*) FILTER (WHERE NOT COALESCE(r.resolved, false)) AS open,
+        count(*) FILTER (WHERE NOT COALESCE(r.resolved, false) AND (r.assigned_to_team IS NULL OR r.assigned_to_user IS NULL)) AS unassigned,
+        count(*) FILTER (WHERE COALESCE(r.resolved, false)) AS resolved
+    FROM requests r
+    CROSS JOIN LATERAL (VALUES
+        ('all', 0),
+        ('department', COALESCE(r.team_category, -1)),
+        ('team', COALESCE(r.assigned_to_team, -1)),
+        ('type', COALESCE(r.type, -1)),
+        ('priority', COALESCE(r.priority, -1))
+    ) AS d (dimension, key)
+    GROUP BY d.dimension, d.key
+'''
+
+#
+# Return the open, unassigned and resolved request counts per dimension (all, department, team, type, priority)
+# and value (-1 where a request doesn't have one). The counters are kept up to date by a trigger on requests,
+# so this reads a handful of rows however many requests there are.
+#
+def get_request_stats():
+    try:
+        # Connect to your postgres DB
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get the counters
+            cursor.execute('SELECT dimension, key, open, unassigned, resolved FROM request_stats ORDER BY dimension, key')
 
-        return updates
+            # Retrieve query results
+            return cursor.fetchall()
 
     except Exception as error:
-        print(f"Error fetching updates by request id: {error}")
+        print(f"Error fetching request stats: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
-# Add a new update to the database
+# Recount the request counters from the requests table and fix any that have drifted. Run by the scheduler.
+# Returns the number of counters that were wrong.
 #
-def add_update(request_id, username, update_content, customer_visible):
+# No table lock is taken, writes to requests carry on while it counts. The trigger changes a request and
+# its counters in the same transaction, so the recount and the counters it is compared with (one statement,
+# one snapshot) always agree unless a counter really is wrong. The difference is then added to the counter
+# rather than overwriting it, which keeps any trigger updates committed since the snapshot.
+#
+def reconcile_request_stats():
     try:
-        # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
+        with pooled_connection(BULK_POOL) as connection, connection.cursor() as cursor:
+            cursor.execute(f'''
+                WITH actual AS ({REQUEST_STATS_QUERY}),
+                drift AS (
+                    SELECT dimension, key,
+                        COALESCE(actual.open, 0) - COALESCE(s.open, 0) AS open,
+                        COALESCE(actual.unassigned, 0) - COALESCE(s.unassigned, 0) AS unassigned,
+                        COALESCE(actual.resolved, 0) - COALESCE(s.resolved, 0) AS resolved
+                    FROM actual
+                    FULL OUTER JOIN request_stats s USING (dimension, key)
+                )
+                INSERT INTO request_stats AS s (dimension, key, open, unassigned, resolved)
+                SELECT dimension, key, open, unassigned, resolved
+                FROM drift
+                WHERE (open, unassigned, resolved) <> (0, 0, 0)
+                ON CONFLICT (dimension, key) DO UPDATE SET
+                    open = s.open + EXCLUDED.open,
+                    unassigned = s.unassigned + EXCLUDED.unassigned,
+                    resolved = s.resolved + EXCLUDED.resolved
+            ''')
+            drifted = cursor.rowcount
+
+            # Commit the transaction
+            commit(connection)
+
+            if drifted:
+                db_logger.warning('%s request stats counters had drifted and were corrected', drifted)
+
+            return drifted
 
-        # Get the user, we need the id
-        user_data = get_user_by_username(username)
+    except Exception as error:
+        print(f"Error reconciling request stats: {error}")
+        raise error
 
-        # Execute a query to insert a new update
-        insert_query = """
-        INSERT INTO updates (created_at, made_by, request_id, content, customer_visible)
-        VALUES (%s, %s, %s, %s, %s)
-        """
-        cursor.execute(insert_query, (datetime.now(), user_data[0], request_id, update_content, customer_visible))
+########################################################
+#			SEARCH
+########################################################
 
-        # Commit the transaction
-        connection.commit()
+#
+# Full text search over request titles and descriptions and update contents, best matches first.
+# The search_vector columns are set by triggers in Postgres (migrations.py), so they are always in step
+# with add_request and add_update, and the GIN indexes find the matches without scanning.
+# Snippets are only made for the page being returned, ts_headline is expensive.
+#
+# Each result is (rank, kind ('request' or 'update'), id, request_id, request title, snippet).
+# The snippet has the matched words between SEARCH_MATCH_START and SEARCH_MATCH_STOP.
+# requester_id limits the search to that user's requests and the updates they can see.
+# after is [rank, kind, id] of the last result on the previous page, None for the first page.
+#
+SEARCH_MATCH_START = '\x02'
+SEARCH_MATCH_STOP = '\x03'
+
+def search_requests(search_text, requester_id=None, limit=PAGE_MAX_LIMIT, after=None):
+    after_rank, after_kind, after_id = after or (None, None, None)
+
+    try:
+        # Connect to your postgres DB
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            query = """
+            WITH search AS (
+                SELECT websearch_to_tsquery(%(language)s::regconfig, %(search_text)s) AS query
+            ),
+            hits AS (
+                SELECT ts_rank(r.search_vector, search.query)::float8 AS rank, 'request' AS kind, r.id, r.id AS request_id
+                FROM requests r, search
+                WHERE r.search_vector @@ search.query
+                AND (%(requester_id)s::integer IS NULL OR r.requester = %(requester_id)s)
+
+                UNION ALL
+
+                SELECT ts_rank(u.search_vector, search.query)::float8, 'update', u.id, u.request_id
+                FROM updates u
+                CROSS JOIN search
+                INNER JOIN requests r ON r.id = u.request_id
+                WHERE u.search_vector @@ search.query
+                AND (%(requester_id)s::integer IS NULL OR (r.requester = %(requester_id)s AND u.customer_visible))
+            ),
+            page AS (
+                SELECT * FROM hits
+                WHERE %(after_rank)s::float8 IS NULL OR (rank, kind, id) < (%(after_rank)s::float8, %(after_kind)s, %(after_id)s)
+                ORDER BY rank DESC, kind DESC, id DESC
+                LIMIT %(limit)s
+            )
+            SELECT page.rank, page.kind, page.id, page.request_id, r.title,
+                ts_headline(%(language)s::regconfig,
+                    CASE WHEN page.kind = 'request' THEN concat_ws(' ', r.title, r.description) ELSE u.content END,
+                    search.query, %(headline_options)s) AS snippet
+            FROM page
+            CROSS JOIN search
+            INNER JOIN requests r ON r.id = page.request_id
+            LEFT JOIN updates u ON page.kind = 'update' AND u.id = page.id
+            ORDER BY page.rank DESC, page.kind DESC, page.id DESC
+            """
+            cursor.execute(query, {
+                'language': SEARCH_LANGUAGE,
+                'search_text': search_text,
+                'requester_id': requester_id,
+                'after_rank': after_rank,
+                'after_kind': after_kind,
+                'after_id': after_id,
+                'limit': limit,
+                'headline_options': f'StartSel={SEARCH_MATCH_START}, StopSel={SEARCH_MATCH_STOP}, MaxFragments=2, MinWords=5, MaxWords=20'
+            })
+
+            # Retrieve query results
+            return cursor.fetchall()
 
     except Exception as error:
-        print(f"Error adding update: {error}")
-        raise Exception("Failed to add new update")
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
+        print(f"Error searching requests: {error}")
+        raise error
 
 ########################################################
 #			PERMISSIONS
 ########################################################
 
+#
+# Return the id and name of every permission
+#
+def get_permissions():
+    try:
+        # Connect to your postgres DB
+        with pooled_connection(AUTH_POOL) as connection, connection.cursor() as cursor:
+            # Execute a query to get all permissions
+            query = "SELECT id, permission_name FROM permissions"
+            cursor.execute(query)
+
+            # Retrieve query results
+            permissions = cursor.fetchall()
+
+            return permissions
+
+    except Exception as error:
+        print(f"Error fetching permissions: {error}")
+        raise error
+
 #
 # Return all fields for a permission by the permission name
 #
 def get_permission_by_name(perm_name):
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to get requests by requester username
-        query = "SELECT * FROM permissions WHERE permission_name = %s"
-        cursor.execute(query, (perm_name,))
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get requests by requester username
+            execute_prepared(cursor, 'get_permission_by_name', (perm_name,))
 
-        # Retrieve query results
-        requests = cursor.fetchall()
+            # Retrieve query results
+            requests = cursor.fetchall()
 
-        return requests
+            return requests
 
     except Exception as error:
         print(f"Error fetching permissions by permission_name: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 
 ########################################################
@@ -955,25 +2075,19 @@ def get_permission_by_name(perm_name):
 def get_departments():
     try:
         # Connect to postgres
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to get all departments
-        query = "SELECT * FROM departments"
-        cursor.execute(query)
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get all departments
+            query = "SELECT * FROM departments"
+            cursor.execute(query)
 
-        # Retrieve query results
-        departments = cursor.fetchall()
+            # Retrieve query results
+            departments = cursor.fetchall()
 
-        return departments
+            return departments
 
     except Exception as error:
         print(f"Error fetching departments: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
 # Return all teams
@@ -981,25 +2095,19 @@ def get_departments():
 def get_teams():
     try:
         # Connect to postgres
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to get all teams
-        query = "SELECT * FROM teams"
-        cursor.execute(query)
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get all teams
+            query = "SELECT * FROM teams_with_members"
+            cursor.execute(query)
 
-        # Retrieve query results
-        teams = cursor.fetchall()
+            # Retrieve query results
+            teams = cursor.fetchall()
 
-        return teams
+            return teams
 
     except Exception as error:
         print(f"Error fetching teams: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
 # Return a team by its ID
@@ -1007,28 +2115,45 @@ def get_teams():
 def get_team_by_id(team_id):
     try:
         # Connect to your postgres DB
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Execute a query to get the team by id
-        query = "SELECT * FROM teams WHERE id = %s"
-        cursor.execute(query, (team_id,))
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get the team by id
+            query = "SELECT * FROM teams_with_members WHERE id = %s"
+            cursor.execute(query, (team_id,))
 
-        # Retrieve query results
-        team = cursor.fetchone()
+            # Retrieve query results
+            team = cursor.fetchone()
 
-        if team:
-            return team
-        else:
-            raise Exception("No team found when getting team by id from database")
+            if team:
+                return team
+            else:
+                raise Exception("No team found when getting team by id from database")
 
     except Exception as error:
         print(f"Error fetching team by id from database: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
+
+#
+# Return the teams the user is a member of
+#
+def get_teams_by_user(user_id):
+    try:
+        # Connect to your postgres DB
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Execute a query to get the user's teams (team_members_user_id_idx)
+            query = """
+            SELECT t.* FROM teams_with_members t
+            INNER JOIN team_members m ON m.team_id = t.id
+            WHERE m.user_id = %s
+            ORDER BY t.id
+            """
+            cursor.execute(query, (user_id,))
+
+            # Retrieve query results
+            return cursor.fetchall()
+
+    except Exception as error:
+        print(f"Error fetching teams by user: {error}")
+        raise error
 
 #
 # Add a new team in to the database
@@ -1036,25 +2161,19 @@ def get_team_by_id(team_id):
 def add_team(name, description):
     try:
         # Connect to postgres
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Insert the new team
-        insert_query = """
-        INSERT INTO teams (name, description)
-        VALUES (%s, %s)
-        """
-
-        cursor.execute(insert_query, (name, description))
-        connection.commit()
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Insert the new team
+            insert_query = """
+            INSERT INTO teams (name, description)
+            VALUES (%s, %s)
+            """
+
+            cursor.execute(insert_query, (name, description))
+            commit(connection)
         
     except Exception as error:
         print(f"Error adding team: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
 
 #
 # Add a new department in to the database
@@ -1062,22 +2181,16 @@ def add_team(name, description):
 def add_department(name, description, initial_team, teamList):
     try:
         # Connect to postgres
-        connection = connect()
-        cursor = connection.cursor()
-
-        # Insert the new department
-        insert_query = """
-        INSERT INTO departments (name, teams, description, initial_assignment)
-        VALUES (%s, %s, %s, %s)
-        """
-
-        cursor.execute(insert_query, (name, list(map(int, teamList)), description, initial_team))
-        connection.commit()
+        with pooled_connection() as connection, connection.cursor() as cursor:
+            # Insert the new department
+            insert_query = """
+            INSERT INTO departments (name, teams, description, initial_assignment)
+            VALUES (%s, %s, %s, %s)
+            """
+
+            cursor.execute(insert_query, (name, list(map(int, teamList)), description, initial_team))
+            commit(connection)
         
     except Exception as error:
         print(f"Error adding department: {error}")
         raise error
-    finally:
-        if connection:
-            cursor.close()
-            disconnect(connection)
\ No newline at end of file
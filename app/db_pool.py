@@ -0,0 +1,371 @@
+from collections import deque
+from psycopg2 import extensions
+import psycopg2
+import threading, time
+
+#
+# Raised when no connection became free within the checkout timeout
+#
+class PoolTimeoutError(Exception):
+    pass
+
+class Histogram:
+    ''' Counts observations (in seconds) in fixed buckets, for wait and hold times. '''
+
+    # upper bounds of the buckets in seconds, anything above the last goes in an overflow bucket
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds) -> None:
+        index = 0
+        while index < len(self.BUCKETS) and seconds > self.BUCKETS[index]:
+            index += 1
+
+        self.counts[index] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def snapshot(self) -> dict:
+        buckets = {f'le_{bound}': count for bound, count in zip(self.BUCKETS, self.counts)}
+        buckets['le_inf'] = self.counts[-1]
+
+        return {
+            'count': self.count,
+            'sum_seconds': self.total,
+            'max_seconds': self.max,
+            'average_seconds': self.total / self.count if self.count else 0.0,
+            'buckets': buckets
+        }
+
+class BlockingConnectionPool:
+    ''' Connection pool where callers wait for a connection when they are all in use,
+        first come first served, for up to the checkout timeout (psycopg2's own pools
+        raise PoolError straight away).
+
+        minconn connections are opened up front and idle connections are kept rather
+        than closed, so requests don't pay to connect. Idle connections are checked
+        before they are handed out, and replaced once they reach their maximum age or
+        number of uses. Connections above minconn that stay idle are closed by maintain().
+    '''
+
+    def __init__(self, minconn, maxconn, timeout, max_age=None, max_uses=None, validate_after=0, max_idle=None, **kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+
+        # seconds / checkouts before a connection is replaced, None for no limit
+        self.max_age = max_age
+        self.max_uses = max_uses
+
+        # connections idle for longer than this (seconds) are checked before being handed out
+        self.validate_after = validate_after
+
+        # connections above minconn idle for longer than this (seconds) are closed by maintain(), None to keep them
+        self.max_idle = max_idle
+
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+
+        # connections checked out, or promised to a waiter being woken up
+        self._in_use = 0
+
+        # one event per waiting thread, oldest first
+        self._waiters = deque()
+
+        # idle connections, most recently returned last
+        self._idle = []
+
+        # id(connection) -> [opened at, times checked out, returned at]
+        self._connections = {}
+
+        # metrics, protected by _lock
+        self._wait_times = Histogram()
+        self._hold_times = {}
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        self._recycled = 0
+        self._failed_checks = 0
+
+        # id(connection) -> (label, checked out at)
+        self._checkouts = {}
+
+        self.prewarm()
+
+    def prewarm(self) -> None:
+        ''' Open connections until minconn are idle, e.g. at startup or after a database restart. '''
+
+        while True:
+            with self._lock:
+                if len(self._idle) + self._in_use >= self.minconn:
+                    return
+
+            connection = self._connect()
+
+            with self._lock:
+                self._connections[id(connection)][2] = time.monotonic()
+                self._idle.append(connection)
+
+    def maintain(self) -> None:
+        ''' Check the idle connections, replace broken and expired ones, close surplus ones and 
+            top up to minconn. Run in the background so it is the pool, not a request, that 
+            notices the database was restarted and pays to reconnect.
+
+            Connections are taken out one at a time, so the rest stay available to callers
+            while one is being checked.
+        '''
+
+        with self._lock:
+            # least recently used first
+            idle = list(self._idle)
+
+        for connection in idle:
+            with self._lock:
+                # checked out since, it will be looked at when it's next idle
+                if connection not in self._idle:
+                    continue
+
+                self._idle.remove(connection)
+                idle_for = time.monotonic() - self._connections[id(connection)][2]
+                open_connections = len(self._idle) + self._in_use
+
+            if open_connections >= self.maxconn:
+                # more open than the pool should hold (connections returned or opened meanwhile)
+                self._discard(connection)
+            elif self.max_idle is not None and idle_for >= self.max_idle and open_connections >= self.minconn:
+                # not needed since the last busy spell, shrink back towards minconn
+                self._discard(connection)
+            elif connection.closed:
+                self._discard(connection)
+            elif self._expired(connection):
+                self._discard(connection, recycled=True)
+            elif not self._check(connection):
+                with self._lock:
+                    self._failed_checks += 1
+
+                self._discard(connection)
+            else:
+                with self._lock:
+                    keep = len(self._idle) + self._in_use < self.maxconn
+
+                    if keep:
+                        # back under any connections returned in the meantime, as it's been idle longer
+                        self._idle.insert(0, connection)
+
+                if not keep:
+                    self._discard(connection)
+
+        self.prewarm()
+
+    def getconn(self, timeout=None, label=None) -> object:
+        ''' Return a connection, waiting for one to be returned if they are all in use.
+
+        Args:
+            timeout: seconds to wait, defaults to the pool's checkout timeout
+            label: who is checking it out (calling function and route), for the hold time metrics
+
+        Returns:
+            Connection: connection to the database
+
+        Raises:
+            PoolTimeoutError: When no connection became free in time
+        '''
+
+        if timeout is None:
+            timeout = self.timeout
+
+        start = time.monotonic()
+        self._acquire_slot(timeout)
+
+        try:
+            connection = self._take_idle() or self._connect()
+        except Exception:
+            # couldn't connect, give the slot to someone else
+            self._release_slot()
+            raise
+
+        now = time.monotonic()
+        with self._lock:
+            self._wait_times.observe(now - start)
+            self._checkouts[id(connection)] = (label or 'unknown', now)
+            self._connections[id(connection)][1] += 1
+
+        return connection
+
+    def putconn(self, connection, close=False) -> None:
+        ''' Return a connection to the pool and wake the longest waiting caller.
+
+        Args:
+            connection: the connection to return
+            close: close the connection rather than keeping it for reuse
+        '''
+
+        with self._lock:
+            checkout = self._checkouts.pop(id(connection), None)
+
+            if checkout:
+                self._hold_times.setdefault(checkout[0], Histogram()).observe(time.monotonic() - checkout[1])
+
+        try:
+            if not close and not connection.closed:
+                status = connection.info.transaction_status
+
+                # lost track of the server, don't trust it
+                if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+
+            if close or connection.closed:
+                self._discard(connection)
+            elif self._expired(connection):
+                self._discard(connection, recycled=True)
+            else:
+                with self._lock:
+                    self._connections[id(connection)][2] = time.monotonic()
+                    self._idle.append(connection)
+        except Exception:
+            # the rollback failed, the connection is broken
+            self._discard(connection)
+        finally:
+            self._release_slot()
+
+    def metrics(self) -> dict:
+        ''' Return a snapshot of the pool's metrics.
+
+        Returns:
+            dict: connections in use, idle and waiting, wait and hold time 
+                histograms, timeouts, connections created and discarded
+        '''
+
+        with self._lock:
+            return {
+                'max_size': self.maxconn,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waiting': len(self._waiters),
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'discarded': self._discarded,
+                'recycled': self._recycled,
+                'failed_checks': self._failed_checks,
+                'wait_time': self._wait_times.snapshot(),
+                'hold_time': {label: histogram.snapshot() for label, histogram in self._hold_times.items()}
+            }
+
+    def closeall(self) -> None:
+        ''' Close every idle connection, checked out ones are closed when they are returned. '''
+
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection in idle:
+            self._discard(connection)
+
+    def _connect(self) -> object:
+        connection = psycopg2.connect(**self._kwargs)
+
+        with self._lock:
+            self._created += 1
+            self._connections[id(connection)] = [time.monotonic(), 0, None]
+
+        return connection
+
+    def _take_idle(self) -> object:
+        ''' Return a usable idle connection, or None if there aren't any. '''
+
+        while True:
+            with self._lock:
+                if not self._idle:
+                    return None
+
+                # the most recently used connection is the least likely to have gone stale
+                connection = self._idle.pop()
+                returned_at = self._connections[id(connection)][2]
+
+            if connection.closed:
+                self._discard(connection)
+                continue
+
+            if self._expired(connection):
+                self._discard(connection, recycled=True)
+                continue
+
+            if time.monotonic() - returned_at >= self.validate_after and not self._check(connection):
+                with self._lock:
+                    self._failed_checks += 1
+
+                self._discard(connection)
+                continue
+
+            return connection
+
+    def _check(self, connection) -> bool:
+        ''' Cheap round trip to make sure the server is still there (e.g. after a restart or failover). '''
+
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _expired(self, connection) -> bool:
+        opened_at, uses, _ = self._connections[id(connection)]
+
+        if self.max_age is not None and time.monotonic() - opened_at >= self.max_age:
+            return True
+
+        return self.max_uses is not None and uses >= self.max_uses
+
+    def _discard(self, connection, recycled=False) -> None:
+        with self._lock:
+            self._connections.pop(id(connection), None)
+            self._discarded += 1
+
+            if recycled:
+                self._recycled += 1
+
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+    def _acquire_slot(self, timeout) -> None:
+        with self._lock:
+            # only skip the queue if nobody is already waiting
+            if self._in_use < self.maxconn and not self._waiters:
+                self._in_use += 1
+                return
+
+            waiter = threading.Event()
+            self._waiters.append(waiter)
+
+        if waiter.wait(timeout):
+            return
+
+        with self._lock:
+            # handed a slot just as the wait timed out, keep it
+            if waiter.is_set():
+                return
+
+            self._waiters.remove(waiter)
+            self._timeouts += 1
+
+        raise PoolTimeoutError(f'No database connection available after waiting {timeout} seconds')
+
+    def _release_slot(self) -> None:
+        with self._lock:
+            # hand the slot straight to the next waiter so nobody can jump the queue
+            if self._waiters:
+                self._waiters.popleft().set()
+            else:
+                self._in_use -= 1
@@ -1,9 +1,17 @@
-import json
+import json, os
+
+# Written by the install, the app isn't installed until it exists
+CREDENTIALS_FILE = 'db_credentials.json'
 
 #
 # Read the credentials from the file
 #
-def read_credentials(filename='db_credentials.json'):
+def read_credentials(filename=CREDENTIALS_FILE):
     with open(filename, encoding='utf-8') as f:
         credentials = json.load(f)
-        return credentials
\ No newline at end of file
+        return credentials
+#
+# Return True once the install has written the credentials file
+#
+def credentials_exist(filename=CREDENTIALS_FILE):
+    return os.path.exists(filename)
@@ -1,5 +1,6 @@
 import psycopg2
 import create_database
+import migrations
 
 username = 'postgres'
 password = 'postgres1234!'
@@ -49,7 +50,10 @@ def check_table_exists(dbname, db_user, db_password, table_name, host='localhost
         return False
     
 #
-# Check if all tables that are required exist, returns True if everything exists
+# Check if all tables that are required exist, returns True if everything exists.
+# token_revocations, login_throttle and schema_migrations are left out, they only matter once the app runs.
+# team_members is checked, every read of the teams depends on it. On existing installs it comes from a
+# migration, which stops the app at startup if it fails, so a failed migration can't reach this check.
 #
 def check_if_all_tables_exists(database, username, password):
     users_exists = check_table_exists('requestmanager', username, password, 'users')
@@ -62,10 +66,10 @@ def check_if_all_tables_exists(database, username, password):
     teams_exists = check_table_exists('requestmanager', username, password, 'teams')
     request_types_exists = check_table_exists('requestmanager', username, password, 'request_types')
     updates_exists = check_table_exists('requestmanager', username, password, 'updates')
-
+    team_members_exists = check_table_exists('requestmanager', username, password, 'team_members')
 
     return (users_exists and permssions_exists and requests_exists and tokens_exists and app_settings_exists and global_tokens_exists
-        and departments_exists and teams_exists and request_types_exists and updates_exists)
+        and departments_exists and teams_exists and request_types_exists and updates_exists and team_members_exists)
 
 #
 # Return true if the database and tables exists
@@ -77,4 +81,7 @@ def is_database_initialised():
 # Create the database and tables
 #
 def init_database(new_db_username, new_db_password):
-    create_database.create_database_and_tables(new_db_username, new_db_password)
\ No newline at end of file
+    create_database.create_database_and_tables(new_db_username, new_db_password)
+
+    # indexes and constraints, and mark the install as up to date
+    migrations.migrate()
\ No newline at end of file
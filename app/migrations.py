@@ -0,0 +1,548 @@
+import psycopg2, logger, db_util, database, create_database
+import psycopg2.errors
+
+#
+# Versioned schema migrations. Each migration runs once per database and is recorded in the
+# schema_migrations table, so existing installs pick up schema changes without a reinstall.
+# Migrations are applied in order at app startup (and straight after a fresh install).
+#
+# A migration is a function taking (conn, cur). Transactional ones run in a single transaction
+# together with recording their version. The others run in autocommit, which CREATE INDEX
+# CONCURRENTLY needs and which keeps table locks short (each statement commits on its own),
+# and must be safe to run again if they are interrupted part way.
+#
+# NOTE: Only ever add new migrations to the end of MIGRATIONS, never change one that has shipped.
+#
+# Usage (from the app directory):
+#   python3 migrations.py
+#
+
+migrations_logger = logger.get_logger('migrations', 'logs/migrations.log')
+
+# Stops two app processes applying the same migration at once
+MIGRATION_LOCK_ID = 7166001
+
+# Give up on DDL that has to wait this long for a table lock, rather than blocking every query
+# queued up behind it. The migration is tried again on the next startup.
+MIGRATION_LOCK_TIMEOUT = '5s'
+
+# Rows filled in per statement when a new column is backfilled
+SEARCH_VECTOR_BATCH_SIZE = 5000
+
+#
+# Create the table that records the applied migrations
+#
+def create_schema_migrations_table(conn, cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(128) NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+#
+# Add a foreign key unless the table already has it, in autocommit. It is added NOT VALID and committed
+# straight away, which only needs a brief lock and checks new rows from then on. Validating it then scans
+# the existing rows under a lock that doesn't block reads or writes. If existing rows break it, it is left
+# NOT VALID and logged, new rows are still checked.
+#
+def add_foreign_key(conn, cur, table, name, definition):
+    cur.execute('SELECT convalidated FROM pg_constraint WHERE conname = %s', (name,))
+    constraint = cur.fetchone()
+
+    if constraint is None:
+        cur.execute(f'ALTER TABLE {table} ADD CONSTRAINT {name} {definition} NOT VALID')
+    elif constraint[0]:
+        return
+
+    try:
+        cur.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT {name}')
+    except psycopg2.errors.ForeignKeyViolation as error:
+        migrations_logger.warning('Existing rows in %s break %s, it only applies to new rows: %s', table, name, error)
+
+#
+# Build an index without blocking writes to the table. An interrupted concurrent build leaves an
+# invalid index behind, which IF NOT EXISTS would skip, so that is dropped and built again.
+#
+def create_index_concurrently(conn, cur, name, definition):
+    cur.execute('''
+        SELECT 1 FROM pg_index i
+        INNER JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND NOT i.indisvalid
+    ''', (name,))
+
+    if cur.fetchone() is not None:
+        migrations_logger.warning('Index %s is invalid (interrupted build), rebuilding it', name)
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+    cur.execute(f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}')
+
+#
+# 1: Bring installs made before the migrations existed up to the schema create_database.py creates now
+#
+def upgrade_existing_tables(conn, cur):
+    # tokens carry the permission mask and are rewritten on every login
+    cur.execute('ALTER TABLE tokens ADD COLUMN IF NOT EXISTS permission_mask BIGINT NOT NULL DEFAULT 0')
+    cur.execute('ALTER TABLE tokens SET (fillfactor = 70, autovacuum_vacuum_scale_factor = 0.05)')
+
+    # global tokens are named and scoped, and a user can have several
+    cur.execute('ALTER TABLE global_tokens ADD COLUMN IF NOT EXISTS name VARCHAR(64)')
+    cur.execute('ALTER TABLE global_tokens ADD COLUMN IF NOT EXISTS permission_mask BIGINT NOT NULL DEFAULT 0')
+    cur.execute('ALTER TABLE global_tokens DROP CONSTRAINT IF EXISTS global_tokens_created_by_key')
+    cur.execute('ALTER TABLE global_tokens ALTER COLUMN created_by DROP DEFAULT')
+
+    # tables added since
+    create_database.create_token_revocations_table(conn, cur)
+    create_database.create_login_throttle_table(conn, cur)
+
+#
+# 2: Foreign keys between the tables. Not transactional, so each table is only locked against writes
+# for as long as its constraint takes to add, not while every constraint is validated.
+#
+def add_foreign_keys(conn, cur):
+    # tokens go with their user
+    add_foreign_key(conn, cur, 'tokens', 'tokens_created_by_fkey',
+        'FOREIGN KEY (created_by) REFERENCES users (id) ON DELETE CASCADE')
+    add_foreign_key(conn, cur, 'global_tokens', 'global_tokens_created_by_fkey',
+        'FOREIGN KEY (created_by) REFERENCES users (id) ON DELETE CASCADE')
+    add_foreign_key(conn, cur, 'token_revocations', 'token_revocations_user_id_fkey',
+        'FOREIGN KEY (user_id) REFERENCES users (id) ON DELETE CASCADE')
+
+    # requests
+    add_foreign_key(conn, cur, 'requests', 'requests_requester_fkey',
+        'FOREIGN KEY (requester) REFERENCES users (id)')
+    add_foreign_key(conn, cur, 'requests', 'requests_assigned_to_user_fkey',
+        'FOREIGN KEY (assigned_to_user) REFERENCES users (id) ON DELETE SET NULL')
+    add_foreign_key(conn, cur, 'requests', 'requests_assigned_to_team_fkey',
+        'FOREIGN KEY (assigned_to_team) REFERENCES teams (id) ON DELETE SET NULL')
+    add_foreign_key(conn, cur, 'requests', 'requests_team_category_fkey',
+        'FOREIGN KEY (team_category) REFERENCES departments (id)')
+    add_foreign_key(conn, cur, 'requests', 'requests_type_fkey',
+        'FOREIGN KEY (type) REFERENCES request_types (id)')
+
+    # updates go with their request
+    add_foreign_key(conn, cur, 'updates', 'updates_request_id_fkey',
+        'FOREIGN KEY (request_id) REFERENCES requests (id) ON DELETE CASCADE')
+    add_foreign_key(conn, cur, 'updates', 'updates_made_by_fkey',
+        'FOREIGN KEY (made_by) REFERENCES users (id)')
+    add_foreign_key(conn, cur, 'request_updates', 'request_updates_associated_request_fkey',
+        'FOREIGN KEY (associated_request) REFERENCES requests (id) ON DELETE CASCADE')
+    add_foreign_key(conn, cur, 'request_updates', 'request_updates_made_by_fkey',
+        'FOREIGN KEY (made_by) REFERENCES users (id)')
+
+    add_foreign_key(conn, cur, 'departments', 'departments_initial_assignment_fkey',
+        'FOREIGN KEY (initial_assignment) REFERENCES teams (id) ON DELETE SET NULL')
+
+#
+# 3: Indexes for the request and update lookups, which were all sequential scans
+#
+def add_request_indexes(conn, cur):
+    # get_requests_by_requester, a user's open requests
+    create_index_concurrently(conn, cur, 'requests_requester_open_idx',
+        'requests (requester, id) WHERE resolved = false')
+
+    # get_all_unassigned_unresolved_requests, the triage queue
+    create_index_concurrently(conn, cur, 'requests_unassigned_open_idx',
+        'requests (id) WHERE resolved = false AND (assigned_to_team IS NULL OR assigned_to_user IS NULL)')
+
+    # open requests assigned to a user, and the foreign key check when a user is deleted
+    create_index_concurrently(conn, cur, 'requests_assigned_to_user_idx',
+        'requests (assigned_to_user) WHERE assigned_to_user IS NOT NULL')
+
+    # get_updates_by_request_id, in the order they were made, and the cascade when a request is deleted
+    create_index_concurrently(conn, cur, 'updates_request_id_idx',
+        'updates (request_id, created_at)')
+    create_index_concurrently(conn, cur, 'request_updates_associated_request_idx',
+        'request_updates (associated_request)')
+
+    # the expired token sweeper (already created by create_database.py on newer installs)
+    create_index_concurrently(conn, cur, 'tokens_deadline_idx',
+        'tokens (deadline)')
+
+#
+# 4: Indexes for the agent work queues (database.query_requests), open requests by department,
+# team and assignee in the order they came in, and every request by date
+#
+def add_request_queue_indexes(conn, cur):
+    create_index_concurrently(conn, cur, 'requests_department_queue_idx',
+        'requests (team_category, requested_at, id) WHERE resolved = false')
+    create_index_concurrently(conn, cur, 'requests_team_queue_idx',
+        'requests (assigned_to_team, requested_at, id) WHERE resolved = false')
+    create_index_concurrently(conn, cur, 'requests_assignee_queue_idx',
+        'requests (assigned_to_user, requested_at, id) WHERE resolved = false')
+    create_index_concurrently(conn, cur, 'requests_requested_at_idx',
+        'requests (requested_at, id)')
+
+#
+# Add a search_vector column to a table, kept up to date by a trigger calling vector_function on the
+# columns it is made from. Adding a plain nullable column doesn't rewrite the table, the existing rows
+# are then filled in a batch at a time (each batch commits on its own) so no lock is held for long.
+#
+def add_search_vector(conn, cur, table, columns, vector_function):
+    cur.execute('''
+        SELECT is_generated FROM information_schema.columns
+        WHERE table_name = %s AND column_name = 'search_vector'
+    ''', (table,))
+    column = cur.fetchone()
+
+    # installs that got the earlier generated column already have it maintained by Postgres
+    if column is not None and column[0] == 'ALWAYS':
+        return
+
+    arguments = ', '.join(f'NEW.{name}' for name in columns)
+
+    cur.execute(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS search_vector tsvector')
+    cur.execute(f'''
+        CREATE OR REPLACE FUNCTION {table}_search_vector_trigger() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := {vector_function}({arguments});
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    cur.execute(f'DROP TRIGGER IF EXISTS {table}_search_vector_trigger ON {table}')
+    cur.execute(f'''
+        CREATE TRIGGER {table}_search_vector_trigger
+        BEFORE INSERT OR UPDATE OF {', '.join(columns)} ON {table}
+        FOR EACH ROW EXECUTE FUNCTION {table}_search_vector_trigger()
+    ''')
+
+    # rows written from here on have the trigger, fill in the ones before it in id order
+    last_id = 0
+    while True:
+        cur.execute(f'''
+            UPDATE {table} t
+            SET search_vector = {vector_function}({', '.join(f't.{name}' for name in columns)})
+            FROM (
+                SELECT id FROM {table}
+                WHERE id > %s AND search_vector IS NULL
+                ORDER BY id
+                LIMIT %s
+            ) batch
+            WHERE t.id = batch.id
+            RETURNING t.id
+        ''', (last_id, SEARCH_VECTOR_BATCH_SIZE))
+        ids = [row[0] for row in cur.fetchall()]
+
+        if not ids:
+            break
+
+        last_id = max(ids)
+
+#
+# 5: Full text search (database.search_requests). The search_vector columns are set by triggers on every insert
+# and on updates of the text they are made from. The tables aren't rewritten, the existing rows are filled in
+# batches and the GIN indexes built online.
+#
+def add_search_vectors(conn, cur):
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION request_search_vector(title TEXT, description TEXT) RETURNS tsvector AS $$
+            SELECT setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(description, '')), 'B')
+        $$ LANGUAGE sql IMMUTABLE
+    ''')
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION update_search_vector(content TEXT) RETURNS tsvector AS $$
+            SELECT to_tsvector('english', coalesce(content, ''))
+        $$ LANGUAGE sql IMMUTABLE
+    ''')
+
+    add_search_vector(conn, cur, 'requests', ('title', 'description'), 'request_search_vector')
+    add_search_vector(conn, cur, 'updates', ('content',), 'update_search_vector')
+
+    create_index_concurrently(conn, cur, 'requests_search_idx', 'requests USING GIN (search_vector)')
+    create_index_concurrently(conn, cur, 'updates_search_idx', 'updates USING GIN (search_vector)')
+
+#
+# 6: Request counters for the dashboard statistics (database.get_request_stats). One row per dimension
+# (all, department, team, type, priority) and value, -1 where the request doesn't have one.
+# A trigger on requests moves each request's counts when it is added, resolved, reassigned or
+# recategorised, in the same transaction. database.reconcile_request_stats recounts them periodically.
+#
+def add_request_stats(conn, cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS request_stats (
+            dimension VARCHAR(16) NOT NULL,
+            key INTEGER NOT NULL,
+            open INTEGER NOT NULL DEFAULT 0,
+            unassigned INTEGER NOT NULL DEFAULT 0,
+            resolved INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (dimension, key)
+        ) WITH (fillfactor = 50)
+    ''')
+
+    # add (sign 1) or take away (sign -1) one request's counts
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION request_stats_apply(r requests, sign INTEGER) RETURNS void AS $$
+        BEGIN
+            INSERT INTO request_stats AS s (dimension, key, open, unassigned, resolved)
+            SELECT d.dimension, d.key,
+                sign * (NOT COALESCE(r.resolved, false))::integer,
+                sign * (NOT COALESCE(r.resolved, false) AND (r.assigned_to_team IS NULL OR r.assigned_to_user IS NULL))::integer,
+                sign * COALESCE(r.resolved, false)::integer
+            FROM (VALUES
+                ('all', 0),
+                ('department', COALESCE(r.team_category, -1)),
+                ('team', COALESCE(r.assigned_to_team, -1)),
+                ('type', COALESCE(r.type, -1)),
+                ('priority', COALESCE(r.priority, -1))
+            ) AS d (dimension, key)
+            ON CONFLICT (dimension, key) DO UPDATE SET
+                open = s.open + EXCLUDED.open,
+                unassigned = s.unassigned + EXCLUDED.unassigned,
+                resolved = s.resolved + EXCLUDED.resolved;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION request_stats_trigger() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM request_stats_apply(OLD, -1);
+            END IF;
+
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM request_stats_apply(NEW, 1);
+            END IF;
+
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+
+    # only changes to the counted columns fire it, editing a title doesn't
+    cur.execute('DROP TRIGGER IF EXISTS request_stats_trigger ON requests')
+    cur.execute('''
+        CREATE TRIGGER request_stats_trigger
+        AFTER INSERT OR DELETE OR UPDATE OF resolved, assigned_to_team, assigned_to_user, team_category, type, priority
+        ON requests
+        FOR EACH ROW EXECUTE FUNCTION request_stats_trigger()
+    ''')
+
+    # count the existing requests, creating the trigger locked out writes until this commits
+    cur.execute('DELETE FROM request_stats')
+    cur.execute('''
+        INSERT INTO request_stats (dimension, key, open, unassigned, resolved)
+        SELECT d.dimension, d.key,
+            count(*) FILTER (WHERE NOT COALESCE(r.resolved, false)),
+            count(*) FILTER (WHERE NOT COALESCE(r.resolved, false) AND (r.assigned_to_team IS NULL OR r.assigned_to_user IS NULL)),
+            count(*) FILTER (WHERE COALESCE(r.resolved, false))
+        FROM requests r
+        CROSS JOIN LATERAL (VALUES
+            ('all', 0),
+            ('department', COALESCE(r.team_category, -1)),
+            ('team', COALESCE(r.assigned_to_team, -1)),
+            ('type', COALESCE(r.type, -1)),
+            ('priority', COALESCE(r.priority, -1))
+        ) AS d (dimension, key)
+        GROUP BY d.dimension, d.key
+    ''')
+
+#
+# 7: Team membership moves from the teams.users array to the team_members table, one row per membership,
+# so adding a member doesn't rewrite and lock the team row and a user's teams can be looked up by index.
+# The teams_with_members view puts the users array back together for reads that want the old shape.
+# teams.users is copied but kept for older versions of the app during a rolling upgrade, migration 8
+# keeps the two in step.
+#
+def add_team_members(conn, cur):
+    create_database.create_team_members_table(conn, cur)
+
+    # copy the existing memberships over, skipping duplicates and users that no longer exist
+    cur.execute('''
+        INSERT INTO team_members (team_id, user_id)
+        SELECT DISTINCT t.id, member.user_id
+        FROM teams t
+        CROSS JOIN LATERAL unnest(t.users) AS member (user_id)
+        INNER JOIN users u ON u.id = member.user_id
+        ON CONFLICT DO NOTHING
+    ''')
+
+    # same columns, in the same order, as the teams table
+    cur.execute('''
+        CREATE OR REPLACE VIEW teams_with_members AS
+        SELECT t.id, t.name,
+            ARRAY(SELECT m.user_id FROM team_members m WHERE m.team_id = t.id ORDER BY m.added_at, m.user_id) AS users,
+            t.description
+        FROM teams t
+    ''')
+
+#
+# 8: Keep teams.users and team_members in step while older versions of the app, which read and write
+# teams.users, may still be running. A change to either is copied to the other by a trigger, the
+# pg_trigger_depth() check stops the copy from coming back. Memberships older versions wrote between
+# migration 7 and this one are copied again.
+#
+# The upgrade window ends with a later migration that drops both triggers and teams.users, once no
+# version older than migration 7 is deployed. Until then adding a member also updates the team row.
+#
+def sync_team_members(conn, cur):
+    # teams.users written (by an older version), make team_members match it
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION teams_users_sync() RETURNS trigger AS $$
+        BEGIN
+            IF pg_trigger_depth() > 1 THEN
+                RETURN NULL;
+            END IF;
+
+            DELETE FROM team_members m
+            WHERE m.team_id = NEW.id AND NOT (m.user_id = ANY(COALESCE(NEW.users, '{}')));
+
+            INSERT INTO team_members (team_id, user_id)
+            SELECT DISTINCT NEW.id, member.user_id
+            FROM unnest(NEW.users) AS member (user_id)
+            INNER JOIN users u ON u.id = member.user_id
+            ON CONFLICT DO NOTHING;
+
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+
+    # team_members written, rebuild the team's users array from it
+    cur.execute('''
+        CREATE OR REPLACE FUNCTION team_members_sync() RETURNS trigger AS $$
+        DECLARE
+            changed_team INTEGER;
+        BEGIN
+            IF pg_trigger_depth() > 1 THEN
+                RETURN NULL;
+            END IF;
+
+            IF TG_OP = 'DELETE' THEN
+                changed_team := OLD.team_id;
+            ELSE
+                changed_team := NEW.team_id;
+            END IF;
+
+            UPDATE teams t
+            SET users = ARRAY(SELECT m.user_id FROM team_members m WHERE m.team_id = t.id ORDER BY m.added_at, m.user_id)
+            WHERE t.id = changed_team;
+
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+
+    cur.execute('DROP TRIGGER IF EXISTS teams_users_sync ON teams')
+    cur.execute('''
+        CREATE TRIGGER teams_users_sync
+        AFTER INSERT OR UPDATE OF users ON teams
+        FOR EACH ROW EXECUTE FUNCTION teams_users_sync()
+    ''')
+
+    cur.execute('DROP TRIGGER IF EXISTS team_members_sync ON team_members')
+    cur.execute('''
+        CREATE TRIGGER team_members_sync
+        AFTER INSERT OR DELETE ON team_members
+        FOR EACH ROW EXECUTE FUNCTION team_members_sync()
+    ''')
+
+    # catch up on memberships written to either side since migration 7
+    cur.execute('''
+        INSERT INTO team_members (team_id, user_id)
+        SELECT DISTINCT t.id, member.user_id
+        FROM teams t
+        CROSS JOIN LATERAL unnest(t.users) AS member (user_id)
+        INNER JOIN users u ON u.id = member.user_id
+        ON CONFLICT DO NOTHING
+    ''')
+    cur.execute('''
+        UPDATE teams t
+        SET users = ARRAY(SELECT m.user_id FROM team_members m WHERE m.team_id = t.id ORDER BY m.added_at, m.user_id)
+    ''')
+
+# (version, name, function, transactional)
+MIGRATIONS = [
+    (1, 'upgrade existing tables', upgrade_existing_tables, True),
+    (2, 'add foreign keys', add_foreign_keys, False),
+    (3, 'add request indexes', add_request_indexes, False),
+    (4, 'add request queue indexes', add_request_queue_indexes, False),
+    (5, 'add full text search', add_search_vectors, False),
+    (6, 'add request stats', add_request_stats, True),
+    (7, 'add team members', add_team_members, True),
+    (8, 'sync team members', sync_team_members, True)
+]
+
+#
+# Open a connection of our own for the migrations, outside the pools (which set statement timeouts)
+#
+def connect():
+    settings = database.load_pool_settings()
+    creds = db_util.read_credentials()
+
+    conn = psycopg2.connect(
+        dbname=settings['dbname'],
+        user=creds['username'],
+        password=creds['password'],
+        host=settings['host'],
+        port=settings['port'],
+        connect_timeout=settings['connect_timeout']
+    )
+
+    conn.autocommit = True
+    return conn
+
+#
+# Return the versions already applied
+#
+def get_applied_versions(cur):
+    cur.execute('SELECT version FROM schema_migrations')
+    return {row[0] for row in cur.fetchall()}
+
+#
+# Apply every migration that hasn't been applied yet, in order. Returns the versions applied.
+#
+def migrate():
+    conn = connect()
+    cur = conn.cursor()
+    applied = []
+
+    try:
+        # wait for any other process that is migrating to finish
+        cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_ID,))
+        cur.execute('SET lock_timeout = %s', (MIGRATION_LOCK_TIMEOUT,))
+
+        create_schema_migrations_table(conn, cur)
+        done = get_applied_versions(cur)
+
+        for version, name, migration, transactional in MIGRATIONS:
+            if version in done:
+                continue
+
+            migrations_logger.info('Applying migration %s (%s)', version, name)
+
+            if transactional:
+                conn.autocommit = False
+
+                try:
+                    migration(conn, cur)
+                    cur.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (version, name))
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.autocommit = True
+            else:
+                migration(conn, cur)
+                cur.execute('INSERT INTO schema_migrations (version, name) VALUES (%s, %s)', (version, name))
+
+            applied.append(version)
+            migrations_logger.info('Applied migration %s (%s)', version, name)
+
+        cur.execute('SELECT pg_advisory_unlock(%s)', (MIGRATION_LOCK_ID,))
+    except Exception as error:
+        migrations_logger.error('Migration failed: %s', error)
+        raise
+    finally:
+        cur.close()
+        conn.close()
+
+    return applied
+
+if __name__ == '__main__':
+    versions = migrate()
+    print(f'Applied migrations: {versions}' if versions else 'Database schema is up to date')
@@ -0,0 +1,48 @@
+import threading, logger
+
+#
+# Runs periodic background jobs (token sweeping, cache refreshes etc.) on daemon threads.
+# Each process running the app has its own jobs, so jobs must be safe to run concurrently
+# from several processes against the same database.
+#
+
+scheduler_logger = logger.get_logger('scheduler', 'logs/scheduler.log')
+
+# job name -> (thread, stop event)
+jobs = {}
+jobs_lock = threading.Lock()
+
+#
+# Run the job every interval seconds until stopped. Scheduling a job name that is already running does nothing.
+#
+def schedule(name, interval, job) -> None:
+    with jobs_lock:
+        if name in jobs:
+            return
+
+        stop = threading.Event()
+
+        def run():
+            # wait first, the app is still starting up when jobs are scheduled
+            while not stop.wait(interval):
+                try:
+                    job()
+                except Exception as error:
+                    scheduler_logger.error('Background job %s failed: %s', name, error)
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        jobs[name] = (thread, stop)
+        thread.start()
+
+    scheduler_logger.info('Scheduled background job %s every %s seconds', name, interval)
+
+#
+# Stop a running job, it finishes its current run first
+#
+def stop(name) -> None:
+    with jobs_lock:
+        job = jobs.pop(name, None)
+
+    if job:
+        job[1].set()
+        scheduler_logger.info('Stopped background job %s', name)
@@ -7,12 +7,9 @@ function updateUnassignedRequestsTable() {
         // Clear existing rows
         table.querySelector('tbody').innerHTML = '';
 
-        // Fetch unassigned requests from the server
-        fetch('/api/requests/unassigned')
-            .then(response => response.json())
-            .then(data => {
-                data.forEach(request => {
-
+        // Fetch the oldest page of unassigned requests from the server, more are loaded on demand
+        loadPagedList('/api/requests/unassigned', table, requests => {
+                requests.forEach(request => {
                     var createdDate = new Date(request[2]);
                     var priorityBadge = '';
                     const priority = request[3]; // Assuming request[3] is the priority
@@ -58,30 +55,31 @@ function updateUnassignedRequestsTable() {
 
 function updateUpdatesList(requestId) {
     const updatesList = document.getElementById('updates-list');
-    fetch(`/api/requests/${requestId}/updates`)
-        .then(response => response.json())
-        .then(updates => {
-
-            // Update the badge on the updates button
-            updatesCountBadge = document.getElementById('update-btn-count-badge');
-            if (updates.length > 0) {
-                updatesCountBadge.textContent = updates.length;
+    const updatesCountBadge = document.getElementById('update-btn-count-badge');
+    let updatesCount = 0;
 
+    // the oldest updates first, later ones are loaded on demand
+    loadPagedList(`/api/requests/${requestId}/updates`, updatesList, (updates, hasMore, firstPage) => {
+            if (firstPage) {
                 updatesList.innerHTML = ''; // Clear any existing updates
-                updates.forEach(update => {
-                    const updateItem = document.createElement('div');
-                    updateItem.className = 'list-group-item';
-                    updateItem.innerHTML = `
+                updatesCount = 0;
+            }
+
+            // Update the badge on the updates button, + while there are more to load
+            updatesCount += updates.length;
+            updatesCountBadge.textContent = hasMore ? `${updatesCount}+` : updatesCount;
+
+            updates.forEach(update => {
+                const updateItem = document.createElement('div');
+                updateItem.className = 'list-group-item';
+                updateItem.innerHTML = `
 									<div class="col">
 										<div class="text-reset d-block">${update[4]}</div>
 										<div class="text-secondary">${update[2]} at ${new Date(update[1]).toLocaleString()}</div>
 									</div>
 								`;
-                    updatesList.appendChild(updateItem);
-                });
-            } else {
-                updatesCountBadge.textContent = 0;
-            }
+                updatesList.appendChild(updateItem);
+            });
         })
         .catch(error => {
             console.error('Error:', error);
@@ -105,28 +103,28 @@ document.addEventListener('click', function (event) {
                 // Populate the modal with request data
                 priorityBadge = document.getElementById('priority-view-badge');
 
-                switch (data[3]) {
+                switch (data.priority) {
                     case 1:
                         // Change color to red for high priority
-                        priorityBadge.innerHTML = `<span class="badge bg-purple text-purple-fg">P${data[3]}</span>`;
+                        priorityBadge.innerHTML = `<span class="badge bg-purple text-purple-fg">P${data.priority}</span>`;
                         break;
                     case 2:
                         // Change color to orange for medium priority
-                        priorityBadge.innerHTML = `<span class="badge bg-red text-red-fg">P${data[3]}</span>`;
+                        priorityBadge.innerHTML = `<span class="badge bg-red text-red-fg">P${data.priority}</span>`;
                         break;
                     case 3:
                         // Change color to yellow for low priority
-                        priorityBadge.innerHTML = `<span class="badge bg-orange text-orange-fg">P${data[3]}</span>`;
+                        priorityBadge.innerHTML = `<span class="badge bg-orange text-orange-fg">P${data.priority}</span>`;
                         break;
                     case 4:
                         // Default color
-                        priorityBadge.innerHTML = `<span class="badge bg-yellow text-yellow-fg">P${data[3]}</span>`;
+                        priorityBadge.innerHTML = `<span class="badge bg-yellow text-yellow-fg">P${data.priority}</span>`;
                         break;
                 }
 
                 outageBadge = document.getElementById('outage-view-badge');
 
-                if (data[4] === true) {
+                if (data.outage === true) {
                     outageBadge.style = 'display:block';
                     outageBadge.textContent = 'Outage';
                 } else {
@@ -134,14 +132,14 @@ document.addEventListener('click', function (event) {
                     outageBadge.textContent = 'Outage';
                 }
 
-                document.getElementById('title-view-field').value = data[5];
-                // document.getElementById('resolve-secondary-text').innerText = '\'' + data[5] + '\'';
-                document.getElementById('description-view-field').value = data[6];
-                document.getElementById('created-view-date').textContent = new Date(data[2]).toLocaleString();
-                document.getElementById('type-view-field').value = data[11];
-                // document.getElementById('department-view-field').value = data[7]; // Disabled as department is not editable here
-                document.getElementById('team-view-field').value = data[8];
-                document.getElementById('assignee-view-field').value = data[9];
+                document.getElementById('title-view-field').value = data.title;
+                // document.getElementById('resolve-secondary-text').innerText = '\'' + data.title + '\'';
+                document.getElementById('description-view-field').value = data.description;
+                document.getElementById('created-view-date').textContent = new Date(data.requested_at).toLocaleString();
+                document.getElementById('type-view-field').value = data.type;
+                // document.getElementById('department-view-field').value = data.department; // Disabled as department is not editable here
+                document.getElementById('team-view-field').value = data.team;
+                document.getElementById('assignee-view-field').value = data.assignee;
 
                 // populate the updates modal as well, so when the user clicks on the updates tab, so it's already loaded
 
@@ -33,4 +33,60 @@ function generatePassword() {
 	}
 	
     return pw;
-}
\ No newline at end of file
+}
+
+/*
+	Show a paged list endpoint a page at a time. The first page is fetched straight away, the
+	next one only when the "Load more" button placed after the list is clicked, following the
+	next_cursor of the page before. The button is hidden once the last page has been shown.
+	Calling it again for the same list starts over from the first page.
+	@param {string} url The list endpoint
+	@param {HTMLElement} after The element (list or table) the button goes after
+	@param {Function} renderItems Called with the items of each page, whether there are more pages, and whether it is the first page
+	@returns {Promise} Resolves once the first page has been shown
+*/
+function loadPagedList(url, after, renderItems) {
+	let cursor = null;
+
+	// one button per list, reused when the list is loaded again
+	let button = after.loadMoreButton;
+
+	if (!button) {
+		button = document.createElement('button');
+		button.type = 'button';
+		button.className = 'btn btn-link w-100 load-more-btn';
+		button.textContent = 'Load more';
+		after.insertAdjacentElement('afterend', button);
+		after.loadMoreButton = button;
+	}
+
+	async function loadPage() {
+		const firstPage = cursor === null;
+		const separator = url.includes('?') ? '&' : '?';
+
+		button.disabled = true;
+
+		try {
+			const response = await fetch(firstPage ? url : `${url}${separator}cursor=${encodeURIComponent(cursor)}`);
+
+			if (!response.ok) {
+				throw new Error(`Error: ${response.status} ${response.statusText}`);
+			}
+
+			const page = await response.json();
+			cursor = page.next_cursor;
+			renderItems(page.items, Boolean(cursor), firstPage);
+		} finally {
+			button.disabled = false;
+			button.style.display = cursor ? '' : 'none';
+		}
+	}
+
+	button.onclick = () => loadPage().catch(error => {
+		console.error('Error:', error);
+		showErrorModal('Error', 'An error occurred while loading more items.');
+	});
+
+	button.style.display = 'none';
+	return loadPage();
+}
@@ -68,30 +68,13 @@ async function getTeamById(teamId) {
 }
 
 /*
-	Get all users from the server and return the Promise.
-*/
-async function getUsers() {
-	try {
-		const response = await fetch('/api/users');
-		if (!response.ok) {
-			throw new Error(`Error: ${response.status} ${response.statusText}`);
-		}
-		const users = await response.json();
-		return users;
-	} catch (error) {
-		showErrorModal('Failed to fetch users', 'An error occurred while fetching users. Please try again later.');
-		return [];
-	}
-}
-
-/*
-	Populate the users table.
+	Populate the users table a page at a time, more users are loaded on demand.
 */
 const usersTable = document.getElementById('users-table-rows');
-getUsers().then(users => {
-	usersTable.innerHTML = "";
-	badges = [];
+usersTable.innerHTML = "";
+badges = [];
 
+loadPagedList('/api/users', usersTable.closest('table') || usersTable, users => {
 	users.forEach(user => {
 		usersTable.innerHTML += `
 			<tr>
@@ -122,6 +105,9 @@ getUsers().then(users => {
 			</tr>
 		`;
 	});
+}).catch(error => {
+	console.error('Error:', error);
+	showErrorModal('Failed to fetch users', 'An error occurred while fetching users. Please try again later.');
 });
 
 /*
@@ -23,13 +23,11 @@ if (getTokenFromCookie()) {
 /*
 	Fetch requests
 */
-fetch('/api/requests/user/self')
-	.then(response => response.json())
-	.then(data => {
-		priorityBadge = ""
+const requestList = document.getElementById('request-list');
 
-		// Sort data by index 2 (date), newest first
-		data.sort((a, b) => new Date(b[2]) - new Date(a[2]));
+// newest first, older requests are loaded on demand
+loadPagedList('/api/requests/user/self', requestList, data => {
+		priorityBadge = ""
 
 		data.forEach(request => {
 			// Check priority and change colour of P indicator
@@ -54,7 +52,6 @@ fetch('/api/requests/user/self')
 					break;
 			}
 
-			const requestList = document.getElementById('request-list');
 			requestList.innerHTML +=
 				`
 			<div class="list-group-item">
@@ -151,6 +148,43 @@ newRequestSubmitBtn = document.getElementById('new-request-submit').onclick = fu
 	}
 }
 
+/*
+	Show a request's updates in the request modal, oldest first, later ones are loaded on demand.
+	@param {string} requestId The request whose updates to show
+*/
+function loadUpdatesList(requestId) {
+	const updatesList = document.getElementById('updates-list');
+	const updatesCountBadge = document.getElementById('update-btn-count-badge');
+	let updatesCount = 0;
+
+	loadPagedList(`/api/requests/${requestId}/updates`, updatesList, (updates, hasMore, firstPage) => {
+			if (firstPage) {
+				updatesList.innerHTML = ''; // Clear any existing updates
+				updatesCount = 0;
+			}
+
+			// Update the badge on the updates button, + while there are more to load
+			updatesCount += updates.length;
+			updatesCountBadge.textContent = hasMore ? `${updatesCount}+` : updatesCount;
+
+			updates.forEach(update => {
+				const updateItem = document.createElement('div');
+				updateItem.className = 'list-group-item';
+				updateItem.innerHTML = `
+					<div class="col">
+						<div class="text-reset d-block">${update[4]}</div>
+						<div class="text-secondary">${update[2]} at ${new Date(update[1]).toLocaleString()}</div>
+					</div>
+				`;
+				updatesList.appendChild(updateItem);
+			});
+		})
+		.catch(error => {
+			console.error('Error:', error);
+			updatesList.innerHTML = 'No updates available.';
+		});
+}
+
 /*
 	Handle the View button on each request.
 */
@@ -165,28 +199,28 @@ document.addEventListener('click', function (event) {
 				// Populate the modal with request data
 				priorityBadge = document.getElementById('priority-view-badge');
 
-				switch (data[3]) {
+				switch (data.priority) {
 					case 1:
 						// Change color to red for high priority
-						priorityBadge.innerHTML = `<span class="badge bg-purple text-purple-fg">P${data[3]}</span>`;
+						priorityBadge.innerHTML = `<span class="badge bg-purple text-purple-fg">P${data.priority}</span>`;
 						break;
 					case 2:
 						// Change color to orange for medium priority
-						priorityBadge.innerHTML = `<span class="badge bg-red text-red-fg">P${data[3]}</span>`;
+						priorityBadge.innerHTML = `<span class="badge bg-red text-red-fg">P${data.priority}</span>`;
 						break;
 					case 3:
 						// Change color to yellow for low priority
-						priorityBadge.innerHTML = `<span class="badge bg-orange text-orange-fg">P${data[3]}</span>`;
+						priorityBadge.innerHTML = `<span class="badge bg-orange text-orange-fg">P${data.priority}</span>`;
 						break;
 					case 4:
 						// Default color
-						priorityBadge.innerHTML = `<span class="badge bg-yellow text-yellow-fg">P${data[3]}</span>`;
+						priorityBadge.innerHTML = `<span class="badge bg-yellow text-yellow-fg">P${data.priority}</span>`;
 						break;
 				}
 
 				outageBadge = document.getElementById('outage-view-badge');
 
-				if (data[4] === true) {
+				if (data.outage === true) {
 					outageBadge.style = 'display:block';
 					outageBadge.textContent = 'Outage';
 				} else {
@@ -194,51 +228,21 @@ document.addEventListener('click', function (event) {
 					outageBadge.textContent = 'Outage';
 				}
 
-				document.getElementById('title-view-field').value = data[5];
-				document.getElementById('resolve-secondary-text').innerText = '\''+data[5]+'\'';
-				document.getElementById('description-view-field').value = data[6];
-				document.getElementById('created-view-date').textContent = new Date(data[2]).toLocaleString();
-				document.getElementById('type-view-field').value = data[11];
-				document.getElementById('department-view-field').value = data[7];
-				document.getElementById('team-view-field').value = data[8];
-				document.getElementById('assignee-view-field').value = data[9];
+				document.getElementById('title-view-field').value = data.title;
+				document.getElementById('resolve-secondary-text').innerText = '\''+data.title+'\'';
+				document.getElementById('description-view-field').value = data.description;
+				document.getElementById('created-view-date').textContent = new Date(data.requested_at).toLocaleString();
+				document.getElementById('type-view-field').value = data.type;
+				document.getElementById('department-view-field').value = data.department;
+				document.getElementById('team-view-field').value = data.team;
+				document.getElementById('assignee-view-field').value = data.assignee;
 
 				// populate the updates modal as well, so when the user clicks on the updates tab, so it's already loaded
 
-				const updatesList = document.getElementById('updates-list');
-				fetch(`/api/requests/${requestId}/updates`)
-					.then(response => response.json())
-					.then(updates => {
-
-						// Update the badge on the updates button
-						updatesCountBadge = document.getElementById('update-btn-count-badge');
-						if (updates.length > 0) {
-							updatesCountBadge.textContent = updates.length;
-
-							updatesList.innerHTML = ''; // Clear any existing updates
-							updates.forEach(update => {
-								const updateItem = document.createElement('div');
-								updateItem.className = 'list-group-item';
-								updateItem.innerHTML = `
-									<div class="col">
-										<div class="text-reset d-block">${update[4]}</div>
-										<div class="text-secondary">${update[2]} at ${new Date(update[1]).toLocaleString()}</div>
-									</div>
-								`;
-								updatesList.appendChild(updateItem);
-							});
-						} else {
-							updatesCountBadge.textContent = 0;
-						}
-					})
-					.catch(error => {
-						console.error('Error:', error);
-						updatesList.innerHTML = 'No updates available.';
-					});
-
-			
-					// update the requestid for the button to add an update
-					document.getElementById('add-update-btn').setAttribute('data-request-id', requestId);
+				loadUpdatesList(requestId);
+
+				// update the requestid for the button to add an update
+				document.getElementById('add-update-btn').setAttribute('data-request-id', requestId);
 			})
 			.catch(error => {
 				console.error('Error:', error);
@@ -271,27 +275,7 @@ document.addEventListener('click', function (event) {
 					if (data.success) {
 
 						// Reload the updates list
-						const updatesList = document.getElementById('updates-list');
-						fetch(`/api/requests/${requestId}/updates`)
-							.then(response => response.json())
-							.then(updates => {
-								updatesList.innerHTML = ''; // Clear any existing updates
-								updates.forEach(update => {
-									const updateItem = document.createElement('div');
-									updateItem.className = 'list-group-item';
-									updateItem.innerHTML = `
-										<div class="col">
-											<div class="text-reset d-block">${update[4]}</div>
-											<div class="text-secondary">${update[2]} at ${new Date(update[1]).toLocaleString()}</div>
-										</div>
-									`;
-									updatesList.appendChild(updateItem);
-								});
-							})
-							.catch(error => {
-								console.error('Error:', error);
-								updatesList.innerHTML = 'No updates available.';
-							});
+						loadUpdatesList(requestId);
 
 						// Reset the update text box
 						document.getElementById('update-text').value
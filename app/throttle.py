@@ -0,0 +1,149 @@
+from collections import OrderedDict
+import os, threading, time, ipaddress, logger, database
+
+#
+# Token bucket throttling for login attempts, keyed by username and by client address.
+# Every attempt takes a token from both buckets, an attempt is rejected (before any hashing or
+# database work) if either bucket is empty. Buckets refill at a steady rate up to their capacity.
+#
+# Buckets are held in a bounded in-memory table per process. Set RM_LOGIN_THROTTLE_SHARED=1 to keep
+# them in Postgres instead so every worker process shares the same budget.
+#
+# Successful logins give their tokens back, so only failed attempts use up the budget.
+#
+# Behind a reverse proxy every request comes from the proxy's address. List the proxies (addresses or
+# networks, comma separated) in RM_TRUSTED_PROXIES and the client address is taken from X-Forwarded-For
+# for requests they pass on. The header is ignored from anyone else, clients could set it to anything.
+#
+
+USERNAME_BUCKET_CAPACITY = 10
+USERNAME_REFILL_PER_SECOND = 1 / 6
+ADDRESS_BUCKET_CAPACITY = 30
+ADDRESS_REFILL_PER_SECOND = 1 / 2
+
+# Least recently used buckets are dropped when the table is full
+MAX_BUCKETS = 10000
+
+SHARED_BUCKETS = os.environ.get('RM_LOGIN_THROTTLE_SHARED', '0') == '1'
+
+TRUSTED_PROXIES = [ipaddress.ip_network(proxy.strip(), strict=False)
+    for proxy in os.environ.get('RM_TRUSTED_PROXIES', '').split(',') if proxy.strip()]
+
+# Shared buckets that haven't been touched for this long are full again and can be deleted
+SHARED_BUCKET_SWEEP_INTERVAL = 600  # seconds
+
+throttle_logger = logger.get_logger('throttle', 'logs/throttle.log')
+
+# key -> [tokens, last refill (monotonic seconds)]
+buckets = OrderedDict()
+buckets_lock = threading.Lock()
+
+#
+# Take a token from the in-memory bucket for the key, return False if the bucket is empty
+#
+def take_local_token(key, capacity, refill_per_second) -> bool:
+    now = time.monotonic()
+
+    with buckets_lock:
+        bucket = buckets.get(key)
+
+        if bucket is None:
+            bucket = [capacity, now]
+            buckets[key] = bucket
+
+            while len(buckets) > MAX_BUCKETS:
+                buckets.popitem(last=False)
+        else:
+            bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * refill_per_second)
+            bucket[1] = now
+            buckets.move_to_end(key)
+
+        if bucket[0] < 1:
+            return False
+
+        bucket[0] -= 1
+        return True
+
+#
+# Give a token back to the in-memory bucket for the key, up to its capacity
+#
+def refund_local_token(key, capacity) -> None:
+    with buckets_lock:
+        bucket = buckets.get(key)
+
+        if bucket is not None:
+            bucket[0] = min(capacity, bucket[0] + 1)
+
+#
+# Return True if the address is one of the trusted reverse proxies
+#
+def is_trusted_proxy(address) -> bool:
+    try:
+        address = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+
+    return any(address in proxy for proxy in TRUSTED_PROXIES)
+
+#
+# Return the address of the client making the request. If the request came through trusted proxies, the
+# client is the last address in X-Forwarded-For that isn't one of them (each proxy appends the address it
+# got the request from, anything before that could have been sent by the client).
+#
+def client_address(remote_addr, forwarded_for) -> str:
+    if not forwarded_for or not is_trusted_proxy(remote_addr):
+        return remote_addr
+
+    for address in reversed([address.strip() for address in forwarded_for.split(',')]):
+        if address and not is_trusted_proxy(address):
+            return address
+
+    return remote_addr
+
+#
+# Take a token from the bucket for the key, shared through the database or in memory
+#
+def take_token(key, capacity, refill_per_second) -> bool:
+    if SHARED_BUCKETS:
+        return database.take_login_throttle_token(key, capacity, refill_per_second)
+
+    return take_local_token(key, capacity, refill_per_second)
+
+#
+# Return True if a login attempt for the username from the address is within budget.
+# Cheap enough to run before the password is looked at.
+#
+def allow_login(username, address) -> bool:
+    username_allowed = take_token(f'user:{(username or "").lower()}', USERNAME_BUCKET_CAPACITY, USERNAME_REFILL_PER_SECOND)
+    address_allowed = take_token(f'addr:{address}', ADDRESS_BUCKET_CAPACITY, ADDRESS_REFILL_PER_SECOND)
+
+    if not username_allowed or not address_allowed:
+        throttle_logger.warning('Login attempt for %s from %s throttled', username, address)
+        return False
+
+    return True
+
+#
+# Give back the tokens a login attempt took, called once it has succeeded so that a burst of users
+# logging in (e.g. everyone through the same proxy on a Monday morning) isn't throttled
+#
+def refund_login(username, address) -> None:
+    keys = ((f'user:{(username or "").lower()}', USERNAME_BUCKET_CAPACITY), (f'addr:{address}', ADDRESS_BUCKET_CAPACITY))
+
+    for key, capacity in keys:
+        if SHARED_BUCKETS:
+            database.refund_login_throttle_token(key, capacity)
+        else:
+            refund_local_token(key, capacity)
+
+#
+# Delete shared buckets that have had time to refill completely. Run by the scheduler.
+#
+def sweep_shared_buckets() -> None:
+    slowest_refill = min(USERNAME_REFILL_PER_SECOND, ADDRESS_REFILL_PER_SECOND)
+    largest_capacity = max(USERNAME_BUCKET_CAPACITY, ADDRESS_BUCKET_CAPACITY)
+
+    deleted = database.delete_idle_login_throttle_buckets(largest_capacity / slowest_refill)
+
+    if deleted:
+        throttle_logger.info('Deleted %s idle login throttle buckets', deleted)